@@ -6,17 +6,34 @@ from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 import io
+import os
+import glob
+import tempfile
 import datetime
 import numpy as np
 import json
 import base64
+import hashlib
 import re
 import time
+import queue
+import shutil
+import threading
+import concurrent.futures
+import sys
+import unicodedata
+import weakref
 import google.generativeai as genai
+import ingest_worker
 
 # ==========================================================================
 # 1. CONFIGURAZIONE & STILE (v96.0 - Fix use_container_width in st.plotly_chart (Streamlit 1.54 width=stretch); zero warning loop in idle heartbeat: contesto AI caricato prima di render_ai_assistant, df unico globale)
 # ==========================================================================
+# Copy-on-Write: i frame filtrati condividono la memoria del dataset condiviso
+# finché non vengono modificati (comportamento di default da pandas 3.0).
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
 st.set_page_config(
     page_title="EITA Analytics Pro v96.0",
     page_icon="🖥️",
@@ -228,6 +245,14 @@ def get_google_service():
     FIX #4 - errore non più silente: l'eccezione viene restituita come
               secondo elemento della tupla così l'utente vede il vero messaggio.
     """
+    return _build_drive_service()
+
+
+def _build_drive_service():
+    """
+    Costruisce un service Drive nuovo → (service, errore). httplib2 non è thread-safe:
+    i thread in background (watcher della cartella) usano un service proprio.
+    """
     if "google_cloud" not in st.secrets:
         return None, "Secrets 'google_cloud' non trovati in .streamlit/secrets.toml"
 
@@ -254,127 +279,1174 @@ def get_google_service():
         return None, f"Errore credenziali Google: {e}"
 
 
-@st.cache_data(ttl=300)
-def get_drive_files_list():
-    """Lista file Drive — ritorna solo dati serializzabili (no service object)."""
-    try:
-        service, svc_error = get_google_service()
-        if service is None:
-            return None, svc_error or "Service non disponibile"
+_DRIVE_FILES_QUERY = (
+    "'{folder}' in parents and "
+    "(mimeType contains 'spreadsheet' or mimeType contains 'csv' "
+    "or name contains '.xlsx') and trashed = false"
+)
+_DRIVE_FILE_KEYS   = ("id", "name", "modifiedTime", "size", "mimeType", "md5Checksum")
+_DRIVE_FILE_FIELDS = ", ".join(_DRIVE_FILE_KEYS)
+_DRIVE_PAGE_SIZE   = 1000   # massimo consentito da files.list
 
-        folder_id = st.secrets.get("folder_id", "")
-        if not folder_id:
-            return None, "Secret 'folder_id' mancante in secrets.toml"
 
-        query = (
-            f"'{folder_id}' in parents and "
-            "(mimeType contains 'spreadsheet' or mimeType contains 'csv' "
-            "or name contains '.xlsx') and trashed = false"
-        )
+def _list_drive_files(service, folder_id: str) -> list:
+    """
+    Elenco completo dei file dati della cartella (più recenti prima).
+    Paginato: prima una sola pagina da 50 e nextPageToken ignorato → oltre 50 file
+    gli export più vecchi sparivano dai selettori senza avviso.
+    """
+    files, page_token = [], None
+    while True:
         results = service.files().list(
-            q=query,
-            fields="files(id, name, modifiedTime, size)",
+            q=_DRIVE_FILES_QUERY.format(folder=folder_id),
+            fields=f"nextPageToken, files({_DRIVE_FILE_FIELDS})",
             orderBy="modifiedTime desc",
-            pageSize=50
+            pageSize=_DRIVE_PAGE_SIZE,
+            pageToken=page_token,
         ).execute()
-        return results.get("files", []), None
+        files.extend(results.get("files", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return files
 
-    except Exception as e:
-        return None, str(e)
 
+def get_drive_files_list():
+    """
+    Lista file Drive — ritorna solo dati serializzabili (no service object).
+    Servita dal watcher della cartella (_drive_watcher): nessun round-trip Drive nel
+    render, file nuovi/aggiornati visibili entro _DRIVE_POLL_S secondi.
+    La lista è un _DriveIndex: by_name / default_file / default_pos in O(1).
+    """
+    folder_id = st.secrets.get("folder_id", "")
+    if not folder_id:
+        return None, "Secret 'folder_id' mancante in secrets.toml"
+    return _drive_watcher(folder_id).files_list()
+
+
+# ── INGEST IN STREAMING ─────────────────────────────────────────────────
+# Il download non passa più da un io.BytesIO completo: i chunk (grandi, configurabili)
+# arrivano a una pipe letta dal parser mentre il download è ancora in corso.
+#   • CSV  → pd.read_csv a blocchi di righe, parsing sovrapposto al download
+#   • xlsx → spool su file temporaneo e pd.read_excel da disco (non da RAM),
+#            in un processo worker (vedi _INGEST_PROCS)
+# Picco di memoria ≈ pochi chunk invece di 2× la dimensione del file.
+_DRIVE_CHUNK_SIZE = int(os.environ.get("EITA_DRIVE_CHUNK_MB", "32")) * 1024 * 1024
+_CSV_CHUNK_ROWS   = 100_000
+_PIPE_MAX_CHUNKS  = 4      # backpressure: il download attende se il parser è indietro
+# Parsing xlsx in processi separati (ingest_worker): openpyxl è CPU-bound e col GIL
+# tre file caricati in parallelo (warm-up) restavano su un core. Il DataFrame torna
+# come stream Arrow IPC. EITA_INGEST_PROCS=0/1 → parsing nel processo Streamlit.
+_INGEST_PROCS = int(os.environ.get(
+    "EITA_INGEST_PROCS",
+    str(min(4, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)),
+))
+# Scadenza (secondi) di un parsing nel worker: oltre, il worker viene terminato e il
+# file si rilegge nel processo Streamlit (stesso ripiego di un worker perso).
+_INGEST_TIMEOUT_S = int(os.environ.get("EITA_INGEST_TIMEOUT_S", "300"))
+
+
+class _DownloadPipe(io.RawIOBase):
+    """Pipe byte thread-safe: MediaIoBaseDownload scrive, il parser legge in streaming."""
+
+    def __init__(self):
+        super().__init__()
+        self._q        = queue.Queue(maxsize=_PIPE_MAX_CHUNKS)
+        self._buf      = b""
+        self._eof      = False
+        self._error    = None
+        self._aborted  = threading.Event()
+        self.bytes_in  = 0
+        self.t_done    = None
+
+    # --- lato download ---
+    def write(self, b) -> int:
+        data = bytes(b)
+        while not self._aborted.is_set():
+            try:
+                self._q.put(data, timeout=0.5)
+                self.bytes_in += len(data)
+                return len(data)
+            except queue.Full:
+                continue
+        raise IOError("Lettura interrotta dal parser")
 
-@st.cache_data(show_spinner=False)
-def load_dataset(file_id, modified_time):
-    """Download + parse del file Drive. Cache basata su (id, modifiedTime)."""
+    def finish(self, error: Exception = None) -> None:
+        self._error = error
+        self.t_done = time.time()
+        while not self._aborted.is_set():
+            try:
+                self._q.put(None, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def abort(self) -> None:
+        self._aborted.set()
+
+    # --- lato parser ---
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buf and not self._eof:
+            chunk = self._q.get()
+            if chunk is None:
+                self._eof = True
+                if self._error is not None:
+                    raise IOError(f"Download interrotto: {self._error}")
+            else:
+                self._buf = chunk
+        if not self._buf:
+            return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+def _pump_download(downloader, pipe: _DownloadPipe) -> None:
+    """Thread di download: next_chunk() fino a done, poi EOF (o errore) sulla pipe."""
     try:
-        service, _ = get_google_service()   # FIX: unpack tupla (service, error)
-        if service is None:
-            return None
-        request = service.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
         done = False
         while not done:
             _, done = downloader.next_chunk()
-        fh.seek(0)
+        pipe.finish()
+    except Exception as e:
+        pipe.finish(e)
+
+
+@st.cache_resource
+def _ingest_stats() -> dict:
+    """Registro process-wide delle statistiche di caricamento per file_id."""
+    return {}
+
+
+def _record_ingest(file_id: str, mode: str, rows: int, seconds: float,
+                   n_bytes: int = 0, download_s: float = None,
+                   engine: str = None, parse_s: float = None) -> None:
+    """
+    Registra throughput di ingest (byte/s e righe/s) per il pannello diagnostica.
+    Motore e tempo di parsing restano quelli dell'ultima lettura vera del file
+    (una lettura da snapshot non li sovrascrive).
+    """
+    seconds = max(seconds, 1e-6)
+    prev    = _ingest_stats().get(file_id, {})
+    _ingest_stats()[file_id] = {
+        "engine":   engine or prev.get("engine"),
+        "parse_s":  parse_s if engine else prev.get("parse_s"),
+        "mode":     mode,
+        "rows":     int(rows),
+        "bytes":    int(n_bytes),
+        "seconds":  seconds,
+        "mb_s":     (n_bytes / 1e6) / max(download_s or seconds, 1e-6) if n_bytes else None,
+        "rows_s":   rows / seconds,
+        "ts":       time.time(),
+    }
+
+
+def _render_data_diagnostics(files_list=None) -> None:
+    """Expander sidebar con le statistiche di ingest dei file caricati (processo corrente)."""
+    stats   = _ingest_stats()
+    watcher = _DriveWatcher._current
+    if watcher is not None:
+        done, total = watcher.warmup_progress()
+        if done < total:
+            st.sidebar.caption(f"⏳ Pre-caricamento pagine: {done}/{total} pronte")
+    if not stats and watcher is None:
+        return
+    names = {fid: f["name"] for fid, f in getattr(files_list, "by_id", {}).items()}
+    with st.sidebar.expander("📥 Diagnostica caricamento dati", expanded=False):
+        if watcher is not None:
+            ago = f"{time.time() - watcher.last_poll:.0f}s fa" if watcher.last_poll else "—"
+            st.caption(
+                f"👀 Cartella Drive: {watcher.mode} · controllo ogni {_DRIVE_POLL_S}s "
+                f"(ultimo {ago}) · {watcher.changes} modifiche · {watcher.prefetched} pre-caricati"
+                + (f" · ⚠️ {watcher.error}" if watcher.error else "")
+            )
+            for pt, w in watcher.warmup.items():
+                secs = f" in {w['seconds']:.1f}s" if w["seconds"] is not None else ""
+                st.caption(f"🔥 Warm-up {pt}: **{w['file']}** — {w['state']}{secs}")
+        for fid, r in sorted(stats.items(), key=lambda kv: -kv[1]["ts"]):
+            mb_txt  = f" · {r['mb_s']:.1f} MB/s" if r["mb_s"] else ""
+            eng_txt = ""
+            if r.get("engine"):
+                eng_txt = f"<br>lettore: {r['engine']}" + (
+                    f" · parsing {r['parse_s']:.2f}s" if r.get("parse_s") is not None else "")
+            st.caption(
+                f"**{names.get(fid, fid)}** — {r['mode']}<br>"
+                f"{r['rows']:,} righe in {r['seconds']:.2f}s · "
+                f"{r['rows_s']:,.0f} righe/s{mb_txt}{eng_txt}",
+                unsafe_allow_html=True,
+            )
+        n_shared, shared_b = _shared_memory_bytes()
+        st.caption(
+            f"🧠 Memoria sessione: {_session_memory_bytes() / 1e6:,.2f} MB · "
+            f"dataset condivisi: {n_shared} ({shared_b / 1e6:,.1f} MB, una copia per processo)"
+        )
+
+@st.cache_resource(show_spinner=False)
+def _ingest_pool():
+    """Pool unico per processo Streamlit (worker avviati subito), None se disattivato."""
+    if _INGEST_PROCS < 2:
+        return None
+    return ingest_worker.IngestPool(_INGEST_PROCS, timeout=_INGEST_TIMEOUT_S)
+
+
+def _parse_spreadsheet(path: str, usecols=None, dtype=None):
+    """(DataFrame, modo, motore, secondi parsing) del file su disco: nel pool se disponibile."""
+    pool = _ingest_pool()
+    if pool is not None:
         try:
-            return pd.read_excel(fh)
-        except Exception:
-            fh.seek(0)
-            return pd.read_csv(fh)
+            fmt, df, engine, parse_s = pool.parse(path, usecols, dtype)
+            return df, f"xlsx (spool su disco, processo worker, {fmt})", engine, parse_s
+        except (OSError, EOFError, ValueError):
+            pass   # worker perso (es. OOM) o scaduto: già rimpiazzato, questo file si legge qui
+    df, engine, parse_s = ingest_worker.read_spreadsheet(path, usecols, dtype)
+    return df, "xlsx (spool su disco)", engine, parse_s
+
+
+def _download_and_parse(file_id, usecols=None, dtype=None):
+    """
+    Scarica il file da Drive in streaming e lo converte in DataFrame (xlsx, fallback csv).
+    usecols/dtype (opzionali) passano al lettore: solo le colonne richieste, tipi dichiarati.
+    """
+    pipe = None
+    try:
+        # Nel thread watcher (prefetch) si usa il suo service: httplib2 non è thread-safe
+        service = getattr(_DRIVE_THREAD, "service", None)
+        if service is None:
+            service, _ = get_google_service()   # FIX: unpack tupla (service, error)
+        if service is None:
+            return None
+        t0 = time.time()
+        request    = service.files().get_media(fileId=file_id)
+        pipe       = _DownloadPipe()
+        downloader = MediaIoBaseDownload(pipe, request, chunksize=_DRIVE_CHUNK_SIZE)
+        threading.Thread(target=_pump_download, args=(downloader, pipe), daemon=True).start()
+
+        stream = io.BufferedReader(pipe, buffer_size=1024 * 1024)
+        head   = stream.peek(8)[:8]
+        # Firma ZIP (xlsx) o OLE2 (xls) → spool su disco; altrimenti CSV in streaming
+        if head.startswith(b"PK\x03\x04") or head.startswith(b"\xd0\xcf\x11\xe0"):
+            with tempfile.NamedTemporaryFile(suffix=".xlsx") as tmp:
+                shutil.copyfileobj(stream, tmp, _DRIVE_CHUNK_SIZE)
+                tmp.flush()
+                df, mode, engine, parse_s = _parse_spreadsheet(tmp.name, usecols, dtype)
+        else:
+            parts = list(pd.read_csv(stream, chunksize=_CSV_CHUNK_ROWS, usecols=usecols, dtype=dtype))
+            df    = (pd.concat(parts, ignore_index=True) if len(parts) > 1
+                     else parts[0] if parts else pd.DataFrame())
+            mode, engine, parse_s = "csv (streaming)", "csv", None   # parsing = download
+        elapsed = time.time() - t0
+        _record_ingest(file_id, mode, len(df), elapsed, pipe.bytes_in,
+                       download_s=(pipe.t_done or time.time()) - t0,
+                       engine=engine, parse_s=parse_s)
+        return df
     except Exception:
         return None
+    finally:
+        if pipe is not None:
+            pipe.abort()
+
+
+# ── SNAPSHOT COLONNARI SU DISCO ─────────────────────────────────────────
+# Il download + pd.read_excel del file vendite costa decine di secondi a freddo
+# (riavvio processo, st.cache_data.clear(), seconda replica). Lo snapshot Parquet
+# del DataFrame (grezzo e già tipizzato) viene servito in < 1 s e invalidato
+# solo quando Drive riporta un modifiedTime diverso (fa parte del nome file).
+_SNAPSHOT_DIR     = os.environ.get("EITA_SNAPSHOT_DIR",
+                                   os.path.join(tempfile.gettempdir(), "eita_snapshots"))
+_SNAPSHOT_VERSION = 4   # incrementare quando cambia smart_analyze_and_clean → invalida i "clean"
+
+
+def _snapshot_path(file_id: str, modified_time: str, stage: str, ext: str = "parquet") -> str:
+    """Percorso snapshot per (file_id, modifiedTime, stadio)."""
+    mt = re.sub(r"[^0-9A-Za-z]", "", str(modified_time))
+    return os.path.join(_SNAPSHOT_DIR, f"{file_id}__{mt}__{stage}.{ext}")
+
+
+def _snapshot_read(file_id: str, modified_time: str, stage: str):
+    """Legge lo snapshot se esiste (Parquet, altrimenti pickle). None se assente/illeggibile."""
+    for ext, reader in (("parquet", pd.read_parquet), ("pkl", pd.read_pickle)):
+        path = _snapshot_path(file_id, modified_time, stage, ext)
+        if os.path.exists(path):
+            try:
+                return reader(path)
+            except Exception:
+                continue
+    return None
+
+
+def _snapshot_write(df: pd.DataFrame, file_id: str, modified_time: str, stage: str) -> None:
+    """
+    Salva lo snapshot in modo atomico (tmp + os.replace) e rimuove le versioni
+    precedenti dello stesso file/stadio. Best-effort: un errore non blocca mai il caricamento.
+    Parquet non accetta colonne object miste (es. numeri + testo nella stessa colonna):
+    in quel caso si ripiega su pickle, che preserva i tipi esatti.
+    """
+    try:
+        os.makedirs(_SNAPSHOT_DIR, exist_ok=True)
+    except OSError:
+        return
+    for ext in ("parquet", "pkl"):
+        path = _snapshot_path(file_id, modified_time, stage, ext)
+        tmp  = f"{path}.{os.getpid()}.tmp"
+        try:
+            if ext == "parquet":
+                df.to_parquet(tmp, index=False)
+            else:
+                df.to_pickle(tmp)
+            os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            continue
+        for old in glob.glob(os.path.join(_SNAPSHOT_DIR, f"{file_id}__*__{stage}.*")):
+            if old != path and not old.endswith(".tmp"):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        return
+
+
+def _snapshot_purge(file_id: str = None, modified_time: str = None) -> None:
+    """
+    Elimina gli snapshot di un file (o tutti) — usato dai pulsanti di ricarica forzata.
+    Con modified_time solo quelli di quella versione (watcher: versione superata).
+    """
+    pattern = f"{file_id}__*" if file_id else "*"
+    if file_id and modified_time:
+        mt = re.sub(r"[^0-9A-Za-z]", "", str(modified_time))
+        pattern = f"{file_id}__{mt}__*"
+    for path in glob.glob(os.path.join(_SNAPSHOT_DIR, pattern)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ── FINGERPRINT DEI DATASET ─────────────────────────────────────────────
+# Le funzioni @st.cache_data che ricevono un DataFrame costringono Streamlit a
+# hashare l'intero frame a ogni rerun. Ogni frame caricato/filtrato porta invece
+# un fingerprint leggero (file id + modifiedTime + descrizione canonica dei filtri):
+# le funzioni cachate ricevono il frame come "_df" (escluso dall'hash) e usano il
+# fingerprint come chiave. Senza fingerprint si ricade sull'hash del contenuto.
+def _fingerprint(*parts) -> str:
+    """Chiave breve e stabile da parti JSON-serializzabili (date/altro → str)."""
+    raw = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _frame_fingerprint(df) -> str:
+    """Fallback: hash del contenuto (colonne, dtype, valori) quando manca una descrizione."""
+    if df is None:
+        return "none"
+    h = hashlib.sha1()
+    h.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode())
+    try:
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    except TypeError:   # celle non hashabili (liste, dict)
+        h.update(df.to_json(date_format="iso", default_handler=str).encode())
+    return h.hexdigest()[:16]
+
+
+def _view_fingerprint(src: tuple, df: pd.DataFrame, *parts) -> str:
+    """
+    Fingerprint economico di un frame ricavato dal dataset condiviso `src` (immutabile
+    per id + modifiedTime): posizioni di riga (etichette, vedi load_clean_dataset) +
+    colonne + parametri che ne determinano il contenuto. Un hash di un array int64
+    invece di hash_pandas_object su tutte le celle a ogni rerun.
+    """
+    rows = hashlib.sha1(df.index.to_numpy(dtype=np.int64).tobytes()).hexdigest()[:16]
+    return _fingerprint(src, rows, list(map(str, df.columns)), *parts)
+
+
+def load_dataset(file_id, modified_time, usecols=None, dtype=None):
+    """Download + parse del file Drive. Cache: snapshot "raw" su disco per (id, modifiedTime).
+
+    Nessuna copia in RAM: il grezzo serve solo a costruire il dataset pulito condiviso.
+    usecols (lista nomi) / dtype ({colonna: tipo}) restringono la lettura: lo snapshot
+    ha allora uno stadio proprio, per non servire un grezzo ridotto a chi vuole tutto.
+    """
+    stage = "raw" if usecols is None and dtype is None else f"raw-{_fingerprint(usecols, dtype)}"
+    t0 = time.time()
+    df = _snapshot_read(file_id, modified_time, stage)
+    if df is not None:
+        _record_ingest(file_id, "snapshot grezzo", len(df), time.time() - t0)
+        return df
+    df = _download_and_parse(file_id, usecols, dtype)
+    if df is not None:
+        _snapshot_write(df, file_id, modified_time, stage)
+    return df
+
+
+# ── DATASET CONDIVISI (process-wide, sola lettura) ─────────────────────────
+# load_clean_dataset è @st.cache_resource: TUTTE le sessioni ricevono lo stesso
+# oggetto, senza copie per utente. Regole:
+#   • il frame condiviso non si modifica MAI in place (niente df[col] = ...);
+#     le colonne derivate si calcolano qui, una volta, in _derive_columns
+#   • le pagine lavorano su filtri/viste transitorie (Copy-on-Write)
+#   • in session_state si salvano solo indici di riga (vedi _view_spec)
+@st.cache_resource
+def _dataset_registry() -> "weakref.WeakValueDictionary":
+    """Registro dei dataset condivisi vivi → metrica memoria in diagnostica."""
+    return weakref.WeakValueDictionary()
+
+
+def _derive_columns(df: pd.DataFrame, page_type: str) -> pd.DataFrame:
+    """Colonne calcolate una volta al caricamento (prima erano scritte dalle pagine)."""
+    if page_type == "Purchase":
+        # LEGENDA: "Kg acquistati = costo della linea / prezzo €/kg"
+        # = Line amount / Purchase price
+        # FIX: SEMPRE ricalcola — la colonna esiste già nel file
+        # Excel ma può avere valori zero o sbagliati.
+        # Non usare il guard "if not in columns".
+        if all(c in df.columns for c in ['Line amount', 'Purchase price']):
+            df['Kg acquistati'] = np.where(
+                df['Purchase price'] > 0, df['Line amount'] / df['Purchase price'], 0
+            )
+        elif all(c in df.columns for c in ['Row amount', 'Purchase price']):
+            df['Kg acquistati'] = np.where(
+                df['Purchase price'] > 0, df['Row amount'] / df['Purchase price'], 0
+            )
+        else:
+            df['Kg acquistati'] = 0
+    return df
+
+
+@st.cache_resource(show_spinner=False, max_entries=6)
+def load_clean_dataset(file_id, modified_time, page_type: str = "Sales"):
+    """
+    Dataset già pulito/tipizzato da smart_analyze_and_clean, condiviso tra le sessioni.
+    Ordine: snapshot "clean" su disco → load_dataset (snapshot "raw" o Drive) + pulizia.
+    """
+    stage = f"clean-{page_type}-v{_SNAPSHOT_VERSION}"
+    t0 = time.time()
+    df = _snapshot_read(file_id, modified_time, stage)
+    if df is not None:
+        _record_ingest(file_id, "snapshot pulito", len(df), time.time() - t0)
+    else:
+        df_raw = load_dataset(file_id, modified_time)
+        if df_raw is None:
+            return None
+        df = _derive_columns(smart_analyze_and_clean(df_raw, page_type), page_type)
+        del df_raw
+        _snapshot_write(df, file_id, modified_time, stage)
+    # Etichette = posizioni: le viste in session_state sono array di posizioni
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+        df = df.reset_index(drop=True)
+    _dataset_registry()[(file_id, modified_time, page_type)] = df
+    return df
+
+
+# ── WATCHER CARTELLA DRIVE (changes feed) ───────────────────────────────
+# Prima get_drive_files_list era cache_data(ttl=300): un export nuovo compariva
+# fino a 5 minuti dopo e ogni scadenza costava un round-trip Drive nel render di
+# qualcuno. Ora un thread di processo segue changes.list dal page token (una
+# chiamata leggera ogni _DRIVE_POLL_S s, vuota se non cambia nulla) e tiene
+# l'elenco in memoria:
+#   • modifiedTime cambiato → si eliminano solo le voci di load_clean_dataset e gli
+#     snapshot della versione superata (le chiavi includono modifiedTime)
+#   • file nuovo/aggiornato → scaricato e pulito in background (snapshot + cache
+#     condivisa) prima che qualcuno apra la pagina
+# Se il changes feed non è disponibile si rilegge la cartella, sempre in background.
+_DRIVE_POLL_S       = int(os.environ.get("EITA_DRIVE_POLL_S", "30"))
+_DRIVE_PREFETCH     = os.environ.get("EITA_DRIVE_PREFETCH", "1") != "0"
+_DRIVE_FIRST_LIST_S = 20    # attesa massima del primo elenco durante il render
+# File predefinito di ogni pagina (sottostringa del nome) → pulizia da pre-caricare
+_PAGE_FILE_MARKERS  = {"Sales": "from_order_to_invoice", "Promo": "customer_promo",
+                       "Purchase": "purchase_orders_history"}
+_DRIVE_CHANGE_FIELDS = ("nextPageToken, newStartPageToken, changes(fileId, removed, "
+                        f"file({_DRIVE_FILE_FIELDS}, parents, trashed))")
+# Indice metadati persistito (elenco + page token): al riavvio l'elenco è subito
+# disponibile e si riparte dal token con changes.list, senza rileggere la cartella.
+_DRIVE_INDEX_PATH    = os.environ.get("EITA_DRIVE_INDEX",
+                                      os.path.join(tempfile.gettempdir(), "eita_drive_index.json"))
+
+
+class _DriveIndex(list):
+    """
+    Elenco file (più recenti prima) + indici costruiti una volta per modifica.
+    Resta una list → i chiamanti di get_drive_files_list non cambiano; le pagine
+    usano by_name / default_pos invece di scansioni lineari a ogni render.
+    Immutabile per convenzione: il watcher ne pubblica uno nuovo a ogni modifica.
+    """
+
+    def __init__(self, files=()):
+        super().__init__(sorted(files, key=lambda f: f.get("modifiedTime", ""), reverse=True))
+        self.by_id   = {f["id"]: f for f in self}
+        self.by_name = {}
+        for f in self:   # a parità di nome vince il più recente
+            self.by_name.setdefault(f.get("name", ""), f)
+        self.names = list(self.by_name)
+        self._pos  = {n: i for i, n in enumerate(self.names)}
+        self._defaults = {
+            pt: next((f for f in self if marker in f.get("name", "").lower()), None)
+            for pt, marker in _PAGE_FILE_MARKERS.items()
+        }
+
+    def default_file(self, page_type: str):
+        """File predefinito della pagina (il più recente col marker nel nome) o None."""
+        return self._defaults.get(page_type)
+
+    def default_pos(self, page_type: str) -> int:
+        """Indice del file predefinito in names (per selectbox), 0 se assente."""
+        f = self._defaults.get(page_type)
+        return self._pos.get(f["name"], 0) if f else 0
+
+
+def _load_drive_index(folder_id: str):
+    """(indice, page token) salvati per questa cartella, o (None, None)."""
+    try:
+        with open(_DRIVE_INDEX_PATH, encoding="utf-8") as fh:
+            saved = json.load(fh)
+    except (OSError, ValueError):
+        return None, None
+    if not isinstance(saved, dict) or saved.get("folder") != folder_id:
+        return None, None
+    return _DriveIndex(saved.get("files") or []), saved.get("token")
+
+
+def _save_drive_index(folder_id: str, index: list, token) -> None:
+    """Scrittura atomica (tmp + os.replace), best-effort come la cache risposte AI."""
+    tmp = f"{_DRIVE_INDEX_PATH}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(_DRIVE_INDEX_PATH) or ".", exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"folder": folder_id, "token": token, "files": list(index)}, fh)
+        os.replace(tmp, _DRIVE_INDEX_PATH)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+_DRIVE_THREAD = threading.local()   # service Drive proprio dei thread watcher/warm-up (download)
+# Warm-up all'avvio: i file predefiniti delle tre pagine scaricati e puliti in
+# parallelo appena c'è il primo elenco → il primo cambio pagina trova la cache
+# calda invece di load_dataset + smart_analyze_and_clean dietro uno spinner.
+# Una pagina aperta mentre il suo file è in warm-up attende lo stesso calcolo
+# (lock per chiave di st.cache_resource su load_clean_dataset), non ne parte un secondo.
+_DRIVE_WARMUP_WORKERS = 3
+
+
+def _thread_drive_service():
+    """Service Drive del thread corrente (creato al primo uso): httplib2 non è thread-safe."""
+    service = getattr(_DRIVE_THREAD, "service", None)
+    if service is None:
+        service, err = _build_drive_service()
+        if service is None:
+            raise RuntimeError(err or "Service non disponibile")
+        _DRIVE_THREAD.service = service
+    return service
+
+
+def _is_data_file(f: dict) -> bool:
+    """Stesso filtro di _DRIVE_FILES_QUERY, su un file restituito da changes.list."""
+    mime = f.get("mimeType", "")
+    return "spreadsheet" in mime or "csv" in mime or ".xlsx" in f.get("name", "")
+
+
+def _forget_dataset_version(file_id: str, modified_time: str) -> None:
+    """Versione superata di un file: via le voci di cache condivisa e gli snapshot su disco."""
+    for page_type in _PAGE_FILE_MARKERS:
+        load_clean_dataset.clear(file_id, modified_time, page_type)
+    _snapshot_purge(file_id, modified_time)
+
+
+class _DriveWatcher:
+    """Thread daemon che tiene aggiornato l'elenco dei file della cartella (changes.list)."""
+
+    _current = None   # watcher attivo: uno nuovo (cache_resource svuotata) ferma il precedente
+
+    def __init__(self, folder_id: str):
+        self.folder_id  = folder_id
+        self.error      = None
+        self.mode       = "avvio"
+        self.polls      = 0
+        self.changes    = 0
+        self.prefetched = 0
+        self.last_poll  = None
+        self.warmup     = {}   # page_type → {"file", "state", "seconds"} del warm-up iniziale
+        self._files, self._token = _load_drive_index(folder_id)
+        self._full      = False
+        self._lock      = threading.Lock()
+        self._stop      = threading.Event()
+        self._wake      = threading.Event()
+        self._ready     = threading.Event()
+        self._polled    = threading.Condition()   # notificata da _run a fine di ogni poll
+        if self._files is not None:   # indice su disco: servito subito, poi solo delta
+            self.mode = "changes feed (ripreso)" if self._token else self.mode
+            self._ready.set()
+        if _DriveWatcher._current is not None:
+            _DriveWatcher._current.stop()
+        _DriveWatcher._current = self
+        threading.Thread(target=self._run, name="drive-watcher", daemon=True).start()
+
+    # --- lato render ---
+    def files_list(self):
+        """(files, errore) come get_drive_files_list; si attende solo il primo elenco."""
+        self._ready.wait(_DRIVE_FIRST_LIST_S)
+        with self._lock:
+            if self._files is None:
+                return None, self.error or "Elenco file Drive non ancora disponibile"
+            return self._files, None
+
+    def live_index(self):
+        """Ultimo _DriveIndex pubblicato (None prima del primo elenco), senza attese."""
+        return self._files
+
+    def refresh(self, timeout: float = 15) -> None:
+        """Rilettura completa subito (pulsante "Forza Aggiornamento"), attende l'esito."""
+        with self._polled:
+            polls = self.polls
+        self._full = True
+        self._wake.set()
+        with self._polled:
+            self._polled.wait_for(lambda: self.polls != polls, timeout)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def warmup_progress(self):
+        """(pronti, totale) del warm-up iniziale; pronti include gli errori (conclusi)."""
+        warm = list(self.warmup.values())
+        return sum(w["state"] not in ("in coda", "in corso") for w in warm), len(warm)
+
+    # --- thread ---
+    def _run(self) -> None:
+        warm_started = False
+        while not self._stop.is_set():
+            try:
+                self._poll(_thread_drive_service())
+                self.error = None
+                if not warm_started and _DRIVE_PREFETCH:
+                    warm_started = True
+                    self._start_warmup()
+            except Exception as e:
+                self.error = str(e)
+            finally:
+                with self._polled:
+                    self.polls    += 1
+                    self.last_poll = time.time()
+                    self._polled.notify_all()
+                self._ready.set()
+            self._wake.wait(_DRIVE_POLL_S)
+            self._wake.clear()
+
+    def _poll(self, service) -> None:
+        if self._files is None or self._full or self._token is None:
+            # Avvio, pulsante o changes feed non disponibile → elenco completo.
+            # Il token si prende PRIMA dell'elenco: nessuna modifica persa nel mezzo.
+            if self._token is None and self.mode != "rilettura cartella":
+                try:
+                    self._token = service.changes().getStartPageToken().execute()["startPageToken"]
+                    self.mode = "changes feed"
+                except Exception:
+                    self.mode = "rilettura cartella"
+            self._full = False
+            self._apply(_list_drive_files(service, self.folder_id))
+            return
+        changed, token, start_token = {}, self._token, self._token
+        try:
+            while token:
+                resp = service.changes().list(pageToken=token, spaces="drive", pageSize=100,
+                                              fields=_DRIVE_CHANGE_FIELDS).execute()
+                for ch in resp.get("changes", []):
+                    changed[ch["fileId"]] = ch
+                token = resp.get("nextPageToken")
+                self._token = resp.get("newStartPageToken") or self._token
+        except Exception:
+            self._token = None   # token scaduto/non valido (es. indice vecchio) → rilettura
+            raise
+        if not changed:
+            if self._token != start_token:
+                _save_drive_index(self.folder_id, self._files, self._token)
+            return
+        files = dict(self._files.by_id)
+        for fid, ch in changed.items():
+            f = ch.get("file") or {}
+            if (not ch.get("removed") and not f.get("trashed") and _is_data_file(f)
+                    and self.folder_id in (f.get("parents") or [])):
+                files[fid] = {k: f[k] for k in _DRIVE_FILE_KEYS if k in f}
+            else:
+                files.pop(fid, None)
+        self._apply(list(files.values()))
+
+    def _apply(self, new_files: list) -> None:
+        """Pubblica il nuovo elenco; versioni superate → cache/snapshot via, nuove → prefetch."""
+        new_files = _DriveIndex(new_files)
+        with self._lock:
+            first, old = self._files is None, dict(self._files.by_id) if self._files else {}
+            self._files = new_files
+        _save_drive_index(self.folder_id, new_files, self._token)
+        if first:
+            return
+        fresh = []
+        for f in new_files:
+            prev = old.pop(f["id"], None)
+            if prev is not None and prev.get("modifiedTime") == f.get("modifiedTime"):
+                continue
+            if prev is not None:
+                _forget_dataset_version(prev["id"], prev["modifiedTime"])
+            fresh.append(f)
+        for prev in old.values():   # file rimossi dalla cartella
+            _forget_dataset_version(prev["id"], prev["modifiedTime"])
+        self.changes += len(fresh) + len(old)
+        if _DRIVE_PREFETCH:
+            for f in fresh:
+                self._prefetch(f)
+
+    def _start_warmup(self) -> None:
+        """File predefiniti delle pagine → pool dedicato (i thread finiscono col lavoro)."""
+        with self._lock:
+            index = self._files
+        todo = {pt: index.default_file(pt) for pt in _PAGE_FILE_MARKERS}
+        todo = {pt: f for pt, f in todo.items() if f is not None}
+        if not todo:
+            return
+        _ingest_pool()   # worker di parsing avviati mentre parte il download
+        for pt, f in todo.items():
+            self.warmup[pt] = {"file": f["name"], "state": "in coda", "seconds": None}
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(_DRIVE_WARMUP_WORKERS, len(todo)), thread_name_prefix="drive-warmup")
+        for pt, f in todo.items():
+            pool.submit(self._warm, pt, f)
+        pool.shutdown(wait=False)
+
+    def _warm(self, page_type: str, f: dict) -> None:
+        entry = self.warmup[page_type]
+        entry["state"] = "in corso"
+        t0 = time.perf_counter()
+        try:
+            _thread_drive_service()
+            load_clean_dataset(f["id"], f["modifiedTime"], page_type)
+            entry["state"] = "pronto"
+        except Exception as e:
+            entry["state"] = f"errore: {e}"
+        entry["seconds"] = time.perf_counter() - t0
+
+    def _prefetch(self, f: dict) -> None:
+        """Download + pulizia in background: chi apre la pagina trova snapshot e cache pronti."""
+        name = f.get("name", "").lower()
+        page_type = next((pt for pt, marker in _PAGE_FILE_MARKERS.items() if marker in name), None)
+        try:
+            if page_type:
+                load_clean_dataset(f["id"], f["modifiedTime"], page_type)
+            else:
+                load_dataset(f["id"], f["modifiedTime"])   # solo snapshot grezzo su disco
+            self.prefetched += 1
+        except Exception:
+            pass
+
+
+@st.cache_resource(show_spinner=False)
+def _drive_watcher(folder_id: str) -> _DriveWatcher:
+    """Un watcher per processo (e cartella)."""
+    return _DriveWatcher(folder_id)
+
+
+def _coerce_dates(df: pd.DataFrame, cols) -> pd.DataFrame:
+    """Colonne testo → datetime (format 'mixed', giorno prima), senza toccare il frame condiviso."""
+    conv = {c: pd.to_datetime(df[c], format='mixed', dayfirst=True, errors='coerce')
+            for c in cols if c in df.columns and not pd.api.types.is_datetime64_any_dtype(df[c])}
+    return df.assign(**conv) if conv else df
+
+
+def _view_spec(src: tuple, df: pd.DataFrame, dates=()) -> dict:
+    """
+    Vista da salvare in session_state: sorgente + posizioni di riga (niente copie).
+    dates: colonne convertite a datetime dalla pagina (scelte dall'utente, quindi non
+    in _derive_columns) → riconvertite da _resolve_view come "tipo".
+    """
+    return {"src": tuple(src), "rows": df.index.to_numpy(dtype=np.int64),
+            "tipo": "__tipo__" in df.columns, "dates": list(dates)}
+
+
+def _is_live_version(file_id: str, modified_time: str) -> bool:
+    """
+    False se il watcher Drive riporta per il file un altro modifiedTime (o il file non
+    c'è più): quella versione è stata superata e le sue cache/snapshot eliminate da
+    _forget_dataset_version. Senza watcher (nessun elenco noto) → True.
+    """
+    watcher = _DriveWatcher._current
+    index   = watcher.live_index() if watcher is not None else None
+    if index is None:
+        return True
+    f = index.by_id.get(file_id)
+    return f is not None and f.get("modifiedTime") == modified_time
+
+
+def _resolve_view(spec):
+    """Ricostruisce (transitoriamente) il frame di una vista salvata con _view_spec."""
+    if not spec:
+        return None
+    # Versione superata: load_clean_dataset(id, vecchio modifiedTime) riscaricherebbe il
+    # contenuto ATTUALE di Drive sotto la chiave vecchia, e le posizioni salvate
+    # indicizzerebbero dati diversi → vista non più valida.
+    if not _is_live_version(*spec["src"][:2]):
+        return None
+    try:
+        base = load_clean_dataset(*spec["src"])
+        if base is None:
+            return None
+        view = base.iloc[spec["rows"]]
+    except (IndexError, KeyError, TypeError):
+        return None   # file aggiornato su Drive nel frattempo: vista non più valida
+    if spec.get("tipo"):
+        view = view.assign(__tipo__=_classifica_vendita(view))
+    if spec.get("dates"):
+        view = _coerce_dates(view, spec["dates"])
+    return view
+
+
+# ── INDICE DATE (filtri periodo in O(log n)) ───────────────────────────────
+# Per ogni (dataset condiviso, colonna data): posizioni di riga ordinate per giorno
+# + giorni ordinati (datetime64[D], NaT in coda). Un range [start, end] diventa due
+# searchsorted → fetta contigua di posizioni, senza creare un date() per riga.
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _date_index(src: tuple, col: str, _base: pd.DataFrame) -> tuple:
+    """(posizioni ordinate, giorni ordinati) della colonna datetime `col` del dataset `src`."""
+    s = _base[col]
+    if getattr(s.dt, "tz", None) is not None:
+        s = s.dt.tz_localize(None)     # giorno "locale", come .dt.date
+    days  = s.to_numpy().astype("datetime64[D]")
+    order = np.argsort(days, kind="stable")
+    return order, days[order]
+
+
+def _filter_period(df: pd.DataFrame, col: str, start, end,
+                   base: pd.DataFrame = None, src: tuple = None) -> pd.DataFrame:
+    """
+    Righe di df con col.date in [start, end] (estremi inclusi).
+    df deve essere base o un suo filtro (etichette = posizioni in base, vedi
+    load_clean_dataset); senza base/src o con colonna non datetime nel dataset
+    condiviso → confronto classico per riga.
+    """
+    if (base is None or src is None or col not in base.columns
+            or not pd.api.types.is_datetime64_any_dtype(base[col])):
+        return df[(df[col].dt.date >= start) & (df[col].dt.date <= end)]
+    order, days = _date_index(tuple(src), col, base)
+    lo = np.searchsorted(days, np.datetime64(start, "D"), side="left")
+    hi = np.searchsorted(days, np.datetime64(end, "D"), side="right")
+    rows = order[lo:hi]
+    if df is base:
+        return base.iloc[np.sort(rows)]
+    keep = np.zeros(len(base), dtype=bool)
+    keep[rows] = True
+    return df[keep[df.index.to_numpy()]]
+
+
+def _session_memory_bytes() -> int:
+    """Byte trattenuti da session_state (frame materializzati, array, resto)."""
+    total = 0
+    for v in list(st.session_state.to_dict().values()):
+        if isinstance(v, (pd.DataFrame, pd.Series)):
+            total += int(v.memory_usage(deep=True).sum()) if isinstance(v, pd.DataFrame) \
+                     else int(v.memory_usage(deep=True))
+        elif isinstance(v, dict) and isinstance(v.get("rows"), np.ndarray):
+            total += v["rows"].nbytes
+        elif isinstance(v, np.ndarray):
+            total += v.nbytes
+        else:
+            total += sys.getsizeof(v)
+    return total
+
+
+def _shared_memory_bytes() -> tuple:
+    """(numero, byte) dei dataset condivisi attualmente in memoria."""
+    frames = list(_dataset_registry().values())
+    return len(frames), sum(int(f.memory_usage(deep=True).sum()) for f in frames)
 
 
 # ==========================================================================
 # 3. UTILITY FUNCTIONS
 # ==========================================================================
 
+_XLSX_MIME            = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+_XLSX_CHUNK_ROWS      = 50_000    # righe scritte per blocco (→ avanzamento progress bar)
+_EXPORT_PREPARE_ROWS  = 100_000   # sopra questa soglia: pulsante "Prepara" con progress
+
+
+def convert_df_to_excel(df: pd.DataFrame, fingerprint: str = None, progress=None) -> bytes:
+    """Esporta un DataFrame in formato .xlsx con formattazione base (cache per fingerprint).
+
+    progress: callable opzionale (frazione 0..1) chiamato dopo ogni blocco di righe.
+    """
+    return _excel_cached(fingerprint or _frame_fingerprint(df), df, progress)
+
+
+_XLSX_WIDTH_SAMPLE = 2_000   # righe campionate (uniformi) per stimare la larghezza colonne
+
+
+def _xlsx_column_values(col: pd.Series) -> list:
+    """Valori di un blocco colonna pronti per write_row (NaN/NaT → None = cella vuota)."""
+    if pd.api.types.is_bool_dtype(col):
+        return col.astype(object).where(col.notna(), None).tolist()
+    if pd.api.types.is_numeric_dtype(col):
+        arr = col.to_numpy(dtype=float, na_value=np.nan)
+        return np.where(np.isnan(arr), None, arr).tolist()
+    if pd.api.types.is_datetime64_any_dtype(col):
+        if getattr(col.dt, "tz", None) is not None:
+            col = col.dt.tz_localize(None)
+        return np.where(col.isna(), None, col.dt.to_pydatetime()).tolist()
+    if pd.api.types.infer_dtype(col, skipna=True) in ("date", "datetime"):
+        return col.astype(object).where(col.notna(), None).tolist()
+    return np.where(col.isna(), None, col.astype(str).to_numpy(dtype=object)).tolist()
+
+
+def _xlsx_width(col: pd.Series, header) -> int:
+    """Larghezza colonna da campione uniforme + header (min 10+5, max 60)."""
+    sample = col.dropna()
+    if len(sample) > _XLSX_WIDTH_SAMPLE:
+        sample = sample.iloc[:: len(sample) // _XLSX_WIDTH_SAMPLE]
+    longest = int(sample.astype(str).str.len().max()) if not sample.empty else 0
+    return min(max(longest, len(str(header))) + 5, 60)
+
+
 @st.cache_data(show_spinner=False, max_entries=10)
-def convert_df_to_excel(df: pd.DataFrame) -> bytes:
-    """Esporta un DataFrame in formato .xlsx con formattazione base."""
+def _excel_cached(fingerprint: str, _df: pd.DataFrame, _progress=None) -> bytes:
     output = io.BytesIO()
-    df_export = df.reset_index() if isinstance(df.index, pd.MultiIndex) else df.copy()
+    # Nessuna copia difensiva: il frame è solo letto
+    df_export = _df.reset_index() if isinstance(_df.index, pd.MultiIndex) else _df
+    n_rows    = len(df_export)
 
     try:
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df_export.to_excel(writer, index=False, sheet_name='Dati')
-            wb  = writer.book
-            ws  = writer.sheets['Dati']
-            hdr = wb.add_format({'bold': True, 'bg_color': '#f0f0f0',
-                                 'border': 1, 'text_wrap': True, 'valign': 'vcenter'})
-            num = wb.add_format({'num_format': '#,##0.0000'})
-            for c_num, val in enumerate(df_export.columns.values):
-                ws.write(0, c_num, val, hdr)
-            for i, col in enumerate(df_export.columns):
-                # FIX: .max() su serie vuota o tutto-NaN restituisce NaN → TypeError
-                # Soluzione: usare pd.Series.max() con default 0 via fillna
-                series_len = df_export[col].astype(str).map(len)
-                col_max    = int(series_len.max()) if not series_len.empty else 0
-                final_len  = min(max(col_max, len(str(col))) + 5, 60)
-                if pd.api.types.is_numeric_dtype(df_export[col]):
-                    ws.set_column(i, i, final_len, num)
-                else:
-                    ws.set_column(i, i, final_len)
+        import xlsxwriter
     except ModuleNotFoundError:
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
             df_export.to_excel(writer, index=False, sheet_name='Dati')
+        return output.getvalue()
+
+    # constant_memory: le righe vengono scritte su file temporaneo man mano (RAM costante);
+    # impone scrittura per righe crescenti → formati colonna e header PRIMA dei dati.
+    wb = xlsxwriter.Workbook(output, {
+        'constant_memory':     True,
+        'strings_to_formulas': False,
+        'strings_to_urls':     False,
+        'strings_to_numbers':  False,
+        'remove_timezone':     True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',   # come pandas.to_excel
+    })
+    ws  = wb.add_worksheet('Dati')
+    hdr = wb.add_format({'bold': True, 'bg_color': '#f0f0f0',
+                         'border': 1, 'text_wrap': True, 'valign': 'vcenter'})
+    num = wb.add_format({'num_format': '#,##0.0000'})
+    columns = list(df_export.columns)
+    for i, col in enumerate(columns):
+        s = df_export.iloc[:, i]
+        is_num = pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s)
+        ws.set_column(i, i, _xlsx_width(s, col), num if is_num else None)
+    ws.write_row(0, 0, [str(c) for c in columns], hdr)
+
+    # Righe a blocchi: conversione vettoriale per colonna, poi write_row per riga
+    for start in range(0, n_rows, _XLSX_CHUNK_ROWS):
+        block = df_export.iloc[start:start + _XLSX_CHUNK_ROWS]
+        cols  = [_xlsx_column_values(block.iloc[:, i]) for i in range(len(columns))]
+        for r, values in enumerate(zip(*cols), start=start + 1):
+            ws.write_row(r, 0, values)
+        if _progress is not None:
+            _progress(min((start + _XLSX_CHUNK_ROWS) / n_rows, 1.0) * 0.95)
+    wb.close()
+    if _progress is not None:
+        _progress(1.0)
     return output.getvalue()
 
 
-# OTTIMIZZAZIONE: smart_analyze_and_clean cachata → non rielaborata se
-# lo stesso DataFrame grezzo viene richiesto due volte (es. Sales in Promo page).
-@st.cache_data(show_spinner=False)
+def convert_df_to_csv(df: pd.DataFrame) -> bytes:
+    """Export CSV (UTF-8 con BOM → Excel lo apre con gli accenti corretti; sep ';' e decimali ',')."""
+    df = df.reset_index() if isinstance(df.index, pd.MultiIndex) else df
+    return df.to_csv(index=False, sep=';', decimal=',').encode('utf-8-sig')
+
+
+def convert_df_to_parquet(df: pd.DataFrame) -> bytes:
+    """Export Parquet (tipi preservati, il più compatto/veloce per analisi successive)."""
+    df  = df.reset_index() if isinstance(df.index, pd.MultiIndex) else df
+    buf = io.BytesIO()
+    try:
+        df.to_parquet(buf, index=False)
+    except Exception:
+        # colonne object miste (numeri + testo): come testo, il resto invariato
+        mixed = {c: str for c in df.columns if df[c].dtype == object}
+        buf   = io.BytesIO()
+        df.astype(mixed).to_parquet(buf, index=False)
+    return buf.getvalue()
+
+
+def _excel_download_button(label: str, df: pd.DataFrame, file_name: str,
+                           key: str = None, fingerprint: str = None) -> None:
+    """
+    download_button con payload .xlsx generato SOLO quando serve.
+    - fino a _EXPORT_PREPARE_ROWS righe: data=callable → Streamlit esegue l'export
+      al click (thread separato), nessun costo sui rerun
+    - oltre: pulsante "Prepara" con progress bar; a file pronto (cache per
+      fingerprint) compare il download vero e proprio. Accanto, CSV e Parquet
+      (molto più rapidi di .xlsx su questi volumi), anch'essi generati al click
+    """
+    if len(df) <= _EXPORT_PREPARE_ROWS:
+        st.download_button(label, data=lambda: convert_df_to_excel(df, fingerprint),
+                           file_name=file_name, mime=_XLSX_MIME, key=key)
+        return
+    base_name = file_name.rsplit(".", 1)[0]
+    wkey      = key or file_name
+    c_xlsx, c_csv, c_pq = st.columns([2, 1, 1])
+    with c_csv:
+        st.download_button("CSV", data=lambda: convert_df_to_csv(df),
+                           file_name=f"{base_name}.csv", mime="text/csv",
+                           key=f"csv_{wkey}", width='stretch')
+    with c_pq:
+        st.download_button("Parquet", data=lambda: convert_df_to_parquet(df),
+                           file_name=f"{base_name}.parquet",
+                           mime="application/vnd.apache.parquet",
+                           key=f"parquet_{wkey}", width='stretch')
+    with c_xlsx:
+        fp        = fingerprint or _frame_fingerprint(df)
+        ready_key = f"xlsx_ready_{wkey}"
+        if st.session_state.get(ready_key) != fp:
+            if not st.button(f"⚙️ Prepara Excel ({len(df):,} righe)",
+                             key=f"xlsx_prepare_{wkey}"):
+                return
+            bar = st.progress(0.0, text="Generazione file Excel...")
+            convert_df_to_excel(df, fp,
+                                progress=lambda f: bar.progress(f, text="Generazione file Excel..."))
+            bar.empty()
+            st.session_state[ready_key] = fp
+        st.download_button(label, data=lambda: convert_df_to_excel(df, fp),
+                           file_name=file_name, mime=_XLSX_MIME, key=key)
+
+
+# ── SCHEMA DI PULIZIA ────────────────────────────────────────────────────
+# Tipi espliciti per le colonne note di ogni pagina. 'numeric' e 'text' si applicano
+# per sottostringa del nome colonna (come le golden rules originali); 'dates' indica
+# il formato atteso. Le colonne dello schema ricevono il tipo direttamente; le
+# euristiche sul campione di 100 valori girano solo sulle colonne fuori schema.
+_CLEAN_SCHEMAS = {
+    "Sales": {
+        "numeric": {'Importo_Netto_TotRiga', 'Peso_Netto_TotRiga',
+                    'Qta_Cartoni_Ordinato', 'Qta_Cartoni_Consegnato',
+                    'Prezzo_Netto', 'Sconto7_Promozionali', 'Sconto4_Free'},
+        "text":    {'Descr_Cliente_Fat', 'Descr_Cliente_Dest', 'Descr_Articolo',
+                    'Entity', 'Ragione Sociale', 'Decr_Cliente_Fat'},
+        "dates":   {'Data_Fattura': '%d/%m/%Y', 'Data_Ordine': '%d/%m/%Y',
+                    'Data_Consegna': '%d/%m/%Y', 'Data_DDT': '%d/%m/%Y',
+                    'Data_Partenza': '%d/%m/%Y'},
+    },
+    "Promo": {
+        "numeric": {'Quantità prevista', 'Quantità ordinata',
+                    'Importo sconto', 'Sconto promo'},
+        "text":    {'Descrizione Cliente', 'Descrizione Prodotto',
+                    'Descrizione Promozione', 'Riferimento', 'Tipo promo',
+                    'Codice prodotto', 'Key Account', 'Decr_Cliente_Fat', 'Week start'},
+        "dates":   {'Sell in da': '%d/%m/%Y', 'Sell in a': '%d/%m/%Y'},
+    },
+    "Purchase": {
+        "numeric": {'Order quantity', 'Received quantity', 'Invoice quantity',
+                    'Invoice amount', 'Row amount', 'Purchase price',
+                    'Kg acquistati', 'Exchange rate', 'Line amount', 'Part net weight'},
+        "text":    {'Supplier name', 'Part description', 'Part group description',
+                    'Part class description', 'Division', 'Facility', 'Warehouse',
+                    'Supplier number', 'Part number', 'Purchase order'},
+        "dates":   {'Invoice date': '%d/%m/%Y', 'Date of receipt': '%d/%m/%Y',
+                    'Purchase order date': '%d/%m/%Y', 'Delivery date': '%d/%m/%Y'},
+    },
+}
+_CLEAN_SKIP_COLS = {'Numero_Pallet', 'Sovrapponibile', 'COMPANY'}
+# Formati provati (dopo quello dello schema) prima di ricadere su format='mixed'.
+# Solo formati giorno-prima: con dayfirst=True il parser 'mixed' inverte giorno/mese
+# anche sulle stringhe ISO (2025-03-05 → 3 maggio), quindi le ISO restano al parser
+# originale per non cambiare il risultato.
+_DATE_FORMATS = ('%d/%m/%Y', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M',
+                 '%d-%m-%Y', '%d/%m/%y')
+
+
+def _sniff_date_format(sample: list, hint: str = None):
+    """Primo formato che interpreta TUTTO il campione, oppure None."""
+    for fmt in ((hint,) if hint else ()) + _DATE_FORMATS:
+        try:
+            for v in sample:
+                datetime.datetime.strptime(v, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_dates(col: pd.Series, fmt: str = None) -> pd.Series:
+    """to_datetime con formato esplicito; i soli valori che non lo rispettano
+    passano dal parser 'mixed' (dayfirst), quindi il risultato non cambia."""
+    if fmt is None:
+        return pd.to_datetime(col, format='mixed', dayfirst=True, errors='coerce')
+    out  = pd.to_datetime(col, format=fmt, errors='coerce')
+    miss = out.isna() & col.notna()
+    if miss.any():
+        out = out.mask(miss, pd.to_datetime(col[miss], format='mixed',
+                                            dayfirst=True, errors='coerce'))
+    return out
+
+
+def _parse_it_numbers(col: pd.Series) -> pd.Series:
+    """Numeri in formato italiano ("1.234,56 €", "12%") → numerici, vettoriale.
+
+    Le colonne già numeriche passano senza round-trip via stringa; per le altre
+    pulizia e to_numeric girano una sola volta sui valori distinti.
+    """
+    if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_bool_dtype(col):
+        return col
+    codes, uniq = pd.factorize(col.astype(str), use_na_sentinel=False)
+    txt = (pd.Series(uniq)
+             .str.replace('€', '', regex=False)
+             .str.replace('%', '', regex=False)
+             .str.replace(' ', '', regex=False))
+    if txt.str.contains(',', regex=False).any():
+        txt = (txt.str.replace('.', '', regex=False)
+                  .str.replace(',', '.', regex=False))
+    vals = pd.to_numeric(txt, errors='coerce').to_numpy()
+    return pd.Series(vals[codes], index=col.index, name=col.name)
+
+
+# ── ENCODING CATEGORICO ─────────────────────────────────────────────────
+# Clienti, articoli, entità, fornitori, stati... si ripetono migliaia di volte:
+# come 'category' occupano un codice intero per riga + un dizionario, e groupby /
+# filtri lavorano sui codici invece di rihashare le stringhe.
+_CAT_MAX_RATIO  = 0.5      # distinti / righe oltre cui il testo resta testo
+_CAT_MAX_UNIQUE = 50_000
+
+
+def _encode_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """Colonne di sole stringhe a bassa cardinalità → dtype category (in place)."""
+    n = len(df)
+    if n == 0:
+        return df
+    for col in df.columns:
+        s = df[col]
+        if not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+            continue
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        n_unique = s.nunique(dropna=True)
+        if n_unique > min(_CAT_MAX_UNIQUE, n * _CAT_MAX_RATIO):
+            continue
+        if pd.api.types.infer_dtype(s, skipna=True) != "string":
+            continue   # colonne miste (numeri + testo): restano object
+        df[col] = s.astype("category")
+    return df
+
+
+# Nessuna cache propria: l'unico chiamante (load_clean_dataset) è già condiviso a
+# livello di processo + snapshot su disco; una cache_data qui terrebbe una seconda
+# copia serializzata di ogni dataset.
 def smart_analyze_and_clean(df_in: pd.DataFrame, page_type: str = "Sales") -> pd.DataFrame:
-    """Pulisce e tipizza automaticamente le colonne del DataFrame."""
+    """Pulisce e tipizza le colonne del DataFrame secondo _CLEAN_SCHEMAS[page_type]."""
     df = df_in.copy()
 
-    if page_type == "Sales":
-        target_numeric  = {'Importo_Netto_TotRiga', 'Peso_Netto_TotRiga',
-                           'Qta_Cartoni_Ordinato', 'Qta_Cartoni_Consegnato',
-                           'Prezzo_Netto', 'Sconto7_Promozionali', 'Sconto4_Free'}
-        protected_text  = {'Descr_Cliente_Fat', 'Descr_Cliente_Dest', 'Descr_Articolo',
-                           'Entity', 'Ragione Sociale', 'Decr_Cliente_Fat'}
-    elif page_type == "Promo":
-        target_numeric  = {'Quantità prevista', 'Quantità ordinata',
-                           'Importo sconto', 'Sconto promo'}
-        protected_text  = {'Descrizione Cliente', 'Descrizione Prodotto',
-                           'Descrizione Promozione', 'Riferimento', 'Tipo promo',
-                           'Codice prodotto', 'Key Account', 'Decr_Cliente_Fat', 'Week start'}
-    elif page_type == "Purchase":
-        target_numeric  = {'Order quantity', 'Received quantity', 'Invoice quantity',
-                           'Invoice amount', 'Row amount', 'Purchase price',
-                           'Kg acquistati', 'Exchange rate', 'Line amount', 'Part net weight'}
-        protected_text  = {'Supplier name', 'Part description', 'Part group description',
-                           'Part class description', 'Division', 'Facility', 'Warehouse',
-                           'Supplier number', 'Part number', 'Purchase order'}
-    else:
-        target_numeric = protected_text = set()
-
-    SKIP_COLS = {'Numero_Pallet', 'Sovrapponibile', 'COMPANY'}
+    schema         = _CLEAN_SCHEMAS.get(page_type, {})
+    target_numeric = schema.get("numeric", set())
+    protected_text = schema.get("text", set())
+    date_hints     = schema.get("dates", {})
 
     for col in df.columns:
-        if col in SKIP_COLS:
+        if col in _CLEAN_SKIP_COLS:
             continue
 
         if any(t in col for t in protected_text):
@@ -388,46 +1460,51 @@ def smart_analyze_and_clean(df_in: pd.DataFrame, page_type: str = "Sales") -> pd
                 df[col] = df[col].astype(str).replace(['nan', 'NaN', 'None'], '-')
             continue
 
-        sample = df[col].dropna().astype(str).head(100).tolist()
-        if not sample:
+        # Colonna già datetime (es. da read_excel) o vuota: nulla da convertire
+        if pd.api.types.is_datetime64_any_dtype(df[col]) or not df[col].notna().any():
             continue
 
+        # Colonne dello schema: tipo dichiarato applicato direttamente, nessun campione.
+        # Date con formato atteso (le celle che non lo rispettano → parser 'mixed');
+        # una colonna data già numerica (seriali Excel) resta all'inferenza sotto.
+        if col in date_hints and not pd.api.types.is_numeric_dtype(df[col]):
+            try:
+                df[col] = _parse_dates(df[col], date_hints[col])
+                continue
+            except Exception:
+                pass
+        if any(t in col for t in target_numeric):
+            try:
+                df[col] = _parse_it_numbers(df[col]).fillna(0)
+            except Exception:
+                pass
+            continue
+
+        # Colonne fuori schema: tipo dedotto dal campione (astype(str) su 100 valori)
+        sample = df[col].dropna().head(100).astype(str).tolist()
+
         # Rilevamento date
         if any(('/' in s or '-' in s) and len(s) >= 8 and s[0].isdigit() for s in sample):
             try:
-                df[col] = pd.to_datetime(df[col], format='mixed', dayfirst=True, errors='coerce')
+                df[col] = _parse_dates(df[col], _sniff_date_format(sample))
                 continue
             except Exception:
                 pass
 
-        is_target = any(t in col for t in target_numeric)
-
         # FIX: euristica numerica conservativa + guard per Purchase
-        if not is_target:
-            numeric_like = sum(
-                1 for s in sample
-                if len(s) > 0 and sum(c.isdigit() for c in s) / len(s) >= 0.5
-            )
-            # guard page_type != "Purchase": evita conversione numerica su codici fornitore/part number
-            looks_numeric = (numeric_like / len(sample) >= 0.6) and (page_type != "Purchase")
-        else:
-            looks_numeric = True
-
-        if is_target or looks_numeric:
+        numeric_like = sum(
+            1 for s in sample
+            if len(s) > 0 and sum(c.isdigit() for c in s) / len(s) >= 0.5
+        )
+        # guard page_type != "Purchase": evita conversione numerica su codici fornitore/part number
+        if (numeric_like / len(sample) >= 0.6) and (page_type != "Purchase"):
             try:
-                clean = (df[col].astype(str)
-                                .str.replace('€', '', regex=False)
-                                .str.replace('%', '', regex=False)
-                                .str.replace(' ', '', regex=False))
-                if clean.str.contains(',', regex=False).any():
-                    clean = (clean.str.replace('.', '', regex=False)
-                                  .str.replace(',', '.', regex=False))
-                converted = pd.to_numeric(clean, errors='coerce')
-                if is_target or converted.notna().sum() / len(converted) > 0.7:
+                converted = _parse_it_numbers(df[col])
+                if converted.notna().sum() / len(converted) > 0.7:
                     df[col] = converted.fillna(0)
             except Exception:
                 pass
-    return df
+    return _encode_categories(df)
 
 
 def guess_column_role(df: pd.DataFrame, page_type: str = "Sales") -> dict:
@@ -499,6 +1576,28 @@ def set_idx(guess, options: list) -> int:
     return options.index(guess) if guess in options else 0
 
 
+def _str_isin(s: pd.Series, values) -> pd.Series:
+    """Maschera s.astype(str).isin(values); sulle category confronta solo i codici."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        hit = np.flatnonzero(s.cat.categories.astype(str).isin(list(values)))
+        return pd.Series(np.isin(s.cat.codes.to_numpy(), hit), index=s.index)
+    return s.astype(str).isin(values)
+
+
+def _str_eq(s: pd.Series, value) -> pd.Series:
+    """Maschera s.astype(str) == value (vedi _str_isin)."""
+    return _str_isin(s, [value])
+
+
+def _str_unique(s: pd.Series) -> list:
+    """sorted(s.dropna().astype(str).unique()) senza convertire ogni riga se category."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        codes = s.cat.codes.to_numpy()
+        used  = np.unique(codes[codes >= 0])
+        return sorted(s.cat.categories[used].astype(str))
+    return sorted(s.dropna().astype(str).unique())
+
+
 def safe_date_input(label: str, default_start, default_end, key: str = None):
     """
     Wrapper date_input robusto: gestisce selezione di un solo giorno
@@ -516,7 +1615,7 @@ def safe_date_input(label: str, default_start, default_end, key: str = None):
 def build_agg_with_ratios(df: pd.DataFrame, group_col: str,
                           col_ct: str, col_kg: str, col_eur: str) -> pd.DataFrame:
     """Raggruppa, aggrega e calcola i ratio €/Kg e €/CT."""
-    agg = (df.groupby(group_col)
+    agg = (df.groupby(group_col, observed=True)
              .agg({col_ct: 'sum', col_kg: 'sum', col_eur: 'sum'})
              .reset_index()
              .sort_values(col_eur, ascending=False))
@@ -531,7 +1630,7 @@ def _add_service_level(agg: pd.DataFrame, df_src: pd.DataFrame,
        Restituisce il df invariato se le colonne non esistono."""
     if col_del is None or col_del not in df_src.columns or col_ord not in df_src.columns:
         return agg
-    svc = (df_src.groupby(group_col)[[col_ord, col_del]]
+    svc = (df_src.groupby(group_col, observed=True)[[col_ord, col_del]]
                  .sum(numeric_only=True)
                  .reset_index())
     svc['% Livello Servizio'] = np.where(
@@ -732,6 +1831,9 @@ Il contesto viene aggiornato ad ogni render e contiene sezioni pre-calcolate:
   TREND MENSILE: aggregazione mensile per Peso_Netto_TotRiga e Importo_Netto_TotRiga
   ANALISI PROMO vs NORMALE: tabelle per cliente e prodotto con Kg promo/normale/omaggio e %
   CROSS PROMO per PRODOTTO×CLIENTE: % promo su Kg per ogni combinazione prodotto-cliente
+  CONTESTO MIRATO (se la domanda cita clienti/prodotti/fornitori per nome): al posto delle
+    tabelle sopra, FOCUS per ogni entità citata (totali, top/bottom, trend, % promo) e
+    INCROCIO CLIENTE × PRODOTTO — valori esatti calcolati solo sulle sue righe
 
 ════════════════════════════════════════════════════════════
 REGOLE DI RISPOSTA — OBBLIGATORIE
@@ -790,6 +1892,184 @@ _GROQ_MODELS   = [
 ]
 
 
+# ── SCHEDULER RICHIESTE AI (rate limit lato client) ─────────────────────
+# La quota Groq/Gemini è del PROCESSO (una API key per tutte le sessioni), non
+# della singola sessione. Prima si scopriva il limite solo con un 429 e si
+# dormiva fino a 20 s. Ora ogni (provider, modello) ha token bucket RPM/RPD/
+# TPM/TPD condivisi: prima di inviare si prenota richiesta + token stimati sul
+# primo modello con margine (routing 70B → 8B) o si attende in coda FIFO quello
+# che si libera prima. A risposta arrivata la prenotazione è corretta con
+# l'usage reale; un 429 residuo blocca il modello per il retry indicato.
+# Limiti per modello (free tier); le chiavi mancanti ricadono su _RATE_DEFAULTS.
+_RATE_LIMITS = {
+    ("groq", "llama-3.3-70b-versatile"): {"rpm": 30, "rpd": 1_000,  "tpm": 12_000, "tpd": 100_000},
+    ("groq", "llama-3.1-8b-instant"):    {"rpm": 30, "rpd": 14_400, "tpm": 6_000,  "tpd": 500_000},
+}
+_RATE_DEFAULTS = {
+    "groq":   {"rpm": _GROQ_FREE_RPM, "rpd": 1_000, "tpm": 6_000,   "tpd": _GROQ_FREE_TPD},
+    "gemini": {"rpm": 15,             "rpd": 1_000, "tpm": 250_000, "tpd": 1_000_000},
+}
+_RATE_MAX_WAIT    = 30      # s massimi in coda: oltre si risponde "quota" senza inviare
+_RATE_OUT_RESERVE = 1_000   # token di output prenotati finché l'usage reale non è noto
+
+
+class _TokenBucket:
+    """Secchio di capacità `capacity` che si riempie in `period` secondi."""
+
+    __slots__ = ("capacity", "rate", "level", "ts")
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = float(capacity)
+        self.rate     = capacity / period
+        self.level    = float(capacity)
+        self.ts       = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.ts) * self.rate)
+        self.ts    = now
+
+    def wait(self, amount: float, now: float) -> float:
+        """Secondi prima che `amount` (al più la capacità) sia disponibile."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float, now: float) -> None:
+        """Preleva (può andare sotto zero: un usage reale oltre la stima è un debito)."""
+        self._refill(now)
+        self.level -= amount
+
+    def used(self, now: float) -> float:
+        self._refill(now)
+        return max(0.0, self.capacity - self.level)
+
+
+class _RateScheduler:
+    """Token bucket per (provider, modello) + coda FIFO per provider, thread-safe."""
+
+    def __init__(self):
+        self._cond    = threading.Condition()
+        self._models  = {}   # (provider, modello) → {"rpm", "rpd", "tpm", "tpd": _TokenBucket, "blocked": ts}
+        self._queues  = {}   # provider → ticket in attesa (il primo è il prossimo servito)
+
+    @staticmethod
+    def _new_state(provider: str, model: str) -> dict:
+        lim = {**_RATE_DEFAULTS.get(provider, _RATE_DEFAULTS["groq"]),
+               **_RATE_LIMITS.get((provider, model), {})}
+        return {"rpm": _TokenBucket(lim["rpm"], 60), "rpd": _TokenBucket(lim["rpd"], 86400),
+                "tpm": _TokenBucket(lim["tpm"], 60), "tpd": _TokenBucket(lim["tpd"], 86400),
+                "blocked": 0.0}
+
+    def _state(self, provider: str, model: str) -> dict:
+        key = (provider, model)
+        if key not in self._models:
+            self._models[key] = self._new_state(provider, model)
+        return self._models[key]
+
+    def _wait_s(self, provider: str, model: str, tokens: int, now: float) -> float:
+        b = self._state(provider, model)
+        return max(b["blocked"] - now,
+                   b["rpm"].wait(1, now), b["rpd"].wait(1, now),
+                   b["tpm"].wait(tokens, now), b["tpd"].wait(tokens, now))
+
+    def acquire(self, provider: str, models: list, tokens: int,
+                max_wait: float = _RATE_MAX_WAIT, on_wait=None):
+        """
+        Prenota 1 richiesta + `tokens` sul primo modello di `models` con margine,
+        altrimenti attende (in ordine di arrivo) quello che si libera prima.
+        Restituisce (modello, secondi_attesi); modello None se l'attesa stimata
+        supera max_wait (niente prenotazione).
+        """
+        start  = time.monotonic()
+        ticket = object()
+        with self._cond:
+            queue = self._queues.setdefault(provider, [])
+            queue.append(ticket)
+            try:
+                shown = None
+                while True:
+                    now = time.monotonic()
+                    wait, _, model = min((self._wait_s(provider, m, tokens, now), i, m)
+                                         for i, m in enumerate(models))
+                    if wait <= 0 and queue[0] is ticket:
+                        b = self._state(provider, model)
+                        b["rpm"].take(1, now)
+                        b["rpd"].take(1, now)
+                        b["tpm"].take(tokens, now)
+                        b["tpd"].take(tokens, now)
+                        return model, now - start
+                    ahead = queue.index(ticket)
+                    if now - start + wait > max_wait:
+                        return None, now - start
+                    if on_wait is not None and (round(wait), ahead) != shown:
+                        shown = (round(wait), ahead)
+                        on_wait(wait, ahead)
+                    self._cond.wait(timeout=min(max(wait, 0.05), 1.0))
+            finally:
+                queue.remove(ticket)
+                self._cond.notify_all()
+
+    def settle(self, provider: str, model: str, reserved: int, actual: int) -> None:
+        """Corregge la prenotazione con i token realmente consumati."""
+        with self._cond:
+            b, now = self._state(provider, model), time.monotonic()
+            b["tpm"].take(actual - reserved, now)
+            b["tpd"].take(actual - reserved, now)
+            self._cond.notify_all()
+
+    def penalize(self, provider: str, model: str, seconds: float) -> None:
+        """429 ricevuto comunque (quota usata da altri client): modello fermo per `seconds`."""
+        with self._cond:
+            b = self._state(provider, model)
+            b["blocked"] = max(b["blocked"], time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def usage(self, provider: str, model: str) -> dict:
+        """Consumo corrente del processo per un modello (per contatore e diagnostica)."""
+        with self._cond:
+            now = time.monotonic()
+            b   = self._models.get((provider, model)) or self._new_state(provider, model)
+            wait = max(b["blocked"] - now, b["rpm"].wait(1, now), b["tpm"].wait(1, now))
+            return {"rpm": int(b["rpm"].capacity), "rpm_used": round(b["rpm"].used(now)),
+                    "tpm": int(b["tpm"].capacity), "tpm_used": round(b["tpm"].used(now)),
+                    "tpd": int(b["tpd"].capacity), "tpd_used": round(b["tpd"].used(now)),
+                    "wait_s": wait,
+                    "queued": len(self._queues.get(provider, []))}
+
+    def models(self) -> list:
+        with self._cond:
+            return list(self._models)
+
+
+@st.cache_resource(show_spinner=False)
+def _rate_scheduler() -> _RateScheduler:
+    """Un solo scheduler per processo: la quota è della API key, non della sessione."""
+    return _RateScheduler()
+
+
+def _rate_acquire(provider: str, models: list, tokens: int, stream: "_StreamDedup" = None):
+    """
+    acquire() sullo scheduler condiviso: l'attesa in coda è mostrata nel riquadro
+    di streaming e sommata in "ai_queue_wait" (→ _update_token_stats).
+    """
+    on_wait = None
+    if stream is not None and stream.on_update is not None:
+        on_wait = lambda wait, ahead: stream.on_update(
+            f"⏳ In coda per limite {provider} (~{wait:.0f}s"
+            + (f", {ahead} richieste prima)" if ahead else ")"))
+    model, waited = _rate_scheduler().acquire(provider, models, tokens, on_wait=on_wait)
+    if waited >= 0.05:
+        state = _ai_session()
+        state["ai_queue_wait"] = state.get("ai_queue_wait", 0.0) + waited
+    return model, waited
+
+
+def _retry_after_s(err_str: str, default: float) -> float:
+    """Secondi di attesa suggeriti da un errore 429 ("retry in 12s", "retry_delay { seconds: 12"), max 60."""
+    m = re.search(r"(?:retry in|try again in|seconds:)\s*(\d+(?:\.\d+)?)", err_str, flags=re.I)
+    return min(float(m.group(1)), 60.0) if m else default
+
+
 def _get_ai_client():
     """
     Restituisce (client, provider, model_name, error, diag).
@@ -997,13 +2277,15 @@ def _classifica_vendita(df: "pd.DataFrame") -> "pd.Series":
 
 
 def _filtra_vendite_periodo(df_sales: "pd.DataFrame", g_start, g_end,
-                             entity: str = None) -> "pd.DataFrame":
+                             entity: str = None, src: tuple = None) -> "pd.DataFrame":
     """
     Filtra df_sales per periodo G_START/G_END e opzionalmente per entity.
     Aggiunge colonna '__tipo__' con _classifica_vendita().
     Restituisce il df filtrato pronto per grafico E contesto AI.
+    Nessuna copia: df_sales è il dataset condiviso, i filtri creano nuovi oggetti.
+    Con src (chiave di load_clean_dataset) il periodo usa l'indice date (_filter_period).
     """
-    df = df_sales.copy()
+    df = df_sales
     # Filtro data — usa la lista completa di fallback per trovare la colonna giusta
     col_dt = next((c for c in _COL_DT_FALLBACKS if c in df.columns
                    and pd.api.types.is_datetime64_any_dtype(df[c])), None)
@@ -1012,16 +2294,77 @@ def _filtra_vendite_periodo(df_sales: "pd.DataFrame", g_start, g_end,
         col_dt = next((c for c in df.columns
                        if pd.api.types.is_datetime64_any_dtype(df[c])), None)
     if col_dt:
-        df = df[(df[col_dt].dt.date >= g_start) & (df[col_dt].dt.date <= g_end)]
+        df = _filter_period(df, col_dt, g_start, g_end,
+                            base=df_sales if src else None, src=src)
     # Filtro entity
     if entity:
         ent_col = next((c for c in ['Entity', 'Società', 'Company', 'Division', 'Azienda']
                         if c in df.columns), None)
         if ent_col:
-            df = df[df[ent_col].astype(str) == entity]
+            df = df[_str_eq(df[ent_col], entity)]
     # Classificazione
-    df = df.copy()
-    df['__tipo__'] = _classifica_vendita(df)
+    return df.assign(__tipo__=_classifica_vendita(df))
+
+
+# ── CUBO VENDITE (pre-aggregato per versione dataset) ──────────────────────
+# Somme €/Kg/CT ordinati/CT consegnati + numero righe per
+# (Entity × giorno × cliente × prodotto × tipo vendita), costruito UNA volta per
+# (file, modifiedTime, mappatura colonne). Le colonne hanno gli stessi nomi del
+# dataset grezzo → build_agg_with_ratios/_add_service_level funzionano identici
+# su cubo e righe; le righe grezze servono solo alle viste "Righe sorgente".
+_CUBE_ROWS = "__righe__"
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _sales_cube(src: tuple, dims: tuple, col_date: str, measures: tuple,
+                _base: pd.DataFrame) -> pd.DataFrame:
+    """Cubo ordinato per giorno (colonna col_date normalizzata a mezzanotte)."""
+    keys = {c: _base[c] for c in dims}
+    keys[col_date]   = _base[col_date].dt.normalize()
+    keys["__tipo__"] = _classifica_vendita(_base)
+    flat = pd.DataFrame(keys).assign(**{m: _base[m] for m in measures}, **{_CUBE_ROWS: 1})
+    cube = (flat.groupby(list(keys), observed=True, dropna=False, sort=False)
+                .sum()
+                .reset_index())
+    return cube.sort_values(col_date, kind="stable").reset_index(drop=True)
+
+
+def _sales_cube_view(base: pd.DataFrame, src: tuple, col_entity: str, col_date: str,
+                     col_customer: str, col_prod: str, measures: tuple,
+                     entity, start, end, filters: dict = None):
+    """
+    Cubo filtrato per entity, periodo [start, end] e filtri avanzati.
+    None se la mappatura non è coperta dal cubo (colonne duplicate, misure non
+    numeriche, data non datetime, filtri su colonne fuori dal cubo) → usare le righe.
+    """
+    dims     = tuple(c for c in (col_entity, col_customer, col_prod) if c)
+    measures = tuple(dict.fromkeys(m for m in measures if m))
+    if (len(set(dims)) != len(dims) or set(dims) & set(measures) or col_date in dims + measures
+            or not all(c in base.columns for c in dims + measures + (col_date,))
+            or not pd.api.types.is_datetime64_any_dtype(base[col_date])
+            or getattr(base[col_date].dt, "tz", None) is not None
+            or not all(pd.api.types.is_numeric_dtype(base[m]) for m in measures)
+            or any(c not in dims for c in (filters or {}))):
+        return None
+    cube = _sales_cube(tuple(src), dims, col_date, measures, base)
+    days = cube[col_date].to_numpy().astype("datetime64[D]")
+    lo   = np.searchsorted(days, np.datetime64(start, "D"), side="left")
+    hi   = np.searchsorted(days, np.datetime64(end, "D"), side="right")
+    view = cube.iloc[lo:hi]
+    if col_entity and entity is not None:
+        view = view[_str_eq(view[col_entity], entity)]
+    for f_col, vals in (filters or {}).items():
+        view = view[_str_isin(view[f_col], vals)]
+    return view
+
+
+def _tree_filter(df: pd.DataFrame, col_prod: str, col_customer: str,
+                 sel_p: list, sel_c: list) -> pd.DataFrame:
+    """Filtri del form "Esplosione Prodotto" (stessa logica su cubo e righe)."""
+    if "TUTTI I PRODOTTI" not in sel_p:
+        df = df[df[col_prod].isin(sel_p)]
+    if sel_c:
+        df = df[_str_isin(df[col_customer], sel_c)]
     return df
 
 
@@ -1099,6 +2442,40 @@ def _fmt_num(val) -> str:
         return str(val)
 
 
+def _rows(frame: pd.DataFrame):
+    """
+    Righe come dict colonna → valore, con gli STESSI valori di iterrows()
+    (che legge frame.values: dtype comune a tutte le colonne) ma senza
+    costruire una Series per riga.
+    """
+    cols = list(frame.columns)
+    return (dict(zip(cols, r)) for r in frame.to_numpy())
+
+
+def _desc_order(values: np.ndarray) -> np.ndarray:
+    """
+    Posizioni che ordinano values in modo decrescente, NaN in coda: stesso
+    algoritmo (quicksort sull'array invertito) di sort_values(ascending=False),
+    quindi stesso ordine dei pareggi — il contesto AI resta identico byte per byte.
+    """
+    values = np.asarray(values)
+    mask   = pd.isna(values)
+    idx    = np.arange(len(values))
+    keep   = idx[~mask][::-1]
+    order  = keep[values[~mask][::-1].argsort(kind="quicksort")][::-1]
+    return np.concatenate([order, idx[mask]])
+
+
+def _group_slices(frame: pd.DataFrame, key_col: str) -> dict:
+    """{chiave: (inizio, fine)} dei blocchi contigui di frame (già ordinato per key_col)."""
+    codes, uniques = pd.factorize(frame[key_col])
+    if len(codes) == 0:
+        return {}
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    stops  = np.r_[starts[1:], len(codes)]
+    return {uniques[codes[a]]: (a, b) for a, b in zip(starts, stops)}
+
+
 def _agg_table(df: pd.DataFrame, group_col: str, value_cols: list,
                top_n: int = 15, label: str = "") -> str:
     """
@@ -1122,7 +2499,7 @@ def _agg_table(df: pd.DataFrame, group_col: str, value_cols: list,
         header = f"{'Voce':<35} | " + " | ".join(f"{c:>14}" for c in present)
         lines.append(header)
         lines.append("-" * len(header))
-        for _, row in agg.iterrows():
+        for row in _rows(agg):
             voce = str(row[group_col])[:34]
             vals = " | ".join(f"{_fmt_num(row[c]):>14}" for c in present)
             lines.append(f"{voce:<35} | {vals}")
@@ -1152,7 +2529,7 @@ def _monthly_trend(df: pd.DataFrame, date_col: str, value_cols: list) -> str:
         header = f"{'Mese':<12} | " + " | ".join(f"{c:>14}" for c in present)
         lines.append(header)
         lines.append("-" * len(header))
-        for _, row in agg.iterrows():
+        for row in _rows(agg):
             vals = " | ".join(f"{_fmt_num(row[c]):>14}" for c in present)
             lines.append(f"{str(row['__mese__']):<12} | {vals}")
         return "\n".join(lines)
@@ -1160,8 +2537,135 @@ def _monthly_trend(df: pd.DataFrame, date_col: str, value_cols: list) -> str:
         return f"[Errore trend: {e}]"
 
 
+# ---------------------------------------------------------------------------
+# Budget del contesto AI in TOKEN per modello (non in caratteri).
+# Il system prompt (~8.300 char ≈ 2.500 token) viaggia a ogni chiamata:
+# sul 70B (6.000 TPM) il contesto deve restare sotto ~2.800 token.
+# ---------------------------------------------------------------------------
+_CTX_TOKEN_BUDGET = {
+    "llama-3.3-70b-versatile": 2_800,
+    "llama-3.1-8b-instant":    6_000,   # 20.000 TPM
+    "gemini-2.0-flash-lite":   6_000,
+    "gemini-2.5-flash":        6_000,
+}
+_CTX_TOKEN_BUDGET_DEFAULT = 2_800
+# Caratteri per token di partenza per famiglia di tokenizer (testo italiano +
+# tabelle numeriche); sostituiti dal rapporto misurato sulle risposte reali
+# (usage.prompt_tokens) appena disponibile — vedi _update_token_stats.
+_CHARS_PER_TOKEN = {"llama": 3.3, "gemini": 3.8}
+_CHARS_PER_TOKEN_DEFAULT = 3.3
+
+
+def _chars_per_token(model_name: str = None) -> float:
+    """Caratteri per token del modello: misurato in sessione se disponibile, altrimenti stima di famiglia."""
+    measured = _ai_session().get("ai_chars_per_token", {}).get(model_name or "")
+    if measured:
+        return measured
+    name = (model_name or "").lower()
+    for family, ratio in _CHARS_PER_TOKEN.items():
+        if family in name:
+            return ratio
+    return _CHARS_PER_TOKEN_DEFAULT
+
+
+def _ctx_tokens(text: str, chars_per_token: float) -> int:
+    """Token stimati di un blocco di contesto (arrotondati per eccesso)."""
+    return int(-(-len(text) // chars_per_token))
+
+
+_CTX_FOOT = "\n" + "="*60 + " FINE CONTESTO =" + "="*44 + "\n"
+_CTX_OMIT = "  [...omesso per limite token — usa filtri per ridurre i dati]"
+
+
+def _ctx_columns(df: pd.DataFrame, context_label: str) -> dict:
+    """Colonne chiave del contesto AI (cliente, prodotto, …) e colonne valore effettive."""
+    dset = _detect_dataset_type(context_label, df.columns.tolist())
+    cmap = _CTX_COL_MAPS.get(dset, {})
+    kc = {k: _first_col(df, cmap.get(k, []))
+          for k in ("cliente", "prodotto", "fornitore", "importo", "kg", "qty", "data")}
+    # Colonne numeriche effettive
+    num_cols = df.select_dtypes(include="number").columns.tolist()
+    val_cols = [c for c in [kc["importo"], kc["kg"], kc["qty"]] if c and c in num_cols]
+    if not val_cols and num_cols:
+        val_cols = num_cols[:3]
+    kc["val_cols"] = val_cols
+    kc["dset"]     = dset
+    return kc
+
+
+def _ctx_head(context_label: str, n: int, dset: str, cols: list) -> list:
+    """Intestazione del contesto AI: dataset, periodo, colonne."""
+    head = []
+    head.append(f"\n\n{'='*60}")
+    head.append(f"DATASET: {context_label} | Righe: {n:,} | Tipo: {dset.upper()}")
+    head.append("⚡ TUTTI I VALORI SONO ESATTI — calcolati dal database, nessuna stima")
+    # Estrai il periodo dal label se presente (formato "Vendite EITA | Periodo: DD/MM/YYYY – DD/MM/YYYY")
+    if "Periodo:" in context_label:
+        head.append(f"📅 {context_label.split('Periodo:')[1].strip()}")
+        head.append("   → I dati sopra si riferiscono SOLO a questo periodo. Rispondi con certezza.")
+    head.append(f"Colonne disponibili: {', '.join(cols)}")
+    head.append("="*60)
+    return head
+
+
+def _assemble_sections(head: list, sections: list,
+                       budget_tokens: int, chars_per_token: float) -> str:
+    """
+    Estrae le sezioni (priorità, char minimi stimati, generatore | None) per
+    priorità finché c'è budget e le riporta nell'ordine della lista.
+    Una sezione il cui primo blocco stimato non entra non viene calcolata; una
+    sezione a blocchi si ferma al primo blocco che non entra (generatore chiuso).
+    """
+    remaining = budget_tokens - _ctx_tokens("\n".join(head) + "\n" + _CTX_FOOT, chars_per_token)
+    omit_cost = _ctx_tokens(_CTX_OMIT, chars_per_token) + 1
+    chosen = {}
+    for pos in sorted(range(len(sections)), key=lambda i: sections[i][0]):
+        _, min_chars, gen = sections[pos]
+        if gen is None:
+            continue
+        if min_chars / chars_per_token + omit_cost > remaining:
+            continue  # non entra: non viene nemmeno calcolata
+        blocks = []
+        for block in gen():
+            if not block:
+                continue
+            cost = _ctx_tokens(block, chars_per_token) + 1   # +1: newline di separazione
+            if cost + omit_cost > remaining:
+                if blocks:
+                    blocks.append(_CTX_OMIT)
+                    remaining -= omit_cost
+                break  # chiude il generatore: il resto della sezione non viene calcolato
+            blocks.append(block)
+            remaining -= cost
+        if blocks:
+            chosen[pos] = "\n".join(blocks)
+    return "\n".join(head + [chosen[i] for i in sorted(chosen)] + [_CTX_FOOT])
+
+
+def _build_compact_context(context_df: pd.DataFrame, context_label: str,
+                           fingerprint: str = None, model_name: str = None,
+                           question: str = None) -> str:
+    """
+    Contesto AI per la domanda: mirato sulle entità citate (_targeted_context_cached)
+    o generale (_compact_context_cached); entrambi cachati per fingerprint del frame.
+    """
+    fingerprint = fingerprint or _frame_fingerprint(context_df)
+    budget = {"budget_tokens":   _CTX_TOKEN_BUDGET.get(model_name, _CTX_TOKEN_BUDGET_DEFAULT),
+              # arrotondato: la cache non si invalida a ogni piccola variazione
+              "chars_per_token": round(_chars_per_token(model_name), 1)}
+    # Domanda che cita clienti/prodotti/fornitori → solo gli aggregati mirati su quelli
+    found = _retrieve_entities(context_df, fingerprint, context_label, question)
+    if found:
+        entities = tuple((role, v) for role, hits in found.items() for v, _ in hits)
+        return _targeted_context_cached(fingerprint, context_label, entities, context_df, **budget)
+    return _compact_context_cached(fingerprint, context_label, context_df, **budget)
+
+
 @st.cache_data(show_spinner=False, ttl=120)
-def _build_compact_context(context_df: pd.DataFrame, context_label: str) -> str:
+def _compact_context_cached(fingerprint: str, context_label: str,
+                            _context_df: pd.DataFrame,
+                            budget_tokens: int = _CTX_TOKEN_BUDGET_DEFAULT,
+                            chars_per_token: float = _CHARS_PER_TOKEN_DEFAULT) -> str:
     """
     Contesto INTELLIGENTE con aggregazioni reali per rispondere a domande come:
     - Top 5 clienti per fatturato → gruppo per cliente, somma importo
@@ -1169,48 +2673,51 @@ def _build_compact_context(context_df: pd.DataFrame, context_label: str) -> str:
     - Trend mensile → raggruppamento per mese
     - Qual è il prodotto più venduto → gruppo per prodotto, somma kg/qty
 
-    Formato testo compatto (~600-1200 token) con tabelle Markdown leggibili dall'AI.
+    Le sezioni sono generatori con priorità e dimensione minima stimata:
+    vengono estratte per priorità finché c'è budget (in token) e riportate
+    nell'ordine del documento. Una sezione che non entra nel budget residuo
+    non viene nemmeno calcolata; una sezione a blocchi si ferma al primo
+    blocco che non entra (il resto non viene calcolato).
     """
-    if context_df is None or context_df.empty:
+    if _context_df is None or _context_df.empty:
         return ""
 
-    df   = context_df
-    n    = len(df)
-    # ── Grok opt: se df grande, campiona per aggregazioni non critiche ──
-    # I totali vengono calcolati prima del campionamento → sempre esatti
-    df_agg = df.sample(min(n, 5000), random_state=42) if n > 50_000 else df
+    df   = _context_df
     cols = df.columns.tolist()
-    dset = _detect_dataset_type(context_label, cols)
-    cmap = _CTX_COL_MAPS.get(dset, {})
-
-    parts = []
-    parts.append(f"\n\n{'='*60}")
-    parts.append(f"DATASET: {context_label} | Righe: {n:,} | Tipo: {dset.upper()}")
-    parts.append("⚡ TUTTI I VALORI SONO ESATTI — calcolati dal database, nessuna stima")
-    # Estrai il periodo dal label se presente (formato "Vendite EITA | Periodo: DD/MM/YYYY – DD/MM/YYYY")
-    if "Periodo:" in context_label:
-        parts.append(f"📅 {context_label.split('Periodo:')[1].strip()}")
-        parts.append("   → I dati sopra si riferiscono SOLO a questo periodo. Rispondi con certezza.")
-    parts.append(f"Colonne disponibili: {', '.join(cols)}")
-    parts.append("="*60)
+    kc   = _ctx_columns(df, context_label)
+    head = _ctx_head(context_label, len(df), kc["dset"], cols)
 
     # --- Colonne chiave ---
-    col_cliente  = _first_col(df, cmap.get("cliente",  []))
-    col_prodotto = _first_col(df, cmap.get("prodotto", []))
-    col_fornitore= _first_col(df, cmap.get("fornitore",[]))
-    col_importo  = _first_col(df, cmap.get("importo",  []))
-    col_kg       = _first_col(df, cmap.get("kg",       []))
-    col_qty      = _first_col(df, cmap.get("qty",      []))
-    col_data     = _first_col(df, cmap.get("data",     []))
-
-    # Colonne numeriche effettive
-    num_cols = df.select_dtypes(include="number").columns.tolist()
-    val_cols = [c for c in [col_importo, col_kg, col_qty] if c and c in num_cols]
-    if not val_cols and num_cols:
-        val_cols = num_cols[:3]
+    col_cliente  = kc["cliente"]
+    col_prodotto = kc["prodotto"]
+    col_fornitore= kc["fornitore"]
+    col_kg       = kc["kg"]
+    col_data     = kc["data"]
+    val_cols     = kc["val_cols"]
+    has_cross = bool(col_cliente and col_prodotto and val_cols)
+
+    def _vals(r) -> str:
+        return " | ".join(f"{_fmt_num(v)}" for v in r[1:])
+
+    # --- Somme PRODOTTO × CLIENTE calcolate UNA volta (alla prima sezione che le usa) ---
+    # Top10 e i due cross leggono blocchi contigui di queste tabelle invece di
+    # rifiltrare df per ogni prodotto/cliente (O(prodotti × righe) → O(righe)).
+    # groupby somma ogni gruppo nell'ordine delle righe → valori identici ai
+    # groupby sui sotto-insiemi; _desc_order riproduce anche l'ordine dei pareggi.
+    _memo = {}
+
+    def _cross_tables():
+        if "pc" not in _memo:
+            pc = (df.groupby([col_prodotto, col_cliente], observed=True)[val_cols]
+                    .sum(numeric_only=True).reset_index())
+            cp = pc.sort_values([col_cliente, col_prodotto], kind="mergesort", ignore_index=True)
+            cli_rank = (df.groupby(col_cliente, observed=True)[val_cols[0]]
+                          .sum().sort_values(ascending=False))
+            _memo["pc"] = (pc, cp, _group_slices(cp, col_cliente), cli_rank)
+        return _memo["pc"]
 
     # --- Riepilogo totali ---
-    if val_cols:
+    def _sec_totali():
         tot_lines = []
         for c in val_cols:
             try:
@@ -1219,169 +2726,150 @@ def _build_compact_context(context_df: pd.DataFrame, context_label: str) -> str:
             except Exception:
                 pass
         if tot_lines:
-            parts.append("\nTOTALI COMPLESSIVI:\n" + "\n".join(tot_lines))
-
-    # --- Aggregazioni per CLIENTE ---
-    if col_cliente:
-        parts.append(_agg_table(df, col_cliente, val_cols, top_n=15, label="CLIENTE"))
-
-    # --- Aggregazioni per PRODOTTO ---
-    if col_prodotto:
-        parts.append(_agg_table(df, col_prodotto, val_cols, top_n=15, label="PRODOTTO"))
-
-    # --- Aggregazioni per FORNITORE (acquisti) ---
-    if col_fornitore:
-        parts.append(_agg_table(df, col_fornitore, val_cols, top_n=15, label="FORNITORE"))
-
-    # --- Altre colonne categoriche chiave ---
-    cat_cols = df.select_dtypes(exclude="number").columns.tolist()
-    done = {col_cliente, col_prodotto, col_fornitore, col_data}
-    for c in cat_cols:
-        if c in done or c is None:
-            continue
-        n_unique = df[c].nunique()
-        # Solo colonne con cardinalità media (5-200 valori unici) → utili per groupby
-        if 2 <= n_unique <= 200 and val_cols:
-            parts.append(_agg_table(df, c, val_cols[:2], top_n=10, label=c))
-        if len("\n".join(parts)) > 2000:
-            break  # limite token (8k char max totale)
+            yield "\nTOTALI COMPLESSIVI:\n" + "\n".join(tot_lines)
+
+    # --- Aggregazioni per CLIENTE / PRODOTTO / FORNITORE (acquisti) ---
+    def _sec_agg(col, label):
+        def _gen():
+            yield _agg_table(df, col, val_cols, top_n=15, label=label)
+        return _gen
+
+    # --- Altre colonne categoriche chiave (max ~2.000 char complessivi) ---
+    def _sec_categoriche():
+        cat_cols = df.select_dtypes(exclude="number").columns.tolist()
+        done = {col_cliente, col_prodotto, col_fornitore, col_data}
+        size = 0
+        for c in cat_cols:
+            if c in done or c is None:
+                continue
+            n_unique = df[c].nunique()
+            # Solo colonne con cardinalità media (5-200 valori unici) → utili per groupby
+            if 2 <= n_unique <= 200:
+                block = _agg_table(df, c, val_cols[:2], top_n=10, label=c)
+                size += len(block)
+                yield block
+            if size > 2000:
+                break
 
     # --- TABELLA PRONTA: Top 5 clienti + prodotto principale + fatturato ---
     # Pre-calcolata per rispondere ESATTAMENTE a "top N clienti con prodotto principale"
-    # POSIZIONE: PRIMA dei CROSS (che sono pesanti) → se il contesto viene troncato
-    # questa tabella è già inclusa (risponde alla domanda più frequente).
-    if col_cliente and col_prodotto and val_cols:
+    def _sec_top10():
         try:
-            cli_tot = (df.groupby(col_cliente, observed=True)[val_cols[0]]
-                        .sum().sort_values(ascending=False).head(5))
+            _, cp, cp_slices, cli_rank = _cross_tables()
+            cp_prod = cp[col_prodotto].to_numpy()
+            cp_val  = cp[val_cols[0]].to_numpy()
             top10_lines = [
                 f"\nTOP 10 CLIENTI PER FATTURATO con PRODOTTO PRINCIPALE:",
                 f"(usa questa tabella per 'top N clienti' — dati PRE-CALCOLATI esatti)",
                 f"{'#':<3} | {'Cliente':<40} | {'Fatturato €':>14} | {'Prodotto Principale':<40} | {'Fat. Prod. Princ. €':>19}",
                 "-" * 130,
             ]
-            for rank, (cli, fat_tot) in enumerate(cli_tot.items(), 1):
-                df_cli = df[df[col_cliente] == cli]
-                prod_agg = (df_cli.groupby(col_prodotto, observed=True)[val_cols[0]]
-                                  .sum().sort_values(ascending=False))
-                if prod_agg.empty:
+            for rank, (cli, fat_tot) in enumerate(cli_rank.head(5).items(), 1):
+                sl = cp_slices.get(cli)
+                if sl is None:
                     top_prod, fat_prod = "-", 0.0
                 else:
-                    top_prod = prod_agg.index[0]
-                    fat_prod = prod_agg.values[0]
+                    first    = sl[0] + _desc_order(cp_val[sl[0]:sl[1]])[0]
+                    top_prod = cp_prod[first]
+                    fat_prod = cp_val[first]
                 cli_str  = str(cli)[:39]
                 prod_str = str(top_prod)[:39]
                 top10_lines.append(
                     f"{rank:<3} | {cli_str:<40} | {_fmt_num(fat_tot):>14} | {prod_str:<40} | {_fmt_num(fat_prod):>19}"
                 )
-            parts.append("\n".join(top10_lines))
+            yield "\n".join(top10_lines)
         except Exception as e:
-            parts.append(f"[Top10 error: {e}]")
+            yield f"[Top10 error: {e}]"
 
     # --- Trend mensile ---
-    if col_data and val_cols:
-        parts.append(_monthly_trend(df, col_data, val_cols[:2]))
+    def _sec_trend():
+        yield _monthly_trend(df, col_data, val_cols[:2])
 
     # --- Indice prodotti compatto (fuzzy match AI: "selection"→nome esatto) ---
-    if col_prodotto:
+    def _sec_indice():
         try:
-            all_prods = sorted(df[col_prodotto].dropna().astype(str).unique().tolist())
-            prod_idx = ["\nINDICE PRODOTTI (usa per fuzzy match su nome parziale):"]
-            for p in all_prods:
-                prod_idx.append(f"  • {p}")
-            parts.append("\n".join(prod_idx))
+            all_prods = _str_unique(df[col_prodotto])
         except Exception:
-            pass
+            return
+        yield "\n".join(["\nINDICE PRODOTTI (usa per fuzzy match su nome parziale):"]
+                        + [f"  • {p}" for p in all_prods])
 
     # --- Cross: TOP + BOTTOM CLIENTI per ogni PRODOTTO ---
     # TOP → risponde a: "Chi ha comprato di PIÙ X?"
     # BOTTOM → risponde a: "Chi ha comprato di MENO X?" / "chi ha fatturato meno?"
-    if col_cliente and col_prodotto and val_cols:
+    # Un blocco per prodotto: il budget decide quanti prodotti entrano.
+    def _sec_cross_prodotto():
         try:
+            pc = _cross_tables()[0]
             # Tutti i prodotti (non solo top 12) per trovare anche "selection"
             all_prod_list = df[col_prodotto].dropna().unique().tolist()
-            cross_lines = ["\nTOP E BOTTOM CLIENTI per PRODOTTO"]
-            cross_lines.append("(risponde a 'chi ha comprato di più/meno X?', 'chi ha fatturato più/meno con X?'):")
+            pc_slices = _group_slices(pc, col_prodotto)
+            # Stessi valori (e dtype comune) delle righe di iterrows sul cli_agg per prodotto
+            pc_rows = pc[[col_cliente] + val_cols].to_numpy()
+            pc_val  = pc[val_cols[0]].to_numpy()
+            title = ("\nTOP E BOTTOM CLIENTI per PRODOTTO\n"
+                     "(risponde a 'chi ha comprato di più/meno X?', 'chi ha fatturato più/meno con X?'):\n")
             for prod in all_prod_list:
-                df_prod = df[df[col_prodotto] == prod]
-                cli_agg = (df_prod.groupby(col_cliente, observed=True)[val_cols]
-                                  .sum(numeric_only=True)
-                                  .reset_index()
-                                  .sort_values(val_cols[0], ascending=False))
-                if cli_agg.empty or len(cli_agg) < 1:
+                sl = pc_slices.get(prod)
+                if sl is None:
                     continue
-                cross_lines.append(f"\n  Prodotto: {prod}")
+                cli_agg = pc_rows[sl[0] + _desc_order(pc_val[sl[0]:sl[1]])]
+                block = [f"{title}\n  Prodotto: {prod}"]
+                title = ""
                 # TOP 5 (di più)
-                cross_lines.append("    TOP (di più):")
-                for _, row in cli_agg.head(5).iterrows():
-                    vals = " | ".join(f"{_fmt_num(row[c])}" for c in val_cols if c in row.index)
-                    cross_lines.append(f"      ↑ {str(row[col_cliente])[:40]}: {vals}")
+                block.append("    TOP (di più):")
+                for row in cli_agg[:5]:
+                    block.append(f"      ↑ {str(row[0])[:40]}: {_vals(row)}")
                 # BOTTOM 3 (di meno) — solo se ci sono abbastanza clienti
                 if len(cli_agg) > 5:
-                    cross_lines.append("    BOTTOM (di meno):")
-                    for _, row in cli_agg.tail(3).iterrows():
-                        vals = " | ".join(f"{_fmt_num(row[c])}" for c in val_cols if c in row.index)
-                        cross_lines.append(f"      ↓ {str(row[col_cliente])[:40]}: {vals}")
+                    block.append("    BOTTOM (di meno):")
+                    for row in cli_agg[-3:]:
+                        block.append(f"      ↓ {str(row[0])[:40]}: {_vals(row)}")
                 elif len(cli_agg) > 1:
                     # Meno di 5 clienti: mostra tutti e indica il minimo
-                    _, last_row = list(cli_agg.tail(1).iterrows())[0]
-                    vals = " | ".join(f"{_fmt_num(last_row[c])}" for c in val_cols if c in last_row.index)
-                    cross_lines.append(f"    MINIMO: {str(last_row[col_cliente])[:40]}: {vals}")
-                if len("\n".join(parts) + "\n".join(cross_lines)) > 8000:
-                    cross_lines.append("  [... altri prodotti omessi per limite token]")
-                    break
-            if len(cross_lines) > 2:
-                parts.append("\n".join(cross_lines))
+                    last_row = cli_agg[-1]
+                    block.append(f"    MINIMO: {str(last_row[0])[:40]}: {_vals(last_row)}")
+                yield "\n".join(block)
         except Exception as e:
-            parts.append(f"[Cross-agg error: {e}]")
+            yield f"[Cross-agg error: {e}]"
 
     # --- Cross: TOP + BOTTOM PRODOTTI per ogni CLIENTE (top 8 clienti) ---
     # Risponde a: "Cosa ha comprato di più/meno Esselunga?"
-    if col_cliente and col_prodotto and val_cols:
+    def _sec_cross_cliente():
         try:
-            top_clients = (df.groupby(col_cliente, observed=True)[val_cols[0]]
-                            .sum().sort_values(ascending=False).head(8).index.tolist())
-            cross2_lines = ["\nTOP E BOTTOM PRODOTTI per CLIENTE"]
-            cross2_lines.append("(risponde a 'cosa ha comprato di più/meno il cliente X?'):")
-            for cli in top_clients:
-                df_cli = df[df[col_cliente] == cli]
-                prod_agg = (df_cli.groupby(col_prodotto, observed=True)[val_cols]
-                                  .sum(numeric_only=True)
-                                  .reset_index()
-                                  .sort_values(val_cols[0], ascending=False))
-                if prod_agg.empty:
+            _, cp, cp_slices, cli_rank = _cross_tables()
+            cp_rows = cp[[col_prodotto] + val_cols].to_numpy()
+            cp_val  = cp[val_cols[0]].to_numpy()
+            title = ("\nTOP E BOTTOM PRODOTTI per CLIENTE\n"
+                     "(risponde a 'cosa ha comprato di più/meno il cliente X?'):\n")
+            for cli in cli_rank.head(8).index.tolist():
+                sl = cp_slices.get(cli)
+                if sl is None:
                     continue
-                cross2_lines.append(f"\n  Cliente: {cli}")
-                cross2_lines.append("    TOP (di più):")
-                for _, row in prod_agg.head(5).iterrows():
-                    vals = " | ".join(f"{_fmt_num(row[c])}" for c in val_cols if c in row.index)
-                    cross2_lines.append(f"      ↑ {str(row[col_prodotto])[:40]}: {vals}")
+                prod_agg = cp_rows[sl[0] + _desc_order(cp_val[sl[0]:sl[1]])]
+                block = [f"{title}\n  Cliente: {cli}"]
+                title = ""
+                block.append("    TOP (di più):")
+                for row in prod_agg[:5]:
+                    block.append(f"      ↑ {str(row[0])[:40]}: {_vals(row)}")
                 if len(prod_agg) > 5:
-                    cross2_lines.append("    BOTTOM (di meno):")
-                    for _, row in prod_agg.tail(3).iterrows():
-                        vals = " | ".join(f"{_fmt_num(row[c])}" for c in val_cols if c in row.index)
-                        cross2_lines.append(f"      ↓ {str(row[col_prodotto])[:40]}: {vals}")
-                if len("\n".join(parts) + "\n".join(cross2_lines)) > 9000:
-                    break
-            if len(cross2_lines) > 2:
-                parts.append("\n".join(cross2_lines))
+                    block.append("    BOTTOM (di meno):")
+                    for row in prod_agg[-3:]:
+                        block.append(f"      ↓ {str(row[0])[:40]}: {_vals(row)}")
+                yield "\n".join(block)
         except Exception as e:
-            parts.append(f"[Cross-agg2 error: {e}]")
+            yield f"[Cross-agg2 error: {e}]"
 
     # --- Analisi PROMO vs NORMALE (solo se le colonne sconto sono presenti) ---
     # Risponde a: "chi ha comprato X più in promo?" / "% promo per cliente"
     # Analisi promo: usa le stesse costanti e la stessa funzione del grafico
-    _has_promo_cols = _COL_S7 in df.columns or any("sconto7" in c.lower() for c in df.columns)
-    if _has_promo_cols and col_cliente and val_cols:
+    # Blocchi: tabella clienti → tabella prodotti → cross per prodotto.
+    def _sec_promo():
         try:
-            df_tmp = df.copy()
-            # __tipo__ già presente (df pre-classificato) o va calcolato ora
-            if '__tipo__' not in df_tmp.columns:
-                df_tmp['__tipo__'] = _classifica_vendita(df_tmp)
+            # __tipo__ già presente (df pre-classificato) o va calcolato ora (senza copiare df)
+            tipo = df['__tipo__'] if '__tipo__' in df.columns else _classifica_vendita(df)
             # Mappa per analisi binaria (normale/promo, esclude Omaggio dal % promo)
-            is_promo   = df_tmp['__tipo__'] == 'In Promozione'
-            is_omaggio = df_tmp['__tipo__'] == 'Omaggio'
-            is_normale = df_tmp['__tipo__'] == 'Vendita Normale'
+            is_promo   = tipo == 'In Promozione'
             col_s7 = _COL_S7
             col_s4 = _COL_S4
 
@@ -1389,18 +2877,22 @@ def _build_compact_context(context_df: pd.DataFrame, context_label: str) -> str:
             # Il grafico donut usa Kg → per coerenza l'AI usa la stessa metrica
             # QUESTO ELIMINA LA DISCREPANZA: righe con €=0 e Kg>0 (resi/campioni)
             # venivano conteggiate diversamente con € vs Kg
-            _metric_col = col_kg if (col_kg and col_kg in df_tmp.columns) else val_cols[0]
+            _metric_col = col_kg if (col_kg and col_kg in df.columns) else val_cols[0]
             _metric_label = "Kg" if _metric_col == col_kg else "€"
             _eur_col = val_cols[0] if val_cols else None  # per riportare € a parte
+            # Sotto-insiemi promo/non promo estratti una volta, solo con le colonne usate
+            _need = list(dict.fromkeys(c for c in (col_cliente, col_prodotto, _metric_col, _eur_col) if c))
+            df_promo = df.loc[is_promo, _need]
+            df_norm  = df.loc[~is_promo, [col_cliente, _metric_col]]
 
             # Aggregazione per cliente: totale, promo, normale, % promo (su Kg)
-            grp = df_tmp.groupby(col_cliente, observed=True)
+            grp = df.groupby(col_cliente, observed=True)
             tot_m  = grp[_metric_col].sum()
-            promo_m = df_tmp[is_promo].groupby(col_cliente, observed=True)[_metric_col].sum()
-            norm_m  = df_tmp[~is_promo].groupby(col_cliente, observed=True)[_metric_col].sum()
+            promo_m = df_promo.groupby(col_cliente, observed=True)[_metric_col].sum()
+            norm_m  = df_norm.groupby(col_cliente, observed=True)[_metric_col].sum()
             # Aggiungi anche € per informazione
             tot_eur_c   = grp[_eur_col].sum() if _eur_col and _eur_col != _metric_col else tot_m
-            promo_eur_c = df_tmp[is_promo].groupby(col_cliente, observed=True)[_eur_col].sum() if _eur_col and _eur_col != _metric_col else promo_m
+            promo_eur_c = df_promo.groupby(col_cliente, observed=True)[_eur_col].sum() if _eur_col and _eur_col != _metric_col else promo_m
 
             combined = pd.DataFrame({
                 "Totale":    tot_m,
@@ -1421,7 +2913,7 @@ def _build_compact_context(context_df: pd.DataFrame, context_label: str) -> str:
             promo_lines.append(f"  Omaggio         = s7=99 o 100 OPPURE s4=99 o 100")
             promo_lines.append(f"{'Cliente':<40} | {'Tot Kg':>10} | {'Promo Kg':>10} | {'% Promo(Kg)':>12} | {'Tot €':>12} | {'Promo €':>12}")
             promo_lines.append("-" * 105)
-            for _, row in combined.iterrows():
+            for row in _rows(combined):
                 cli = str(row[col_cliente])[:39]
                 promo_lines.append(
                     f"{cli:<40} | {_fmt_num(row['Totale']):>10} | {_fmt_num(row['Promo']):>10} | {row['% Promo']:>11.1f}% | {_fmt_num(row['Tot€']):>12} | {_fmt_num(row['Promo€']):>12}"
@@ -1429,64 +2921,569 @@ def _build_compact_context(context_df: pd.DataFrame, context_label: str) -> str:
                 if len("\n".join(promo_lines)) > 2500:
                     promo_lines.append("  [...altri clienti omessi per limite token]")
                     break
-            promo_lines.append("")
+            size = len("\n".join(promo_lines))
+            yield "\n".join(promo_lines)
+
+            promo_lines = [""]
             promo_lines.append(f"STESSO CALCOLO per PRODOTTO (% su {_metric_label}, top 20 per €):")
             promo_lines.append(f"{'Prodotto':<40} | {'Tot Kg':>10} | {'Promo Kg':>10} | {'% Promo(Kg)':>12} | {'Tot €':>12}")
             promo_lines.append("-" * 90)
-
             if col_prodotto:
-                grp_p = df_tmp.groupby(col_prodotto, observed=True)
+                grp_p = df.groupby(col_prodotto, observed=True)
                 tot_pm   = grp_p[_metric_col].sum()
-                promo_pm = df_tmp[is_promo].groupby(col_prodotto, observed=True)[_metric_col].sum()
+                promo_pm = df_promo.groupby(col_prodotto, observed=True)[_metric_col].sum()
                 tot_pe   = grp_p[_eur_col].sum() if _eur_col and _eur_col != _metric_col else tot_pm
                 comb_p  = pd.DataFrame({"Totale": tot_pm, "Promo": promo_pm, "Tot€": tot_pe}).fillna(0)
                 comb_p["% Promo"] = (comb_p["Promo"] / comb_p["Totale"].replace(0,1) * 100).round(1)
                 comb_p = comb_p.sort_values("Tot€", ascending=False).head(20).reset_index()
-                for _, row in comb_p.iterrows():
+                for row in _rows(comb_p):
                     prod = str(row[col_prodotto])[:39]
                     promo_lines.append(
                         f"{prod:<40} | {_fmt_num(row['Totale']):>10} | {_fmt_num(row['Promo']):>10} | {row['% Promo']:>11.1f}% | {_fmt_num(row['Tot€']):>12}"
                     )
+            size += len("\n".join(promo_lines)) + 1
+            yield "\n".join(promo_lines)
+            if not col_prodotto or size > 3500:
+                return
 
             # Cross: % promo per ogni PRODOTTO × CLIENTE — metrica Kg (= donut)
-            if col_prodotto:
-                promo_lines.append(f"\nCROSS: % PROMO per PRODOTTO × CLIENTE (% su {_metric_label} = UGUALE a donut):")
-                top_p_list = (df_tmp.groupby(col_prodotto, observed=True)[_eur_col or _metric_col]
-                               .sum().sort_values(ascending=False).head(15).index.tolist())
-                for prod in top_p_list:
-                    df_p = df_tmp[df_tmp[col_prodotto] == prod]
-                    is_p_promo = df_p["__tipo__"] == "In Promozione"
-                    cli_grp = df_p.groupby(col_cliente, observed=True)
-                    cli_tot_m  = cli_grp[_metric_col].sum()
-                    cli_promo_m = df_p[is_p_promo].groupby(col_cliente, observed=True)[_metric_col].sum()
-                    cli_tot_e  = cli_grp[_eur_col].sum() if _eur_col and _eur_col != _metric_col else cli_tot_m
-                    cli_df = pd.DataFrame({"TotKg": cli_tot_m, "PromoKg": cli_promo_m, "Tot€": cli_tot_e}).fillna(0)
-                    cli_df["% Promo"] = (cli_df["PromoKg"] / cli_df["TotKg"].replace(0,1) * 100).round(1)
-                    cli_df = cli_df.sort_values("% Promo", ascending=False).reset_index()
-                    if cli_df.empty:
-                        continue
-                    promo_lines.append(f"\n  {prod}:")
-                    for _, row in cli_df.iterrows():
-                        promo_lines.append(
-                            f"    {str(row[col_cliente])[:38]}: {_fmt_num(row['TotKg'])} Kg tot / {_fmt_num(row['PromoKg'])} Kg promo ({row['% Promo']:.1f}%) / {_fmt_num(row['Tot€'])} €"
-                        )
-                    if len("\n".join(promo_lines)) > 3500:
-                        promo_lines.append("  [...omesso per limite token]")
-                        break
-
-            parts.append("\n".join(promo_lines))
+            top_p_list = (df.groupby(col_prodotto, observed=True)[_eur_col or _metric_col]
+                            .sum().sort_values(ascending=False).head(15).index.tolist())
+            # Somme PRODOTTO × CLIENTE in un solo passaggio (totale e solo promo):
+            # ogni prodotto legge il suo blocco invece di rifiltrare df
+            _sep_eur = bool(_eur_col and _eur_col != _metric_col)
+            pcm = (df.groupby([col_prodotto, col_cliente], observed=True)
+                     [[_metric_col] + ([_eur_col] if _sep_eur else [])].sum().reset_index())
+            pcp = (df_promo.groupby([col_prodotto, col_cliente], observed=True)
+                           [_metric_col].sum().reset_index())
+            pcm_slices = _group_slices(pcm, col_prodotto)
+            pcp_slices = _group_slices(pcp, col_prodotto)
+
+            def _block(frame, sl, col):
+                a, b = sl if sl else (0, 0)
+                return pd.Series(frame[col].iloc[a:b].to_numpy(),
+                                 index=pd.Index(frame[col_cliente].iloc[a:b]))
+
+            title = f"\nCROSS: % PROMO per PRODOTTO × CLIENTE (% su {_metric_label} = UGUALE a donut):\n"
+            for prod in top_p_list:
+                sl = pcm_slices.get(prod)
+                if sl is None:
+                    continue
+                cli_tot_m   = _block(pcm, sl, _metric_col)
+                cli_promo_m = _block(pcp, pcp_slices.get(prod), _metric_col)
+                cli_tot_e   = _block(pcm, sl, _eur_col) if _sep_eur else cli_tot_m
+                cli_df = pd.DataFrame({"TotKg": cli_tot_m, "PromoKg": cli_promo_m, "Tot€": cli_tot_e}).fillna(0)
+                cli_df["% Promo"] = (cli_df["PromoKg"] / cli_df["TotKg"].replace(0,1) * 100).round(1)
+                cli_df = cli_df.sort_values("% Promo", ascending=False).reset_index()
+                if cli_df.empty:
+                    continue
+                block = [f"{title}\n  {prod}:"]
+                title = ""
+                for row in _rows(cli_df):
+                    block.append(
+                        f"    {str(row[col_cliente])[:38]}: {_fmt_num(row['TotKg'])} Kg tot / {_fmt_num(row['PromoKg'])} Kg promo ({row['% Promo']:.1f}%) / {_fmt_num(row['Tot€'])} €"
+                    )
+                block = "\n".join(block)
+                size += len(block) + 1
+                yield block
+                if size > 3500:
+                    return
         except Exception as e:
-            parts.append(f"[Analisi promo error: {e}]")
+            yield f"[Analisi promo error: {e}]"
+
+    # ── Sezioni: (priorità, dimensione minima stimata in char, generatore) ──
+    # Ordine della lista = ordine nel documento; la priorità decide chi entra
+    # quando il budget non basta per tutto. La dimensione minima è il primo
+    # blocco utile: se non entra, la sezione non viene calcolata.
+    _promo_cols = _COL_S7 in df.columns or any("sconto7" in c.lower() for c in df.columns)
+    _agg_min = 19 * (38 + 17 * len(val_cols))   # ~ tabella top 15
+    sections = [
+        (0, 60,    _sec_totali                         if val_cols else None),
+        (1, _agg_min, _sec_agg(col_cliente,  "CLIENTE")   if col_cliente else None),
+        (1, _agg_min, _sec_agg(col_prodotto, "PRODOTTO")  if col_prodotto else None),
+        (1, _agg_min, _sec_agg(col_fornitore, "FORNITORE") if col_fornitore else None),
+        (8, 400,   _sec_categoriche                    if val_cols else None),
+        (2, 800,   _sec_top10                          if has_cross else None),
+        (3, 300,   _sec_trend                          if col_data and val_cols else None),
+        (6, 80,    _sec_indice                         if col_prodotto else None),
+        (5, 600,   _sec_cross_prodotto                 if has_cross else None),
+        (7, 600,   _sec_cross_cliente                  if has_cross else None),
+        (4, 1500,  _sec_promo                          if _promo_cols and col_cliente and val_cols else None),
+    ]
+
+    return _assemble_sections(head, sections, budget_tokens, chars_per_token)
+
+
+# ---------------------------------------------------------------------------
+# RETRIEVAL LOCALE: domanda → clienti/prodotti/fornitori citati
+# Indice a trigrammi (pesati IDF) sui valori unici delle colonne entità,
+# nessun servizio esterno. Se la domanda cita entità riconosciute il contesto
+# contiene solo gli aggregati mirati su quelle (prompt più piccolo); altrimenti
+# si usa il contesto generale di _compact_context_cached.
+# ---------------------------------------------------------------------------
+_RETRIEVAL_MIN_SCORE = 0.6    # soglia di similarità (0-1) per accettare un'entità
+_RETRIEVAL_MAX_HITS  = 3      # entità per colonna (es. più punti vendita "Esselunga"); oltre = ambiguo
+_RETRIEVAL_MAX_WORDS = 4      # lunghezza massima (parole) delle finestre della domanda
+# Parole funzionali: le finestre che iniziano/finiscono con una di queste sono
+# già coperte da finestre più corte. I nomi generici ("cliente", "articolo")
+# NON sono qui: li neutralizza il peso IDF (compaiono in molti valori).
+_RETRIEVAL_STOPWORDS = frozenset("""
+    il lo la i gli le un uno una di a da in con su per tra fra e o ed che chi cosa come
+    quale quali quanto quanta quanti quante quando dove del dello della dei degli delle
+    al allo alla ai agli alle dal dalla dai nel nello nella nei negli nelle sul sulla sui
+    ha hanno ho e sono piu meno mi ci dammi dimmi mostra elenca fammi vedere
+""".split())
+
+
+def _norm_text(text: str) -> str:
+    """Minuscolo, senza accenti, solo lettere/cifre separate da spazi."""
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+
+def _trigrams(text: str) -> set:
+    """Trigrammi di caratteri di un testo normalizzato (con bordo di parola)."""
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _entity_index(fingerprint: str, col: str, _series: pd.Series) -> dict:
+    """
+    Indice a trigrammi dei valori unici di una colonna entità:
+    values (valori originali, per filtrare il df), postings (trigramma →
+    posizioni dei valori), idf (peso del trigramma), mass (peso IDF totale
+    di ogni valore).
+    """
+    values = _series.dropna().unique().tolist()
+    postings = {}
+    for i, v in enumerate(values):
+        for t in _trigrams(_norm_text(v)):
+            postings.setdefault(t, []).append(i)
+    n = max(len(values), 1)
+    postings = {t: np.asarray(ids, dtype=np.int64) for t, ids in postings.items()}
+    idf  = {t: 1.0 + np.log(n / len(ids)) for t, ids in postings.items()}
+    mass = np.zeros(len(values))
+    for t, ids in postings.items():
+        mass[ids] += idf[t]
+    return {"values": values, "postings": postings, "idf": idf,
+            "mass": np.maximum(mass, 1.0), "idf_unknown": 1.0 + np.log(n)}
+
+
+def _match_entities(question: str, index: dict) -> list:
+    """
+    [(valore, score)] delle entità citate nella domanda, score decrescente.
+    Ogni finestra di 1-4 parole della domanda è confrontata con i valori che
+    condividono trigrammi: score = copertura IDF della finestra × (0,7 + 0,3 ×
+    copertura IDF del valore). "esselunga" trova "ESSELUNGA SPA", "articolo 12"
+    preferisce "ARTICOLO 12" a "ARTICOLO 120"; una parola generica come
+    "articolo" pareggia su troppi valori → ambigua, nessun risultato.
+    """
+    best = _entity_scores(question, index)
+    if len(best) == 0:
+        return []
+    top = best.max()
+    hits = np.flatnonzero(best >= max(_RETRIEVAL_MIN_SCORE, top * 0.9))
+    if len(hits) == 0 or len(hits) > _RETRIEVAL_MAX_HITS:
+        return []
+    hits = hits[np.argsort(-best[hits], kind="stable")]
+    return [(index["values"][k], float(best[k])) for k in hits]
+
+
+def _entity_scores(question: str, index: dict) -> np.ndarray:
+    """Score (0-1) di ogni valore dell'indice rispetto alla domanda (vedi _match_entities)."""
+    values = index["values"]
+    words = _norm_text(question).split()
+    idf, postings = index["idf"], index["postings"]
+    best = np.zeros(len(values))
+    for i in range(len(words)):
+        for j in range(i + 1, min(i + _RETRIEVAL_MAX_WORDS, len(words)) + 1):
+            window = words[i:j]
+            if window[0] in _RETRIEVAL_STOPWORDS or window[-1] in _RETRIEVAL_STOPWORDS:
+                continue
+            text = " ".join(window)
+            if len(text) < 3:
+                continue
+            shared, w_mass = np.zeros(len(values)), 0.0
+            for t in _trigrams(text):
+                ids = postings.get(t)
+                if ids is None:
+                    w_mass += index["idf_unknown"]
+                    continue
+                w_mass += idf[t]
+                shared[ids] += idf[t]
+            score = (shared / w_mass) * (0.7 + 0.3 * shared / index["mass"])
+            np.maximum(best, score, out=best)
+    return best
+
+
+def _retrieve_entities(df: pd.DataFrame, fingerprint: str, context_label: str, question: str) -> dict:
+    """{ruolo: [(valore, score)]} per cliente/prodotto/fornitore citati nella domanda."""
+    if df is None or df.empty or not (question or "").strip():
+        return {}
+    kc = _ctx_columns(df, context_label)
+    found = {}
+    for role in ("cliente", "prodotto", "fornitore"):
+        col = kc[role]
+        if not col:
+            continue
+        hits = _match_entities(question, _entity_index(fingerprint, col, df[col]))
+        if hits:
+            found[role] = hits
+    return found
+
+
+@st.cache_data(show_spinner=False, ttl=120)
+def _targeted_context_cached(fingerprint: str, context_label: str, entities: tuple,
+                             _context_df: pd.DataFrame,
+                             budget_tokens: int = _CTX_TOKEN_BUDGET_DEFAULT,
+                             chars_per_token: float = _CHARS_PER_TOKEN_DEFAULT) -> str:
+    """
+    Contesto MIRATO sulle entità citate nella domanda (entities = ((ruolo, valore), …)):
+    per ognuna totali, controparti top/bottom, trend mensile e quota promo,
+    calcolati solo sulle sue righe; più l'incrocio cliente × prodotto se la
+    domanda li cita entrambi. Stesso assemblaggio a budget del contesto generale.
+    """
+    df   = _context_df
+    kc   = _ctx_columns(df, context_label)
+    val_cols = kc["val_cols"]
+    head = _ctx_head(context_label, len(df), kc["dset"], df.columns.tolist())
+    head.append("🔎 CONTESTO MIRATO sulle entità citate nella domanda: "
+                + "; ".join(f"{role} = {v}" for role, v in entities))
+    head.append("   → Per domande su altre entità chiedi all'utente di citarle per nome.")
+    # Controparte mostrata in top/bottom per ogni ruolo
+    other = {"cliente":   kc["prodotto"],
+             "prodotto":  kc["cliente"] or kc["fornitore"],
+             "fornitore": kc["prodotto"]}
+    _promo_cols = _COL_S7 in df.columns or any("sconto7" in c.lower() for c in df.columns)
+
+    def _tot_line(sub) -> str:
+        return " | ".join(f"{c}: {_fmt_num(sub[c].sum())}" for c in val_cols)
+
+    def _sec_totali():
+        if val_cols:
+            yield "\nTOTALI COMPLESSIVI (tutto il dataset):\n  " + _tot_line(df)
+
+    def _sec_focus(role, value):
+        def _gen():
+            try:
+                sub = df[df[kc[role]] == value]
+                oth = other.get(role)
+                first = [f"\nFOCUS {role.upper()}: {value}",
+                         f"  Righe: {len(sub):,}" + (f" | {oth} distinti: {sub[oth].nunique():,}" if oth else "")]
+                if val_cols:
+                    first.append(f"  Totali: {_tot_line(sub)}")
+                yield "\n".join(first)
+                if oth and val_cols:
+                    agg = (sub.groupby(oth, observed=True)[val_cols].sum(numeric_only=True)
+                              .reset_index())
+                    rows = agg.to_numpy()[_desc_order(agg[val_cols[0]].to_numpy())]
+                    lines = [f"  TOP {oth} (di più):"]
+                    lines += [f"    ↑ {str(r[0])[:40]}: " + " | ".join(_fmt_num(v) for v in r[1:])
+                              for r in rows[:10]]
+                    if len(rows) > 10:
+                        lines.append(f"  BOTTOM {oth} (di meno):")
+                        lines += [f"    ↓ {str(r[0])[:40]}: " + " | ".join(_fmt_num(v) for v in r[1:])
+                                  for r in rows[-5:]]
+                    yield "\n".join(lines)
+                if kc["data"] and val_cols:
+                    yield _monthly_trend(sub, kc["data"], val_cols[:2])
+                if _promo_cols and val_cols and not sub.empty:
+                    tipo = sub['__tipo__'] if '__tipo__' in sub.columns else _classifica_vendita(sub)
+                    metric = kc["kg"] if kc["kg"] in val_cols else val_cols[0]
+                    tot    = sub[metric].sum()
+                    promo  = sub.loc[tipo == 'In Promozione', metric].sum()
+                    omagg  = sub.loc[tipo == 'Omaggio', metric].sum()
+                    pct    = round(promo / (tot if tot != 0 else 1) * 100, 1)
+                    yield (f"  PROMO ({metric}): totale {_fmt_num(tot)} | in promozione {_fmt_num(promo)}"
+                           f" ({pct:.1f}%) | omaggio {_fmt_num(omagg)}")
+            except Exception as e:
+                yield f"[Focus {role} error: {e}]"
+        return _gen
+
+    def _sec_incrocio():
+        clis  = [v for role, v in entities if role == "cliente"]
+        prods = [v for role, v in entities if role == "prodotto"]
+        if not (clis and prods and val_cols):
+            return
+        lines = ["\nINCROCIO CLIENTE × PRODOTTO:"]
+        for c in clis:
+            sub_c = df[df[kc["cliente"]] == c]
+            for p in prods:
+                sub = sub_c[sub_c[kc["prodotto"]] == p]
+                lines.append(f"  {str(c)[:40]} × {str(p)[:40]}: righe {len(sub):,} | {_tot_line(sub)}")
+        yield "\n".join(lines)
+
+    sections = [(0, 60, _sec_totali)]
+    if val_cols and kc["cliente"] and kc["prodotto"]:
+        sections.append((1, 120, _sec_incrocio))
+    sections += [(2 + i, 120, _sec_focus(role, v)) for i, (role, v) in enumerate(entities)]
+    return _assemble_sections(head, sections, budget_tokens, chars_per_token)
+
+
+# ---------------------------------------------------------------------------
+# QUERY ENGINE LOCALE per il function-calling Groq
+# Il modello non legge tabelle pre-calcolate: chiede aggregati con il tool
+# query_data (filtri, group-by, bucket temporale, somma/media/conteggio,
+# top-k) e cerca i nomi esatti con find_values. Le query girano qui in pandas
+# sul df di contesto; al modello tornano solo le poche righe del risultato.
+# ---------------------------------------------------------------------------
+_TOOL_MAX_ROWS   = 50     # righe massime restituite al modello per query
+_TOOL_MAX_ROUNDS = 4      # giri tool → modello per domanda
+_TOOL_LOG_SIZE   = 50     # query tenute nel log tempi (session_state["ai_query_log"])
+_TOOL_BUCKETS    = {"giorno": "D", "settimana": "W", "mese": "M", "trimestre": "Q", "anno": "Y"}
+_TOOL_AGGS       = ("sum", "mean", "min", "max", "count")
+_TOOL_OPS        = ("==", "!=", "in", "not in", "contains", ">", ">=", "<", "<=")
+
+_AI_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "query_data",
+            "description": (
+                "Aggrega i dati del dataset corrente (già filtrato per entità e periodo). "
+                "Filtra le righe, raggruppa per colonne e/o per periodo, calcola la metrica "
+                "e restituisce le prime top_k righe ordinate. Senza group_by né time_bucket "
+                "restituisce solo i totali. I valori sono ESATTI."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "metrics":  {"type": "array", "items": {"type": "string"},
+                                 "description": "Colonne numeriche da aggregare (default: importo, kg)."},
+                    "agg":      {"type": "string", "enum": list(_TOOL_AGGS),
+                                 "description": "Funzione di aggregazione (default sum; count = numero righe)."},
+                    "group_by": {"type": "array", "items": {"type": "string"},
+                                 "description": "Colonne di raggruppamento (max 3)."},
+                    "time_bucket": {"type": "string", "enum": list(_TOOL_BUCKETS),
+                                    "description": "Raggruppa anche per periodo della colonna data."},
+                    "filters": {
+                        "type": "array",
+                        "description": "Condizioni in AND. I confronti su testo ignorano maiuscole/minuscole.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "column": {"type": "string"},
+                                "op":     {"type": "string", "enum": list(_TOOL_OPS)},
+                                "value":  {"description": "Valore, o lista di valori per in / not in."},
+                            },
+                            "required": ["column", "op", "value"],
+                        },
+                    },
+                    "date_from": {"type": "string", "description": "Data iniziale inclusa (YYYY-MM-DD)."},
+                    "date_to":   {"type": "string", "description": "Data finale inclusa (YYYY-MM-DD)."},
+                    "sort":  {"type": "string", "enum": ["desc", "asc"],
+                              "description": "Ordine sulla prima metrica (default desc; i periodi sono sempre in ordine cronologico)."},
+                    "top_k": {"type": "integer", "description": f"Righe da restituire (default 20, max {_TOOL_MAX_ROWS})."},
+                },
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_values",
+            "description": ("Trova i valori esatti di una colonna testuale (clienti, prodotti, fornitori…) "
+                            "che corrispondono a un nome parziale o scritto male. Usalo prima di filtrare."),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "column": {"type": "string"},
+                    "query":  {"type": "string"},
+                    "limit":  {"type": "integer", "description": "Valori massimi (default 10)."},
+                },
+                "required": ["column", "query"],
+            },
+        },
+    },
+]
 
-    parts.append("\n" + "="*60 + " FINE CONTESTO =" + "="*44 + "\n")
-    full_ctx = "\n".join(p for p in parts if p)
-    # HARD CAP: tronca il contesto a 10000 char per non sforare i limiti Groq
-    # System prompt ~8000 char + contesto dati ~10000 char = ~18000 char ≈ 4500 token
-    # Groq free tier: 6000 TPM → safe margin con conversazione multi-turno
-    _MAX_CTX = 10000
-    if len(full_ctx) > _MAX_CTX:
-        full_ctx = full_ctx[:_MAX_CTX] + "\n...[CONTESTO TRONCATO PER LIMITE TOKEN — usa filtri per ridurre i dati]\n"
-    return full_ctx
+
+class _ToolError(ValueError):
+    """Richiesta del modello non valida: il messaggio torna al modello come risultato del tool."""
+
+
+def _tool_column(df: pd.DataFrame, name) -> str:
+    """Nome colonna reale (anche con maiuscole/minuscole diverse) o _ToolError."""
+    if name in df.columns:
+        return name
+    folded = {str(c).casefold(): c for c in df.columns}
+    col = folded.get(str(name).casefold())
+    if col is None:
+        raise _ToolError(f"colonna '{name}' inesistente; colonne: {', '.join(map(str, df.columns))}")
+    return col
+
+
+def _tool_value_mask(s: pd.Series, test) -> np.ndarray:
+    """Maschera righe applicando test ai soli valori distinti (categorie o unique)."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        ok = np.array([bool(test(v)) for v in s.cat.categories] + [False])
+        return ok[s.cat.codes.to_numpy()]   # codice -1 (NaN) → ultimo elemento: False
+    uniq = s.dropna().unique()
+    keep = [v for v in uniq if test(v)]
+    return s.isin(keep).to_numpy()
+
+
+def _tool_filter(df: pd.DataFrame, flt: dict) -> np.ndarray:
+    """Maschera di una condizione {column, op, value}."""
+    col = _tool_column(df, flt.get("column"))
+    op, val = flt.get("op", "=="), flt.get("value")
+    if op not in _TOOL_OPS:
+        raise _ToolError(f"operatore '{op}' non supportato: {', '.join(_TOOL_OPS)}")
+    s = df[col]
+    if pd.api.types.is_datetime64_any_dtype(s):
+        val = [pd.Timestamp(v) for v in val] if isinstance(val, list) else pd.Timestamp(val)
+    elif pd.api.types.is_numeric_dtype(s):
+        try:
+            val = [float(v) for v in val] if isinstance(val, list) else float(val)
+        except (TypeError, ValueError):
+            raise _ToolError(f"'{col}' è numerica: valore '{val}' non valido")
+    else:
+        # Testo: confronto case-insensitive sui valori distinti
+        vals = {str(v).casefold() for v in (val if isinstance(val, list) else [val])}
+        if op in ("==", "in"):
+            return _tool_value_mask(s, lambda v: str(v).casefold() in vals)
+        if op in ("!=", "not in"):
+            return ~_tool_value_mask(s, lambda v: str(v).casefold() in vals)
+        if op == "contains":
+            return _tool_value_mask(s, lambda v: any(x in str(v).casefold() for x in vals))
+        raise _ToolError(f"operatore '{op}' non valido su testo")
+    if op in ("in", "not in"):
+        m = s.isin(val if isinstance(val, list) else [val]).to_numpy()
+        return ~m if op == "not in" else m
+    if op == "contains" or isinstance(val, list):
+        raise _ToolError(f"operatore '{op}' non valido su '{col}' con valore {val!r}")
+    return {"==": s.eq, "!=": s.ne, ">": s.gt, ">=": s.ge, "<": s.lt, "<=": s.le}[op](val).to_numpy()
+
+
+def _tool_num(v):
+    """Valore JSON compatto: numeri arrotondati a 2 decimali, il resto come testo."""
+    if isinstance(v, (int, np.integer)):
+        return int(v)
+    if isinstance(v, (float, np.floating)):
+        return None if np.isnan(v) else round(float(v), 2)
+    return str(v)
+
+
+def _tool_query_data(df: pd.DataFrame, kc: dict, args: dict) -> dict:
+    """Esegue query_data: filtri → group-by/bucket → aggregazione → top-k."""
+    agg = args.get("agg") or "sum"
+    if agg not in _TOOL_AGGS:
+        raise _ToolError(f"agg '{agg}' non supportata: {', '.join(_TOOL_AGGS)}")
+    metrics = [_tool_column(df, m) for m in (args.get("metrics") or kc["val_cols"][:2])]
+    bad = [m for m in metrics if not pd.api.types.is_numeric_dtype(df[m])]
+    if bad and agg != "count":
+        raise _ToolError(f"colonne non numeriche: {', '.join(bad)}")
+    group_by = [_tool_column(df, g) for g in (args.get("group_by") or [])][:3]
+
+    mask = np.ones(len(df), dtype=bool)
+    for flt in args.get("filters") or []:
+        mask &= _tool_filter(df, flt)
+    date_col = kc["data"]
+    if args.get("date_from") or args.get("date_to"):
+        if not date_col:
+            raise _ToolError("nessuna colonna data nel dataset")
+        d = df[date_col]
+        if args.get("date_from"):
+            mask &= (d >= pd.Timestamp(args["date_from"])).to_numpy()
+        if args.get("date_to"):
+            mask &= (d < pd.Timestamp(args["date_to"]) + pd.Timedelta(days=1)).to_numpy()
+    sub = df[mask] if not mask.all() else df
+
+    keys = [sub[g] for g in group_by]
+    bucket = args.get("time_bucket")
+    if bucket:
+        if bucket not in _TOOL_BUCKETS or not date_col:
+            raise _ToolError(f"time_bucket '{bucket}' non disponibile")
+        keys.append(sub[date_col].dt.to_period(_TOOL_BUCKETS[bucket]).rename(f"periodo ({bucket})"))
+
+    result = {"righe_filtrate": int(len(sub)),
+              "totali": {m: _tool_num(sub[m].sum()) for m in metrics if m not in bad}}
+    if not keys:
+        result["valore"] = ({"righe": int(len(sub))} if agg == "count"
+                            else {m: _tool_num(getattr(sub[m], agg)()) for m in metrics})
+        return result
+
+    grp = sub.groupby(keys, observed=True)
+    out = grp.size().rename("righe") if agg == "count" else getattr(grp[metrics], agg)()
+    out = out.reset_index()
+    sort_col = "righe" if agg == "count" else metrics[0]
+    if bucket and not group_by:
+        out = out.sort_values(keys[-1].name)          # serie temporale: ordine cronologico
+    else:
+        out = out.sort_values(sort_col, ascending=args.get("sort") == "asc", kind="stable")
+    top_k = max(1, min(int(args.get("top_k") or 20), _TOOL_MAX_ROWS))
+    result["gruppi_totali"] = int(len(out))
+    result["colonne"] = [str(c) for c in out.columns]
+    result["righe"] = [[_tool_num(v) for v in r] for r in out.head(top_k).itertuples(index=False)]
+    if len(out) > top_k:
+        result["troncato"] = f"mostrate {top_k} righe su {len(out)}"
+    return result
+
+
+def _tool_find_values(df: pd.DataFrame, fingerprint: str, args: dict) -> dict:
+    """Esegue find_values: contiene (case-insensitive) e, se vuoto, ricerca fuzzy a trigrammi."""
+    col = _tool_column(df, args.get("column"))
+    query = str(args.get("query") or "").strip()
+    limit = max(1, min(int(args.get("limit") or 10), _TOOL_MAX_ROWS))
+    index = _entity_index(fingerprint, col, df[col])
+    q = _norm_text(query)
+    found = [v for v in index["values"] if q and q in _norm_text(v)][:limit]
+    if not found:
+        # Nessun "contiene": i valori più simili (trigrammi), anche se ambigui — sceglie il modello
+        scores = _entity_scores(query, index)
+        order = np.argsort(-scores, kind="stable")[:limit]
+        found = [index["values"][k] for k in order if scores[k] >= 0.4]
+    return {"colonna": col, "valori": [str(v) for v in found], "distinti_totali": len(index["values"])}
+
+
+def _run_ai_tool(name: str, arguments: str, df: pd.DataFrame,
+                 context_label: str, fingerprint: str) -> str:
+    """Esegue un tool chiamato dal modello; risultato (o errore) in JSON compatto. Registra i tempi."""
+    t0 = time.perf_counter()
+    try:
+        args = json.loads(arguments or "{}")
+        if name == "query_data":
+            result = _tool_query_data(df, _ctx_columns(df, context_label), args)
+        elif name == "find_values":
+            result = _tool_find_values(df, fingerprint, args)
+        else:
+            raise _ToolError(f"tool '{name}' sconosciuto")
+    except (_ToolError, json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        result = {"errore": str(e)}
+    ms = (time.perf_counter() - t0) * 1000
+    log = _ai_session().setdefault("ai_query_log", [])
+    log.append({"ora": datetime.datetime.now().strftime("%H:%M:%S"), "tool": name,
+                "argomenti": arguments, "righe": len(result.get("righe", [])),
+                "errore": result.get("errore", ""), "ms": round(ms, 1)})
+    del log[:-_TOOL_LOG_SIZE]
+    return json.dumps(result, ensure_ascii=False, default=str)
+
+
+def _tool_context(context_df: pd.DataFrame, context_label: str) -> str:
+    """
+    Contesto per il function-calling: schema e totali, dimensione indipendente
+    dal numero di righe. I dettagli il modello li chiede con query_data.
+    """
+    kc = _ctx_columns(context_df, context_label)
+    head = _ctx_head(context_label, len(context_df), kc["dset"], context_df.columns.tolist())
+    lines = ["\nSCHEMA (colonna: tipo, valori distinti se testo):"]
+    for c in context_df.columns:
+        s = context_df[c]
+        if pd.api.types.is_numeric_dtype(s):
+            lines.append(f"  {c}: numero")
+        elif pd.api.types.is_datetime64_any_dtype(s):
+            lines.append(f"  {c}: data ({s.min():%Y-%m-%d} → {s.max():%Y-%m-%d})" if s.notna().any() else f"  {c}: data")
+        else:
+            lines.append(f"  {c}: testo, {s.nunique():,} valori")
+    roles = {k: kc[k] for k in ("cliente", "prodotto", "fornitore", "data") if kc[k]}
+    lines.append("Colonne chiave: " + ", ".join(f"{k}={v}" for k, v in roles.items()))
+    if kc["val_cols"]:
+        lines.append("\nTOTALI COMPLESSIVI:")
+        lines += [f"  {c}: {_fmt_num(context_df[c].sum())}" for c in kc["val_cols"]]
+    lines.append("\n🛠️ Per QUALSIASI altro numero usa i tool query_data / find_values: "
+                 "non stimare, non inventare. Per filtrare su un nome usa prima find_values.")
+    return "\n".join(head + lines + [_CTX_FOOT])
 
 
 def _transcribe_audio_groq(client, audio_bytes: bytes) -> str:
@@ -1503,10 +3500,60 @@ def _transcribe_audio_groq(client, audio_bytes: bytes) -> str:
         return f"[Errore trascrizione: {e}]"
 
 
+def _groq_round(client, stream, **kw):
+    """
+    Un giro di chat completion Groq → (testo, tool_calls, in_tok, out_tok).
+    Con stream (_StreamDedup) usa stream=True: i frammenti di testo vanno a
+    stream.feed, le tool_calls arrivano a pezzi (per indice) e sono ricomposte;
+    l'usage è nell'ultimo chunk (x_groq.usage).
+    """
+    if stream is None:
+        resp = client.chat.completions.create(**kw)
+        msg  = resp.choices[0].message
+        calls = [{"id": c.id, "type": "function",
+                  "function": {"name": c.function.name, "arguments": c.function.arguments}}
+                 for c in (getattr(msg, "tool_calls", None) or [])]
+        return (msg.content, calls,
+                getattr(resp.usage, "prompt_tokens",     0) or 0,
+                getattr(resp.usage, "completion_tokens", 0) or 0)
+    text, calls, usage = [], {}, None
+    for chunk in client.chat.completions.create(stream=True, **kw):
+        usage = (getattr(getattr(chunk, "x_groq", None), "usage", None)
+                 or getattr(chunk, "usage", None) or usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if getattr(delta, "content", None):
+            text.append(delta.content)
+            stream.feed(delta.content)
+        for tc in getattr(delta, "tool_calls", None) or []:
+            c = calls.setdefault(tc.index, {"id": "", "type": "function",
+                                            "function": {"name": "", "arguments": ""}})
+            c["id"] = tc.id or c["id"]
+            if tc.function is not None:
+                c["function"]["name"]      += tc.function.name or ""
+                c["function"]["arguments"] += tc.function.arguments or ""
+    return ("".join(text), [calls[i] for i in sorted(calls)],
+            getattr(usage, "prompt_tokens",     0) or 0,
+            getattr(usage, "completion_tokens", 0) or 0)
+
+
 def _call_groq(client, model_name: str, history: list,
                prompt: str, audio_bytes: bytes = None,
-               max_retries: int = 1):
-    """Chiama Groq con retry. Prova prima 70B poi 8B su rate limit."""
+               max_retries: int = 1, tool_df: pd.DataFrame = None,
+               tool_label: str = "", tool_fp: str = None,
+               stream: "_StreamDedup" = None):
+    """
+    Chiama Groq con retry. Prova prima 70B poi 8B su rate limit.
+    Con tool_df il modello può chiamare query_data / find_values (_AI_TOOLS):
+    le query girano in locale su tool_df e i risultati tornano al modello,
+    fino a _TOOL_MAX_ROUNDS giri; i token di tutti i giri sono sommati.
+    Con stream la risposta arriva token per token (stream.feed) e la
+    deduplica è incrementale; il testo finale è lo stesso del non-streaming.
+    Ogni giro passa dallo scheduler condiviso (_rate_acquire): il modello è il
+    primo con margine RPM/TPM/TPD, altrimenti si attende in coda (max
+    _RATE_MAX_WAIT s) invece di inviare e ricevere un 429.
+    """
     final_prompt = prompt
     if audio_bytes:
         transcript = _transcribe_audio_groq(client, audio_bytes)
@@ -1514,8 +3561,11 @@ def _call_groq(client, model_name: str, history: list,
 
     models_to_try = list(dict.fromkeys([model_name] + _GROQ_MODELS))  # dedup, order preserved
     current_model = models_to_try[0]
+    scheduler     = _rate_scheduler()
+    tools_chars   = len(json.dumps(_AI_TOOLS)) if tool_df is not None else 0
 
     for attempt in range(max_retries + 1):
+        reserved = 0
         try:
             messages = [{"role": "system", "content": _AI_SYSTEM_PROMPT}]
             for m in history:
@@ -1524,38 +3574,73 @@ def _call_groq(client, model_name: str, history: list,
                     "content": m["text"],
                 })
             messages.append({"role": "user", "content": final_prompt})
-            resp = client.chat.completions.create(
-                model=current_model,
-                messages=messages,
-                temperature=0.05,   # quasi-deterministico → risposte precise e assertive
-                max_tokens=8192,    # risposta lunga senza troncamenti
-            )
-            answer  = _deduplicate_response(resp.choices[0].message.content)
-            in_tok  = getattr(resp.usage, "prompt_tokens",     0) or 0
-            out_tok = getattr(resp.usage, "completion_tokens", 0) or 0
+            in_tok = out_tok = 0
+            for rnd in range(_TOOL_MAX_ROUNDS + 1 if tool_df is not None else 1):
+                tool_kw = {}
+                if tool_df is not None:
+                    # Ultimo giro: niente più tool, il modello deve rispondere
+                    tool_kw = {"tools": _AI_TOOLS,
+                               "tool_choice": "auto" if rnd < _TOOL_MAX_ROUNDS else "none"}
+                if stream is not None:
+                    stream.reset()   # l'eventuale testo di un giro precedente non è la risposta
+                # Stima token del giro (prompt completo + output prenotato), poi coda/routing:
+                # dal secondo giro tool il modello resta quello della conversazione
+                sent = (tools_chars + sum(len(m.get("content") or "") for m in messages)
+                        + sum(len(json.dumps(m["tool_calls"])) for m in messages if "tool_calls" in m))
+                est  = int(sent / _chars_per_token(current_model)) + _RATE_OUT_RESERVE
+                model, waited = _rate_acquire("groq", models_to_try if rnd == 0 else [current_model],
+                                              est, stream)
+                if model is None:
+                    return (None, in_tok, out_tok,
+                            f"429 rate_limit: quota Groq satura per i prossimi {_RATE_MAX_WAIT}s "
+                            f"(limiti condivisi da tutte le sessioni).", current_model)
+                current_model, reserved = model, est
+                content, calls, it, ot = _groq_round(
+                    client, stream,
+                    model=current_model,
+                    messages=messages,
+                    temperature=0.05,   # quasi-deterministico → risposte precise e assertive
+                    max_tokens=8192,    # risposta lunga senza troncamenti
+                    **tool_kw,
+                )
+                in_tok, out_tok = in_tok + it, out_tok + ot
+                scheduler.settle("groq", current_model, reserved, it + ot)
+                reserved = 0
+                if not calls:
+                    break
+                messages.append({"role": "assistant", "content": content or "", "tool_calls": calls})
+                for c in calls:
+                    messages.append({
+                        "role": "tool", "tool_call_id": c["id"],
+                        "content": _run_ai_tool(c["function"]["name"], c["function"]["arguments"],
+                                                tool_df, tool_label, tool_fp),
+                    })
+            answer = stream.final() if stream is not None else _deduplicate_response(content)
+            if not answer:
+                return None, in_tok, out_tok, "Risposta vuota dal modello.", current_model
             return answer, in_tok, out_tok, None, current_model
         except Exception as e:
+            if reserved:   # richiesta fallita: i token prenotati non sono stati consumati
+                scheduler.settle("groq", current_model, reserved, 0)
             err_str = str(e)
             is_rate  = "429" in err_str or "rate_limit" in err_str.lower()
             is_model = "model" in err_str.lower() and ("not found" in err_str.lower() or "does not exist" in err_str.lower())
             if (is_rate or is_model) and attempt < max_retries:
-                # Prossimo modello nella lista
-                idx = models_to_try.index(current_model) if current_model in models_to_try else 0
-                if idx + 1 < len(models_to_try):
-                    current_model = models_to_try[idx + 1]
                 if is_rate:
-                    wait_s = 3   # ridotto da 15s per fallback più rapido
-                    m_wait = re.search(r"retry in (\d+)", err_str)
-                    if m_wait:
-                        wait_s = min(int(m_wait.group(1)), 20)
-                    time.sleep(wait_s)
+                    # Niente sleep: il modello resta fermo nello scheduler per il retry
+                    # indicato e il prossimo giro va su un modello libero o in coda
+                    scheduler.penalize("groq", current_model, _retry_after_s(err_str, 3))
+                elif len(models_to_try) > 1:
+                    models_to_try.remove(current_model)
+                    current_model = models_to_try[0]
                 continue
             return None, 0, 0, err_str, current_model
     return None, 0, 0, "Quota esaurita.", current_model
 
 
-def _call_gemini(client, history: list, prompt: str, audio_bytes: bytes = None):
-    """Chiama Gemini con retry su 429."""
+def _call_gemini(client, history: list, prompt: str, audio_bytes: bytes = None,
+                 stream: "_StreamDedup" = None):
+    """Chiama Gemini con retry su 429 (con stream: send_message(stream=True), testo a stream.feed)."""
     gem_history = [
         {"role": m["role"], "parts": [m["text"]]}
         for m in history
@@ -1568,18 +3653,38 @@ def _call_gemini(client, history: list, prompt: str, audio_bytes: bytes = None):
         ]
     else:
         content = prompt
+    scheduler = _rate_scheduler()
+    model     = getattr(client, "model_name", "gemini").replace("models/", "")
+    sent      = len(_AI_SYSTEM_PROMPT) + sum(len(m["text"] or "") for m in history) + len(prompt or "")
+    est       = int(sent / _chars_per_token(model)) + _RATE_OUT_RESERVE
     for attempt in range(3):
+        if _rate_acquire("gemini", [model], est, stream)[0] is None:
+            return None, 0, 0, f"429 quota Gemini satura per i prossimi {_RATE_MAX_WAIT}s."
         try:
             chat = client.start_chat(history=gem_history)
-            resp = chat.send_message(content)
+            if stream is not None:
+                stream.reset()
+                resp = chat.send_message(content, stream=True)
+                for chunk in resp:
+                    try:
+                        stream.feed(chunk.text)
+                    except ValueError:   # chunk senza parti di testo (es. solo safety)
+                        continue
+                answer = stream.final()
+            else:
+                resp = chat.send_message(content)
+                answer = _deduplicate_response(resp.text)
             usage   = getattr(resp, "usage_metadata", None)
             in_tok  = getattr(usage, "prompt_token_count",    0) or 0
             out_tok = getattr(usage, "candidates_token_count",0) or 0
-            return _deduplicate_response(resp.text), in_tok, out_tok, None
+            scheduler.settle("gemini", model, est, in_tok + out_tok)
+            return answer, in_tok, out_tok, None
         except Exception as e:
+            scheduler.settle("gemini", model, est, 0)
             err_str = str(e)
             if ("429" in err_str) and attempt < 2:
-                time.sleep(20)
+                # Al posto dello sleep fisso: il prossimo tentativo attende in coda
+                scheduler.penalize("gemini", model, _retry_after_s(err_str, 20))
                 continue
             return None, 0, 0, err_str
     return None, 0, 0, "Quota Gemini esaurita."
@@ -1593,40 +3698,180 @@ def _deduplicate_response(text: str) -> str:
     """
     if not text:
         return text
-
     # --- PASSATA 1: paragrafi separati da \n\n ---
-    paragraphs = text.split("\n\n")
-    deduped = []
-    prev = None
-    for p in paragraphs:
+    return _dedup_finish(_StreamDedup().feed(text).paragraphs())
+
+
+class _StreamDedup:
+    """
+    Deduplica incrementale di una risposta in streaming.
+    La PASSATA 1 di _deduplicate_response (paragrafi identici consecutivi) è
+    applicata man mano che i paragrafi si chiudono con "\n\n": la stessa
+    scansione sinistra→destra di str.split, quindi lo stesso risultato. Le
+    passate 2-3 (blocchi e frasi ripetute) richiedono il testo completo e
+    girano in final(): il testo finale è identico a _deduplicate_response.
+    on_update(testo) riceve il testo parziale da mostrare (al più ogni 80 ms).
+    ttft: secondi dal costruttore al primo frammento di testo.
+    """
+
+    def __init__(self, on_update=None):
+        self.on_update = on_update
+        self.t0   = time.perf_counter()
+        self.ttft = None
+        self.reset()
+
+    def reset(self) -> None:
+        """Ricomincia (retry su altro modello/provider): il ttft resta quello del primo token."""
+        self._kept, self._prev, self._tail, self._last_push = [], None, "", 0.0
+
+    def feed(self, delta: str) -> "_StreamDedup":
+        if not delta:
+            return self
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.t0
+        self._tail += delta
+        while "\n\n" in self._tail:
+            p, self._tail = self._tail.split("\n\n", 1)
+            self._keep(p)
+        if self.on_update and time.perf_counter() - self._last_push > 0.08:
+            self._last_push = time.perf_counter()
+            self.on_update(self.partial())
+        return self
+
+    def _keep(self, p: str) -> None:
         stripped = p.strip()
-        if stripped and stripped != prev:
-            deduped.append(p)
-            prev = stripped
-    text = "\n\n".join(deduped)
+        if stripped and stripped != self._prev:
+            self._kept.append(p)
+            self._prev = stripped
+
+    def paragraphs(self) -> str:
+        """Testo dopo la PASSATA 1 (l'ultimo paragrafo aperto è chiuso qui)."""
+        kept = list(self._kept)
+        stripped = self._tail.strip()
+        if stripped and stripped != self._prev:
+            kept.append(self._tail)
+        return "\n\n".join(kept)
+
+    def partial(self) -> str:
+        """Testo da mostrare durante lo streaming."""
+        return self.paragraphs()
+
+    def final(self) -> str:
+        """Testo finale: identico a _deduplicate_response(testo grezzo completo)."""
+        text = self.paragraphs()
+        return _dedup_finish(text) if text else text
+
+
+_DEDUP_MIN_BLOCK = 30   # lunghezza minima di un blocco ripetuto (PASSATA 2)
+
+
+def _lce_index(codes: np.ndarray):
+    """
+    Suffix array (prefix doubling) + LCP (Kasai) + sparse table per RMQ.
+    Restituisce lce(i, j) vettoriale: lunghezza del prefisso comune dei suffissi
+    che iniziano in i e j (array di posizioni distinte, < len(codes)).
+    """
+    n = len(codes)
+    rank = codes.astype(np.int64)
+    k = 1
+    while True:
+        second = np.full(n, -1, dtype=np.int64)
+        second[:n - k] = rank[k:]
+        sa = np.lexsort((second, rank))
+        r1, r2 = rank[sa], second[sa]
+        step = np.empty(n, dtype=np.int64)
+        step[0] = 0
+        step[1:] = (r1[1:] != r1[:-1]) | (r2[1:] != r2[:-1])
+        rank = np.empty(n, dtype=np.int64)
+        rank[sa] = np.cumsum(step)
+        if rank[sa[-1]] == n - 1 or k >= n:
+            break
+        k *= 2
+    # Kasai: lcp[r] = LCP(sa[r-1], sa[r])
+    seq, sa_l, rank_l = codes.tolist(), sa.tolist(), rank.tolist()
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        r = rank_l[i]
+        if r == 0:
+            h = 0
+            continue
+        j = sa_l[r - 1]
+        while i + h < n and j + h < n and seq[i + h] == seq[j + h]:
+            h += 1
+        lcp[r] = h
+        if h:
+            h -= 1
+    table = [np.asarray(lcp, dtype=np.int64)]
+    span = 1
+    while span * 2 <= n:
+        prev = table[-1]
+        table.append(np.minimum(prev[:-span], prev[span:]))
+        span *= 2
+
+    def lce(i: np.ndarray, j: np.ndarray) -> np.ndarray:
+        ri, rj = rank[i], rank[j]
+        lo = np.minimum(ri, rj) + 1
+        hi = np.maximum(ri, rj)
+        lev = np.log2(hi - lo + 1).astype(np.int64)
+        out = np.empty(len(lo), dtype=np.int64)
+        for level in np.unique(lev).tolist():
+            m = lev == level
+            t = table[level]
+            out[m] = np.minimum(t[lo[m]], t[hi[m] - (1 << level) + 1])
+        return out
+
+    return lce
+
+
+def _first_square(text: str, min_period: int):
+    """
+    Prima ripetizione "XX" con len(X) >= min_period: (inizio, len(X)) con inizio
+    minimo e, a parità, periodo minimo (= il match di re.search(r'(.{p,}?)\1')),
+    oppure None. Per ogni periodo L si campionano le posizioni multiple di L:
+    ogni quadrato di periodo L ne contiene una, e lì LCE in avanti + LCE
+    all'indietro >= L lo rivelano. Sum(n/L) campioni → O(n log n) query LCE.
+    """
+    n = len(text)
+    if n < 2 * min_period:
+        return None
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    periods = np.arange(min_period, n // 2 + 1, dtype=np.int64)
+    counts = (n - 1 - periods) // periods + 1          # q = 0, L, 2L, ... con q + L < n
+    per = np.repeat(periods, counts)
+    first = np.cumsum(counts) - counts
+    q = (np.arange(int(counts.sum()), dtype=np.int64) - np.repeat(first, counts)) * per
+    fwd = _lce_index(codes)(q, q + per)
+    back = np.zeros(len(q), dtype=np.int64)
+    has_left = q > 0
+    if has_left.any():
+        rev_lce = _lce_index(codes[::-1].copy())
+        back[has_left] = rev_lce(n - q[has_left], n - q[has_left] - per[has_left])
+    back = np.minimum(back, per)
+    hit = back + fwd >= per
+    if not hit.any():
+        return None
+    start, per = (q - back)[hit], per[hit]
+    best = np.lexsort((per, start))[0]
+    return int(start[best]), int(per[best])
+
 
+def _dedup_finish(text: str) -> str:
+    """PASSATE 2-3 di _deduplicate_response (sul testo già deduplicato per paragrafi)."""
     # --- PASSATA 2: blocchi ripetuti concatenati senza separatore ---
-    # Usa regex: trova il pattern (X){2,} dove X è qualunque sequenza >=30 chars
-    import re as _re
-    # Cerca sequenze ripetute 2+ volte (almeno 30 caratteri per sequenza)
-    # Il pattern è greedy-free per trovare la ripetizione più lunga
-    changed = True
-    max_iter = 5
-    while changed and max_iter > 0:
-        changed = False
-        max_iter -= 1
-        # Cerca: una stringa di almeno 30 char seguita dalla stessa stringa identica
-        match = _re.search(
-            r'(.{30,}?)\1+',
-            text,
-            flags=_re.DOTALL
-        )
-        if match:
-            # Sostituisce tutte le ripetizioni con una sola occorrenza
-            repeated = _re.escape(match.group(1))
-            original = match.group(0)
-            text = text.replace(original, match.group(1), 1)
-            changed = True
+    # Stessa semantica di re.search(r'(.{30,}?)\1+', DOTALL) + replace, ma
+    # lineare-logaritmica: il regex è quadratico/cubico e su risposte lunghe e
+    # ripetitive bloccava il thread per secondi.
+    for _ in range(5):
+        sq = _first_square(text, _DEDUP_MIN_BLOCK)
+        if sq is None:
+            break
+        i, period = sq
+        block = text[i:i + period]
+        j = i + period
+        while text.startswith(block, j):
+            j += period
+        text = text[:i] + block + text[j:]
 
     # --- PASSATA 3: frasi ripetute consecutive ---
     parts = [s.strip() for s in text.split(". ") if s.strip()]
@@ -1645,19 +3890,26 @@ def _deduplicate_response(text: str) -> str:
 def _call_ai(client, provider: str, model_name: str,
              history: list, prompt: str,
              audio_bytes: bytes = None,
-             max_retries: int = 2):
+             max_retries: int = 2, tool_df: pd.DataFrame = None,
+             tool_label: str = "", tool_fp: str = None,
+             stream: "_StreamDedup" = None):
     """
     Wrapper principale: chiama Groq o Gemini.
     Se Groq fallisce per motivo non-quota, tenta fallback su Gemini
     (se gemini_api_key è nei secrets) prima di mostrare errore.
+    Con tool_df (function-calling, solo Groq) niente fallback: il prompt contiene
+    solo lo schema, il chiamante riprova con il contesto pre-calcolato.
     Restituisce (answer, in_tok, out_tok, error, provider_used, model_used).
     """
     if provider == "groq":
         answer, in_tok, out_tok, err, model_used = _call_groq(
-            client, model_name, history, prompt, audio_bytes, max_retries
+            client, model_name, history, prompt, audio_bytes, max_retries,
+            tool_df=tool_df, tool_label=tool_label, tool_fp=tool_fp, stream=stream
         )
         if answer:
             return answer, in_tok, out_tok, None, "groq", model_used
+        if tool_df is not None:
+            return None, 0, 0, err, "groq", model_used
 
         # Groq fallito: prova Gemini automaticamente
         gemini_key = st.secrets.get("gemini_api_key", "")
@@ -1673,7 +3925,8 @@ def _call_ai(client, provider: str, model_name: str,
                                 temperature=0.1, top_p=0.85, max_output_tokens=4096
                             ),
                         )
-                        ans2, it2, ot2, err2 = _call_gemini(gem_client, history, prompt, audio_bytes)
+                        ans2, it2, ot2, err2 = _call_gemini(gem_client, history, prompt, audio_bytes,
+                                                            stream=stream)
                         if ans2:
                             return ans2, it2, ot2, None, "gemini_fallback", gm
                     except Exception:
@@ -1685,26 +3938,137 @@ def _call_ai(client, provider: str, model_name: str,
         return None, 0, 0, err, "groq", model_used
 
     else:  # gemini primario
-        ans, it, ot, err = _call_gemini(client, history, prompt, audio_bytes)
+        ans, it, ot, err = _call_gemini(client, history, prompt, audio_bytes, stream=stream)
         return ans, it, ot, err, "gemini", model_name
 
 
-def _tts_audio(text: str) -> bytes | None:
-    """Genera audio MP3 da testo in italiano via gTTS (gratis, nessuna API key)."""
-    try:
-        from gtts import gTTS
-        buf = io.BytesIO()
-        gTTS(text=text, lang="it", slow=False).write_to_fp(buf)
-        buf.seek(0)
-        return buf.read()
-    except ImportError:
-        return None
-    except Exception:
+# Sintesi per frase: le frasi complete si sintetizzano mentre il modello scrive le
+# successive (_AiJob.show); il file finale è la concatenazione degli MP3 delle frasi
+# della risposta definitiva (come fa gTTS stesso con i suoi blocchi da 100 caratteri).
+_TTS_SENTENCE_RE = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+
+def _tts_sentences(text: str) -> list:
+    """Frasi/righe da sintetizzare separatamente (vuote escluse)."""
+    return [p.strip() for p in _TTS_SENTENCE_RE.split(text or "") if p.strip()]
+
+
+@st.cache_data(show_spinner=False, max_entries=1024, ttl=86400)
+def _tts_clip(sentence: str) -> bytes:
+    """MP3 di una frase (cache per contenuto: risposte ripetute non si risintetizzano)."""
+    from gtts import gTTS
+    buf = io.BytesIO()
+    gTTS(text=sentence, lang="it", slow=False).write_to_fp(buf)
+    return buf.getvalue()
+
+
+def _tts_audio(text: str, pending: dict = None) -> bytes | None:
+    """
+    Genera audio MP3 da testo in italiano via gTTS (gratis, nessuna API key).
+    pending: frase → Future di _tts_clip già avviate durante lo streaming; quelle
+    non ancora partite si annullano e si sintetizzano qui (niente attese sul pool).
+    """
+    clips = []
+    for sentence in _tts_sentences(text):
+        fut = (pending or {}).get(sentence)
+        try:
+            if fut is not None and not fut.cancel():
+                clips.append(fut.result())
+            else:
+                clips.append(_tts_clip(sentence))
+        except ImportError:
+            return None
+        except Exception:
+            continue
+    return b"".join(clips) or None
+
+
+# ── CACHE RISPOSTE AI ───────────────────────────────────────────────────
+# Le stesse domande ("Top 5 clienti per fatturato", "trend mensile") tornano spesso
+# sullo stesso periodo/entità: ogni volta un giro Groq completo e token contro
+# _GROQ_FREE_TPD. La risposta si riusa se coincidono la domanda normalizzata
+# (senza accenti, punteggiatura, parole funzionali) e il fingerprint del contesto
+# (versione file + filtri + label + prompt di sistema). Condivisa fra sessioni,
+# LRU + TTL, salvata su disco (JSON atomico) → sopravvive ai riavvii.
+_ANSWER_CACHE_PATH      = os.environ.get("EITA_ANSWER_CACHE",
+                                         os.path.join(tempfile.gettempdir(), "eita_ai_answers.json"))
+_ANSWER_CACHE_TTL       = int(os.environ.get("EITA_ANSWER_CACHE_TTL_H", "24")) * 3600
+_ANSWER_CACHE_MAX       = 500   # voci tenute (le meno usate di recente escono per prime)
+_ANSWER_CACHE_MIN_WORDS = 3     # sotto: domanda di follow-up ("e a febbraio?") → dipende dalla chat
+
+
+class _AnswerCache:
+    """Cache domanda → risposta thread-safe (LRU + TTL) persistita in un file JSON."""
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path, self.ttl, self.max_entries = path, ttl, max_entries
+        self._lock = threading.Lock()
+        self._data = {}   # ordine di inserimento = ordine LRU (meno recente in testa)
+        try:
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        now = time.time()
+        for key, entry in saved.items():
+            if isinstance(entry, dict) and now - entry.get("ts", 0) < ttl:
+                self._data[key] = entry
+
+    def get(self, key: str):
+        """Voce valida (copia) o None; un hit la sposta in fondo (più recente)."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or time.time() - entry["ts"] >= self.ttl:
+                return None
+            entry["hits"] = entry.get("hits", 0) + 1
+            self._data[key] = entry
+            return dict(entry)
+
+    def put(self, key: str, entry: dict) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = dict(entry, ts=time.time(), hits=0)
+            while len(self._data) > self.max_entries:
+                del self._data[next(iter(self._data))]
+            self._save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._save()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _save(self) -> None:
+        """Scrittura atomica (tmp + os.replace), best-effort come gli snapshot."""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+@st.cache_resource
+def _answer_cache() -> _AnswerCache:
+    """Istanza unica per processo (condivisa da tutte le sessioni)."""
+    return _AnswerCache(_ANSWER_CACHE_PATH, _ANSWER_CACHE_TTL, _ANSWER_CACHE_MAX)
+
+
+def _answer_cache_key(question: str, context_fp: str, context_label: str):
+    """Chiave per domanda + contesto, None se la domanda è troppo corta per stare da sola."""
+    words = [w for w in _norm_text(question or "").split() if w not in _RETRIEVAL_STOPWORDS]
+    if len(words) < _ANSWER_CACHE_MIN_WORDS:
         return None
+    return _fingerprint(" ".join(words), context_fp, context_label, _AI_SYSTEM_PROMPT)
 
 
-def _update_token_stats(in_tok: int, out_tok: int, provider: str, model: str) -> None:
-    """Aggiorna contatore token in session_state."""
+def _token_stats(provider: str, model: str) -> dict:
+    """Contatore token in session_state (creato al primo uso, azzerato dopo 24h)."""
     if "ai_token_stats" not in st.session_state:
         st.session_state["ai_token_stats"] = {
             "session_input": 0, "session_output": 0,
@@ -1714,13 +4078,48 @@ def _update_token_stats(in_tok: int, out_tok: int, provider: str, model: str) ->
     s = st.session_state["ai_token_stats"]
     if time.time() - s["day_start_ts"] > 86400:
         s["session_input"] = s["session_output"] = s["session_calls"] = 0
+        s["cache_hits"] = s["cache_saved"] = 0
         s["day_start_ts"]  = time.time()
+    return s
+
+
+def _record_cache_hit(entry: dict) -> None:
+    """Risposta servita dalla cache: nessun token consumato, si contano quelli risparmiati."""
+    s = _token_stats(entry.get("provider", "groq"), entry.get("model", ""))
+    s["cache_hits"]  = s.get("cache_hits", 0) + 1
+    s["cache_saved"] = s.get("cache_saved", 0) + entry.get("in_tok", 0) + entry.get("out_tok", 0)
+    s["last_cached"] = True
+
+
+def _update_token_stats(in_tok: int, out_tok: int, provider: str, model: str,
+                        sent_chars: int = 0, ttft: float = None, queue_wait: float = None) -> None:
+    """
+    Aggiorna contatore token in session_state (e i char/token misurati del modello).
+    ttft: secondi dalla richiesta al primo token mostrato (streaming).
+    queue_wait: secondi passati in coda nello scheduler (_rate_acquire).
+    """
+    if sent_chars and in_tok:
+        # Media mobile: il budget del contesto si adatta al tokenizer reale del modello
+        ratios = st.session_state.setdefault("ai_chars_per_token", {})
+        ratio  = sent_chars / in_tok
+        prev   = ratios.get(model)
+        ratios[model] = ratio if prev is None else 0.7 * prev + 0.3 * ratio
+    s = _token_stats(provider, model)
     s["session_input"]  += in_tok
     s["session_output"] += out_tok
     s["session_calls"]  += 1
     s["last_call_ts"]    = time.time()
     s["provider"]        = provider
     s["model"]           = model
+    s["last_cached"]     = False
+    if ttft is not None:
+        s["last_ttft"] = ttft
+        s["ttft_sum"]  = s.get("ttft_sum", 0.0) + ttft
+        s["ttft_n"]    = s.get("ttft_n", 0) + 1
+    if queue_wait:
+        s["queue_last"] = queue_wait
+        s["queue_sum"]  = s.get("queue_sum", 0.0) + queue_wait
+        s["queue_n"]    = s.get("queue_n", 0) + 1
 
 
 def _render_token_counter() -> None:
@@ -1731,35 +4130,306 @@ def _render_token_counter() -> None:
     tot       = s["session_input"] + s["session_output"]
     provider  = s.get("provider", "groq")
     model_lbl = s.get("model", "")
-    # Limiti per provider
-    tpd_limit = _GROQ_FREE_TPD if provider == "groq" else 1_000_000
-    rpm_limit = _GROQ_FREE_RPM if provider == "groq" else 15
-    est_rem   = max(0, tpd_limit - tot)
-    pct       = min(100, int(tot / tpd_limit * 100))
-
-    last_ts   = s.get("last_call_ts")
-    rpm_wait  = max(0, int(60 - (time.time() - last_ts))) if last_ts else 0
+    # Limiti e consumo del PROCESSO (quota condivisa da tutte le sessioni): scheduler
+    use       = _rate_scheduler().usage("groq" if provider == "groq" else "gemini", model_lbl)
+    tpd_limit = use["tpd"]
+    rpm_limit = use["rpm"]
+    est_rem   = max(0, tpd_limit - use["tpd_used"])
+    pct       = min(100, int(use["tpd_used"] / tpd_limit * 100))
+
+    rpm_wait  = int(use["wait_s"] + 0.999)
     color     = "#43e97b" if pct < 60 else "#f7971e" if pct < 85 else "#e74c3c"
     rate_txt  = f"⏱️ {rpm_wait}s" if rpm_wait > 0 else "✅ ok"
+    if use["queued"]:
+        rate_txt += f" · {use['queued']} in coda"
+    queue_txt = (f"⏳ coda {s['queue_last']:.1f}s · media {s['queue_sum'] / s['queue_n']:.1f}s<br>"
+                 if s.get("queue_n") else "")
     prov_icon = "🟡 Groq" if provider == "groq" else "🔵 Gemini"
     reset_hour= "09:00" if provider == "groq" else "09:00"  # entrambi mezzanotte PT
+    ttft_txt  = (f"⚡ 1° token {s['last_ttft']:.1f}s · media {s['ttft_sum'] / s['ttft_n']:.1f}s<br>"
+                 if s.get("ttft_n") else "")
+    if s.get("cache_hits"):
+        badge = ('<span style="background:#43e97b;color:#000;border-radius:4px;'
+                 'padding:0 4px;font-weight:600;">💾 cached</span> ' if s.get("last_cached") else "💾 ")
+        cache_txt = (f"{badge}{s['cache_hits']} dalla cache · "
+                     f"~{s.get('cache_saved', 0):,} token risparmiati<br>")
+    else:
+        cache_txt = ""
 
     st.sidebar.markdown(
         f"""<div style="font-size:0.71rem; padding:6px 10px; margin:4px 0;
             background:rgba(0,0,0,0.2); border-radius:8px;
             border-left:3px solid {color};">
-        <b>📊 Token</b> — <span style="color:{color}"><b>{pct}%</b></span> usato<br>
-        ✉️ {tot:,} usati · ~{est_rem:,} rimanenti<br>
+        <b>📊 Token</b> — <span style="color:{color}"><b>{pct}%</b></span> usato (24h, tutte le sessioni)<br>
+        ✉️ {use["tpd_used"]:,} usati · ~{est_rem:,} rimanenti · sessione {tot:,}<br>
         🤖 {prov_icon} · {model_lbl.split("-")[0] if model_lbl else "—"}<br>
         📞 {s["session_calls"]} chiamate · Rate: {rate_txt}<br>
-        <span style="opacity:0.55;font-size:0.63rem;">
-        Stima sessione · Reset: {reset_hour} IT · Limite: {rpm_limit} req/min
+        {ttft_txt}{queue_txt}{cache_txt}        <span style="opacity:0.55;font-size:0.63rem;">
+        Stima processo · Reset: {reset_hour} IT · Limite: {rpm_limit} req/min · {use["tpm"]:,} token/min
         </span></div>""",
         unsafe_allow_html=True,
     )
 
 
-def render_ai_assistant(context_df: pd.DataFrame = None, context_label: str = ""):
+# ── AI IN BACKGROUND ────────────────────────────────────────────────────
+# Prima _call_ai (con retry, coda dello scheduler e gTTS) girava nel thread dello
+# script: la pagina restava congelata fino alla risposta. Ora ogni domanda è un
+# _AiJob che attraversa tre stadi su pool dedicati — trascrizione (Whisper) →
+# risposta (LLM) → voce (gTTS) — così gli stadi di domande diverse si sovrappongono
+# e lo script finisce subito. Un frammento con run_every legge il job (fase e
+# testo parziale) e, a job concluso, lo consegna alla sessione con un rerun.
+# Voce: mentre Whisper trascrive, il contesto si prepara in parallelo (pool "ctx");
+# con la lettura ad alta voce le frasi complete vanno a gTTS mentre il modello
+# scrive le successive. I tempi per stadio finiscono in "ai_latency_log".
+# I worker non toccano MAI st.*: session_state è della sessione e va letto/scritto
+# nel thread dello script. Le poche letture/scritture della catena AI passano da
+# _ai_session(), che nei worker punta al dict del job (fuso alla consegna).
+_AI_STAGE_WORKERS = {"stt": 2, "ctx": 2, "llm": 4, "tts": 4}   # thread per stadio (processo)
+_AI_STAGE_LABELS  = {"stt": "🎤 Trascrizione", "llm": "🤖 Elaborazione", "tts": "🔊 Sintesi vocale"}
+_AI_POLL_S        = 0.5                                # intervallo di polling del frammento
+_AI_LATENCY_LOG_SIZE = 30                              # job tenuti in session_state["ai_latency_log"]
+
+_AI_THREAD = threading.local()
+
+
+def _ai_session():
+    """session_state nel thread dello script; nei worker AI lo stato privato del job."""
+    state = getattr(_AI_THREAD, "state", None)
+    return st.session_state if state is None else state
+
+
+@st.cache_resource(show_spinner=False)
+def _ai_pools() -> dict:
+    """Un ThreadPoolExecutor per stadio, condiviso da tutte le sessioni del processo."""
+    return {stage: concurrent.futures.ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"ai-{stage}")
+            for stage, n in _AI_STAGE_WORKERS.items()}
+
+
+class _AiJob:
+    """
+    Una domanda AI in elaborazione. I worker scrivono solo qui (fase, testo
+    parziale, risultato); done segnala la fine della pipeline.
+    """
+
+    def __init__(self, question: str, audio_bytes: bytes, speak: bool, history: list,
+                 context_df: pd.DataFrame, context_label: str, context_fp: str,
+                 client, provider: str, model_name: str, cache_key: str = None):
+        self.question, self.audio_bytes, self.speak = question, audio_bytes, speak
+        self.history = history
+        self.context_df, self.context_label, self.context_fp = context_df, context_label, context_fp
+        self.client, self.provider, self.model_name = client, provider, model_name
+        self.cache_key = cache_key
+        # Unica parte di session_state letta dai worker (copiata qui, nel thread dello script)
+        self.state = {"ai_chars_per_token": dict(st.session_state.get("ai_chars_per_token", {}))}
+        self.stage      = ""
+        self.partial    = ""
+        self.transcript = None
+        self.answer = self.err_msg = self.audio_out = self.ttft = None
+        self.in_tok = self.out_tok = self.sent_chars = 0
+        self.prov_used, self.mod_used = provider, model_name
+        self.context_text = ""
+        self.cached = False
+        self.pools       = None   # pool degli stadi (_submit_ai_job)
+        self.ctx_future  = None   # contesto preparato in parallelo alla trascrizione
+        self.tts_futures = {}     # frase → Future di _tts_clip avviata durante lo streaming
+        self.timings     = {}     # stadio → secondi (log latenza)
+        self.t0   = time.time()
+        self.done = threading.Event()
+
+    def show(self, text: str) -> None:
+        """
+        on_update dello streaming: il frammento di polling mostra l'ultimo testo;
+        con la lettura ad alta voce le frasi già complete partono subito verso gTTS.
+        """
+        self.partial = text
+        if self.speak and self.pools is not None:
+            for sentence in _tts_sentences(text)[:-1]:   # l'ultima può essere ancora a metà
+                if sentence not in self.tts_futures:
+                    self.tts_futures[sentence] = self.pools["tts"].submit(_tts_clip, sentence)
+
+
+def _ai_prepare_context(job: _AiJob) -> str:
+    """Contesto per il function-calling (non dipende dalla domanda): parte con la trascrizione."""
+    t = time.perf_counter()
+    try:
+        return _tool_context(job.context_df, job.context_label)
+    finally:
+        job.timings["contesto"] = time.perf_counter() - t
+
+
+def _ai_stage_stt(job: _AiJob):
+    """
+    Stadio 1 (solo Groq + voce): trascrizione Whisper → la domanda diventa testo.
+    In parallelo (pool "ctx") si prepara il contesto schema + totali dei tool.
+    """
+    df = job.context_df
+    if df is not None and not df.empty:
+        job.ctx_future = job.pools["ctx"].submit(_ai_prepare_context, job)
+    job.transcript = _transcribe_audio_groq(job.client, job.audio_bytes)
+    return "llm"
+
+
+def _ai_stage_llm(job: _AiJob):
+    """
+    Stadio 2: risposta. Groq con function-calling sul query engine locale
+    (contesto = schema + totali); se fallisce non per quota, contesto pre-calcolato.
+    """
+    question = job.transcript or job.question or ""
+    prefix   = f"[Domanda vocale trascritta]: {job.transcript}\n\n" if job.transcript else ""
+    audio    = None if job.transcript else job.audio_bytes   # Gemini: audio inline
+    df       = job.context_df
+    use_tools = job.provider == "groq" and df is not None and not df.empty
+    answer, err_msg = None, None
+    if use_tools:
+        job.context_text = (job.ctx_future.result() if job.ctx_future is not None
+                            else _ai_prepare_context(job))
+        prompt_txt = prefix + (job.question or "") + job.context_text
+        stream = _StreamDedup(on_update=job.show)
+        answer, in_tok, out_tok, err_msg, prov_used, mod_used = _call_ai(
+            job.client, job.provider, job.model_name, job.history, prompt_txt,
+            audio_bytes=audio, tool_df=df, tool_label=job.context_label,
+            tool_fp=job.context_fp or _frame_fingerprint(df), stream=stream
+        )
+    is_quota = any(x in (err_msg or "") for x in ["429", "rate_limit", "quota"])
+    if not answer and not is_quota:
+        use_tools = False
+        t = time.perf_counter()
+        job.context_text = _build_compact_context(df, job.context_label,
+                                                  fingerprint=job.context_fp,
+                                                  model_name=job.model_name, question=question)
+        job.timings["contesto"] = job.timings.get("contesto", 0.0) + time.perf_counter() - t
+        prompt_txt = prefix + (job.question or "") + job.context_text
+        stream = _StreamDedup(on_update=job.show)
+        answer, in_tok, out_tok, err_msg, prov_used, mod_used = _call_ai(
+            job.client, job.provider, job.model_name, job.history, prompt_txt,
+            audio_bytes=audio, stream=stream
+        )
+    job.answer, job.err_msg = answer, err_msg
+    job.in_tok, job.out_tok, job.prov_used, job.mod_used = in_tok, out_tok, prov_used, mod_used
+    job.ttft = stream.ttft
+    # Caratteri inviati (system + storico + domanda/contesto) per tarare i char/token;
+    # con audio inline il prompt reale è diverso, con i tool include schemi e
+    # risultati delle query → niente taratura
+    job.sent_chars = 0 if (audio or use_tools) else (
+        len(_AI_SYSTEM_PROMPT) + sum(len(m["text"] or "") for m in job.history) + len(prompt_txt))
+    return "tts" if answer and job.speak else None
+
+
+def _ai_stage_tts(job: _AiJob):
+    """
+    Stadio 3 (opzionale): risposta letta ad alta voce. Le frasi sintetizzate durante
+    lo streaming si riusano; qui restano solo le ultime (o quelle cambiate dalla deduplica).
+    """
+    job.audio_out = _tts_audio(job.answer, pending=job.tts_futures)
+    return None
+
+
+_AI_STAGES = {"stt": _ai_stage_stt, "llm": _ai_stage_llm, "tts": _ai_stage_tts}
+
+
+def _ai_run_stage(job: _AiJob, stage: str, pools: dict) -> None:
+    """Esegue uno stadio nel suo pool e accoda il successivo (o chiude il job)."""
+    _AI_THREAD.state = job.state
+    t = time.perf_counter()
+    try:
+        nxt = _AI_STAGES[stage](job)
+    except Exception as e:
+        job.err_msg, nxt = job.err_msg or f"{type(e).__name__}: {e}", None
+    finally:
+        _AI_THREAD.state = None
+        job.timings[stage] = time.perf_counter() - t
+    if nxt:
+        job.stage = _AI_STAGE_LABELS[nxt]
+        pools[nxt].submit(_ai_run_stage, job, nxt, pools)
+    else:
+        job.timings["totale"] = time.time() - job.t0
+        job.done.set()
+
+
+def _submit_ai_job(job: _AiJob) -> None:
+    """Mette il job in session_state e lo avvia dal primo stadio utile."""
+    if job.answer is not None:          # risposta già nota (cache): resta solo la voce
+        first = "tts"
+    elif job.audio_bytes and job.provider == "groq":
+        first = "stt"
+    else:
+        first = "llm"
+    job.stage = _AI_STAGE_LABELS[first]
+    st.session_state["ai_job"] = job
+    job.pools = pools = _ai_pools()
+    pools[first].submit(_ai_run_stage, job, first, pools)
+
+
+def _deliver_ai_job(job: _AiJob) -> None:
+    """Nel thread dello script: fonde stato e statistiche del job nella sessione."""
+    st.session_state.pop("ai_job", None)
+    _log_ai_latency(job)
+    log = job.state.get("ai_query_log")
+    if log:
+        merged = st.session_state.setdefault("ai_query_log", [])
+        merged.extend(log)
+        del merged[:-_TOOL_LOG_SIZE]
+    if not job.answer:
+        st.session_state["ai_error"] = {
+            "err": job.err_msg, "provider": job.prov_used, "model": job.mod_used,
+            "ctx_size": len(job.context_text),
+        }
+        return
+    if not job.cached:
+        _update_token_stats(job.in_tok, job.out_tok, job.prov_used, job.mod_used,
+                            sent_chars=job.sent_chars, ttft=job.ttft,
+                            queue_wait=job.state.get("ai_queue_wait"))
+        # Salva provider realmente usato (per badge)
+        st.session_state["ai_last_provider"] = job.prov_used
+        st.session_state["ai_last_model"]    = job.mod_used
+        if job.cache_key:
+            _answer_cache().put(job.cache_key, {"question": job.question, "answer": job.answer,
+                                                "in_tok": job.in_tok, "out_tok": job.out_tok,
+                                                "provider": job.prov_used, "model": job.mod_used})
+    voice = job.audio_bytes is not None
+    display_q = f"[🎤 Vocale] {job.transcript or job.question or ''}" if voice else job.question
+    st.session_state["ai_chat_history"].append(
+        {"role": "user",  "text": display_q, "voice": voice}
+    )
+    st.session_state["ai_chat_history"].append(
+        {"role": "model", "text": job.answer, "audio_bytes": job.audio_out, "cached": job.cached}
+    )
+
+
+def _log_ai_latency(job: _AiJob) -> None:
+    """Tempi per stadio del job (s) in session_state["ai_latency_log"] → diagnostica."""
+    t   = job.timings
+    sec = lambda k: round(t[k], 2) if k in t else None
+    log = st.session_state.setdefault("ai_latency_log", [])
+    log.append({
+        "ora": datetime.datetime.fromtimestamp(job.t0).strftime("%H:%M:%S"),
+        "tipo": "🎤 voce" if job.audio_bytes is not None else "⌨️ testo",
+        "coda": round(job.state.get("ai_queue_wait", 0.0), 2),
+        "trascrizione": sec("stt"), "contesto": sec("contesto"),
+        "1° token": round(job.ttft, 2) if job.ttft is not None else None,
+        "risposta": sec("llm"), "sintesi": sec("tts"),
+        "frasi pre-sintetizzate": len(job.tts_futures) if job.speak else None,
+        "totale": sec("totale"), "esito": "ok" if job.answer else "errore",
+    })
+    del log[:-_AI_LATENCY_LOG_SIZE]
+
+
+@st.fragment(run_every=_AI_POLL_S)
+def _render_ai_job() -> None:
+    """Polling del job della sessione: fase e testo parziale; a fine job consegna + rerun."""
+    job = st.session_state.get("ai_job")
+    if job is None:
+        return
+    if job.done.is_set():
+        _deliver_ai_job(job)
+        st.rerun()
+    st.caption(f"{job.stage}… {time.time() - job.t0:.0f}s — puoi continuare a usare la dashboard")
+    if job.partial:
+        st.markdown(job.partial)
+
+
+def render_ai_assistant(context_df: pd.DataFrame = None, context_label: str = "",
+                        context_fp: str = None):
     """AI Data Assistant: Groq (free) + voce Whisper + output TTS."""
     st.sidebar.markdown("### 💬 AI Data Assistant")
 
@@ -1805,6 +4475,24 @@ def render_ai_assistant(context_df: pd.DataFrame = None, context_label: str = ""
                 "💡 Se vedi Gemini invece di Groq: controlla che groq_api_key "
                 "sia PRIMA di [google_cloud] nel file Secrets."
             )
+            sched = _rate_scheduler()
+            if sched.models():
+                st.caption("📶 Limiti condivisi dal processo (token bucket):")
+                st.dataframe(pd.DataFrame([
+                    {"modello": f"{p} · {m}", "req/min": f"{u['rpm_used']}/{u['rpm']}",
+                     "token/min": f"{u['tpm_used']:,}/{u['tpm']:,}",
+                     "token/24h": f"{u['tpd_used']:,}/{u['tpd']:,}",
+                     "attesa s": round(u["wait_s"], 1)}
+                    for p, m in sched.models() for u in [sched.usage(p, m)]
+                ]), hide_index=True, width='stretch')
+            if st.session_state.get("ai_latency_log"):
+                st.caption("⏱️ Latenza per stadio delle ultime domande (s, più recenti in alto):")
+                st.dataframe(pd.DataFrame(st.session_state["ai_latency_log"][::-1]),
+                             hide_index=True, width='stretch')
+            if st.session_state.get("ai_query_log"):
+                st.caption("🧮 Query locali chiamate dall'AI (più recenti in alto):")
+                st.dataframe(pd.DataFrame(st.session_state["ai_query_log"][::-1]),
+                             hide_index=True, width='stretch')
     else:
         st.sidebar.error("⚙️ AI non configurata — leggi la diagnostica:")
         with st.sidebar.expander("🔍 Diagnostica AI", expanded=True):
@@ -1824,7 +4512,8 @@ def render_ai_assistant(context_df: pd.DataFrame = None, context_label: str = ""
                         unsafe_allow_html=True
                     )
                 else:
-                    st.markdown("🤖 **Risposta:**")
+                    st.markdown("🤖 **Risposta:** `💾 cache`" if msg.get("cached")
+                                else "🤖 **Risposta:**")
                     st.markdown(msg["text"])
                     if msg.get("audio_bytes"):
                         st.audio(msg["audio_bytes"], format="audio/mp3", autoplay=False)
@@ -1854,9 +4543,46 @@ def render_ai_assistant(context_df: pd.DataFrame = None, context_label: str = ""
                                    value=st.session_state.get("ai_speak", False),
                                    key="ai_speak_cb")
         st.session_state["ai_speak"] = speak_answer
+        use_cache = st.checkbox("💾 Riusa risposte già date (stessi dati e filtri)",
+                                value=st.session_state.get("ai_use_cache", True),
+                                key="ai_use_cache_cb",
+                                help="Domande uguali sullo stesso periodo/entità: risposta "
+                                     "immediata, zero token. Disattiva per forzarne una nuova.")
+        st.session_state["ai_use_cache"] = use_cache
+        if len(_answer_cache()) and st.button(f"🗑️ Svuota cache risposte ({len(_answer_cache())})",
+                                              key="clear_ai_cache"):
+            _answer_cache().clear()
+
+    # ── Risposta in elaborazione / ultimo errore ───────────────────
+    # Il job gira nei pool AI: qui solo il frammento di polling (attivo finché c'è
+    # un job), il resto della pagina si disegna e resta usabile
+    busy = "ai_job" in st.session_state
+    if busy:
+        with st.sidebar:
+            _render_ai_job()
+    ai_error = st.session_state.pop("ai_error", None)
+    if ai_error:
+        is_quota = any(x in (ai_error["err"] or "") for x in ["429", "rate_limit", "quota"])
+        if is_quota:
+            st.sidebar.warning(
+                f"⚠️ **Quota esaurita ({ai_error['provider']}).**\n\n"
+                "Reset: ore **09:00 IT** (inverno) / 10:00 IT (estate).\n\n"
+                "**Ora puoi:**\n"
+                "1. Attendere 1 minuto (rolling window 60s)\n"
+                "2. Filtrare i dati a meno righe\n"
+                "3. Monitorare: console.groq.com/usage"
+            )
+        else:
+            # Mostra errore con provider, modello e dimensione contesto
+            st.sidebar.error(
+                f"❌ Errore AI [{ai_error['provider']} / {ai_error['model']}]: {ai_error['err']}\n\n"
+                f"📐 Contesto: {ai_error['ctx_size']:,} chars | "
+                f"Suggerimento: riduci il periodo o filtra i dati."
+            )
 
     # ── Input testo ─────────────────────────────────────────────────
-    user_text = st.sidebar.chat_input("Scrivi domanda...", key="ai_chat_input")
+    user_text = st.sidebar.chat_input("Risposta in arrivo..." if busy else "Scrivi domanda...",
+                                      key="ai_chat_input", disabled=busy)
 
     # ── Input vocale ────────────────────────────────────────────────
     audio_rec = None
@@ -1870,67 +4596,50 @@ def render_ai_assistant(context_df: pd.DataFrame = None, context_label: str = ""
     # ── Processa ────────────────────────────────────────────────────
     audio_bytes = None
     voice_mode  = False
-    if audio_rec is not None:
+    # La registrazione resta nel widget a ogni rerun: si invia una volta sola
+    if audio_rec is not None and st.session_state.get("ai_voice_sent") != audio_rec.file_id:
+        st.session_state["ai_voice_sent"] = audio_rec.file_id
         audio_bytes = audio_rec.read()
         voice_mode  = True
         user_text   = user_text or ""
 
     if not (user_text or audio_bytes):
         return
+    if busy:
+        st.sidebar.info("⏳ Attendi la risposta alla domanda precedente.")
+        return
+
+    # Cache risposte: solo domande scritte (la vocale si conosce dopo la trascrizione)
+    cache_key = None if voice_mode else _answer_cache_key(
+        user_text, context_fp or _frame_fingerprint(context_df), context_label)
+    cached = _answer_cache().get(cache_key) if cache_key and use_cache else None
+    if cached:
+        _record_cache_hit(cached)
+        if not st.session_state.get("ai_speak"):
+            st.session_state["ai_chat_history"].append(
+                {"role": "user", "text": user_text, "voice": False})
+            st.session_state["ai_chat_history"].append(
+                {"role": "model", "text": cached["answer"], "audio_bytes": None, "cached": True})
+            st.rerun()
 
     client, provider, model_name, err, diag = _get_ai_client()
-    if client is None:
+    if client is None and not cached:
         st.sidebar.warning(f"⚠️ AI non configurata\n\n{err}")
         with st.sidebar.expander("🔍 Diagnostica AI", expanded=True):
             st.code(diag, language=None)
         return
 
-    context_text = _build_compact_context(context_df, context_label)
     history = [{"role": m["role"], "text": m["text"]}
                for m in st.session_state["ai_chat_history"]]
-    prompt_txt = (user_text or "") + context_text
-
-    with st.sidebar, st.spinner("🤖 Elaborazione in corso..."):
-        answer, in_tok, out_tok, err_msg, prov_used, mod_used = _call_ai(
-            client, provider, model_name,
-            history, prompt_txt, audio_bytes=audio_bytes
-        )
-
-    if answer:
-        _update_token_stats(in_tok, out_tok, prov_used, mod_used)
-        # Salva provider realmente usato (per badge)
-        st.session_state["ai_last_provider"] = prov_used
-        st.session_state["ai_last_model"]    = mod_used
-        audio_out = _tts_audio(answer) if st.session_state.get("ai_speak") else None
-        display_q = f"[🎤 Vocale] {user_text or ''}" if voice_mode else user_text
-        st.session_state["ai_chat_history"].append(
-            {"role": "user",  "text": display_q, "voice": voice_mode}
-        )
-        st.session_state["ai_chat_history"].append(
-            {"role": "model", "text": answer, "audio_bytes": audio_out}
-        )
-        st.rerun()
-    else:
-        is_quota = any(x in (err_msg or "") for x in ["429", "rate_limit", "quota"])
-        if is_quota:
-            st.sidebar.warning(
-                f"⚠️ **Quota esaurita ({prov_used}).**\n\n"
-                "Reset: ore **09:00 IT** (inverno) / 10:00 IT (estate).\n\n"
-                "**Ora puoi:**\n"
-                "1. Attendere 1 minuto (rolling window 60s)\n"
-                "2. Filtrare i dati a meno righe\n"
-                "3. Monitorare: console.groq.com/usage"
-            )
-        else:
-            # Mostra errore con provider, modello e dimensione contesto
-            ctx_size = len(context_text) if 'context_text' in dir() else 0
-            st.sidebar.error(
-                f"❌ Errore AI [{prov_used} / {mod_used}]: {err_msg}\n\n"
-                f"📐 Contesto: {ctx_size:,} chars | "
-                f"Suggerimento: riduci il periodo o filtra i dati."
-            )
-
-
+    job = _AiJob(user_text, audio_bytes, bool(st.session_state.get("ai_speak")), history,
+                 context_df, context_label, context_fp, client, provider, model_name,
+                 cache_key=cache_key)
+    if cached:   # risposta dalla cache, in background resta solo la sintesi vocale
+        job.answer, job.cached = cached["answer"], True
+    _submit_ai_job(job)
+    # Lo script non attende: il frammento mostra l'avanzamento e consegna la risposta
+    with st.sidebar:
+        _render_ai_job()
 
 
 # ==========================================================================
@@ -1952,8 +4661,13 @@ if st.sidebar.button("🔄 Forza Aggiornamento Dati",
                      help="Ricarica tutti i dati da Google Drive e svuota la cache locale",
                      use_container_width=True):
     st.cache_data.clear()
+    load_clean_dataset.clear()
+    _snapshot_purge()   # anche gli snapshot su disco, altrimenti nessun nuovo download
+    if _DriveWatcher._current is not None:
+        _DriveWatcher._current.refresh()   # elenco file riletto subito (non al prossimo giro)
     # Rimuovi anche i df in session_state per forzare il reload
-    for _k in [k for k in st.session_state if k.startswith(('df_', 'promo_', 'sales_'))]:
+    for _k in [k for k in st.session_state
+               if k.startswith(('df_', 'promo_', 'sales_', 'ai_context_'))]:
         del st.session_state[_k]
     st.rerun()
 st.sidebar.markdown("---")
@@ -2002,32 +4716,37 @@ st.sidebar.markdown("---")
 # ── PRE-CARICAMENTO CONTESTO AI ─────────────────────────────────────────
 # CRITICO: il contesto deve essere aggiornato SUL RENDER CORRENTE,
 # non sul precedente. Carichiamo il file vendite PRIMA di render_ai_assistant.
-# load_dataset e smart_analyze_and_clean sono @st.cache_data → zero overhead.
+# load_clean_dataset è @st.cache_data (+ snapshot su disco) → zero overhead.
 files, drive_error = get_drive_files_list()
 if drive_error:
     st.sidebar.error(f"Errore Drive: {drive_error}")
 
 _df_sales_global = None   # df vendite filtrato+classificato, condiviso da AI e donut
+_df_sales_global_fp = None
 _periodo_g = f" | Periodo: {G_START.strftime('%d/%m/%Y')} – {G_END.strftime('%d/%m/%Y')}"
 
 # ── CARICAMENTO PRE-RENDER del file vendite (cached) ─────────────────────
 # Necessario per: (a) selettore Entity globale, (b) contesto AI corretto
 _df_proc_pre = None
+_df_proc_pre_fp = None
+_df_proc_pre_src = None
 _entity_col_pre = None
 if files:
-    _sales_key_pre = next(
-        (f for f in files if "from_order_to_invoice" in f.get('name','').lower()), None
-    )
+    _sales_key_pre = files.default_file("Sales")
     if _sales_key_pre:
         try:
-            _df_raw_pre  = load_dataset(_sales_key_pre['id'], _sales_key_pre['modifiedTime'])
-            if _df_raw_pre is not None:
-                _df_proc_pre = smart_analyze_and_clean(_df_raw_pre, "Sales")
-                if _df_proc_pre is not None:
-                    _entity_col_pre = next(
-                        (c for c in ['Entity', 'Società', 'Company', 'Division', 'Azienda']
-                         if c in _df_proc_pre.columns), None
-                    )
+            _df_proc_pre = load_clean_dataset(
+                _sales_key_pre['id'], _sales_key_pre['modifiedTime'], "Sales"
+            )
+            _df_proc_pre_fp = _fingerprint(
+                _sales_key_pre['id'], _sales_key_pre['modifiedTime'], "Sales"
+            )
+            _df_proc_pre_src = (_sales_key_pre['id'], _sales_key_pre['modifiedTime'], "Sales")
+            if _df_proc_pre is not None:
+                _entity_col_pre = next(
+                    (c for c in ['Entity', 'Società', 'Company', 'Division', 'Azienda']
+                     if c in _df_proc_pre.columns), None
+                )
         except Exception:
             _df_proc_pre = None
 
@@ -2038,7 +4757,7 @@ if files:
 # e se il campo Entity aveva valori diversi, scattava il fallback su tutti i dati.
 _g_entity = st.session_state.get("global_entity", "EITA")
 if _df_proc_pre is not None and _entity_col_pre:
-    _all_entities = sorted(_df_proc_pre[_entity_col_pre].dropna().astype(str).unique())
+    _all_entities = _str_unique(_df_proc_pre[_entity_col_pre])
     if _all_entities:
         _def_ent_idx = _all_entities.index(_g_entity) if _g_entity in _all_entities else 0
         _g_entity = st.sidebar.selectbox(
@@ -2055,8 +4774,10 @@ else:
 # ── FILTRO CON ENTITY SELEZIONATA (no fallback a tutti i dati) ───────────
 if _df_proc_pre is not None:
     _df_sales_global = _filtra_vendite_periodo(
-        _df_proc_pre, G_START, G_END, entity=_g_entity
+        _df_proc_pre, G_START, G_END, entity=_g_entity, src=_df_proc_pre_src
     )
+    _df_sales_global_fp = _fingerprint(_df_proc_pre_fp, "vendite_periodo",
+                                       G_START, G_END, _g_entity)
     if _df_sales_global.empty:
         # Entità non trovata — segnala ma non espande a tutti i dati
         st.sidebar.warning(f"⚠️ Nessun dato per entità '{_g_entity}' nel periodo selezionato.")
@@ -2065,16 +4786,22 @@ if _df_proc_pre is not None:
 # Aggiorna il contesto AI con i dati corretti DEL RENDER CORRENTE
 if _df_sales_global is not None and not _df_sales_global.empty:
     # Imposta solo se non è già stato aggiornato da una pagina (es. Page 1 usa df_global)
-    # Page 1 aggiornerà ai_context_df con df_global (filtrato per data corretta) → NON sovrascrivere
-    # Solo il pre-load iniziale (prima che Page 1 giri) usa questo valore come default.
-    if st.session_state.get("ai_context_df") is None:
-        st.session_state["ai_context_df"] = _df_sales_global
+    # Page 1 aggiornerà ai_context_view con df_global (filtrato per data corretta) → NON sovrascrivere
+    # Solo il pre-load iniziale (prima che Page 1 giri) usa questo valore come default,
+    # o quando la vista salvata punta a una versione del file non più su Drive.
+    _ai_view = st.session_state.get("ai_context_view")
+    _live_src = {(f['id'], f['modifiedTime']) for f in (files or [])}
+    if _ai_view is None or tuple(_ai_view["src"][:2]) not in _live_src:
+        st.session_state["ai_context_view"] = _view_spec(_df_proc_pre_src, _df_sales_global)
+        st.session_state["ai_context_fp"] = _df_sales_global_fp
     st.session_state["ai_context_label"] = f"Vendite {_g_entity}{_periodo_g}"
 
 # AI Assistant — ora legge il contesto AGGIORNATO
-_ai_ctx_df    = st.session_state.get("ai_context_df",    None)
+_ai_ctx_df    = _resolve_view(st.session_state.get("ai_context_view"))
 _ai_ctx_label = st.session_state.get("ai_context_label", "Dati correnti")
-render_ai_assistant(context_df=_ai_ctx_df, context_label=_ai_ctx_label)
+_ai_ctx_fp    = st.session_state.get("ai_context_fp",    None)
+render_ai_assistant(context_df=_ai_ctx_df, context_label=_ai_ctx_label, context_fp=_ai_ctx_fp)
+_render_data_diagnostics(files)
 
 st.sidebar.markdown("---")
 
@@ -2086,18 +4813,16 @@ if page == "📊 Vendite & Fatturazione":
     df_processed = None
 
     if files:
-        file_map      = {f['name']: f for f in files}
-        file_list     = list(file_map.keys())
-        default_index = next(
-            (i for i, n in enumerate(file_list) if "from_order_to_invoice" in n.lower()), 0
-        )
+        file_map      = files.by_name
+        file_list     = files.names
+        default_index = files.default_pos("Sales")
         sel_file_name     = st.sidebar.selectbox("1. Sorgente Dati", file_list, index=default_index)
         selected_file_obj = file_map[sel_file_name]
 
         with st.spinner('Loading Sales Data...'):
-            df_raw = load_dataset(selected_file_obj['id'], selected_file_obj['modifiedTime'])
-            if df_raw is not None:
-                df_processed = smart_analyze_and_clean(df_raw, "Sales")
+            df_processed = load_clean_dataset(
+                selected_file_obj['id'], selected_file_obj['modifiedTime'], "Sales"
+            )
     else:
         st.error("Nessun file trovato su Google Drive.")
 
@@ -2116,21 +4841,21 @@ if page == "📊 Vendite & Fatturazione":
             col_data     = st.selectbox("Data Riferimento",      all_cols, index=set_idx(guesses['date'],         all_cols))
 
         st.sidebar.markdown("### 🔍 Filtri Rapidi")
-        df_global = df_processed.copy()
+        df_global = df_processed   # condiviso: i filtri sotto creano nuovi oggetti
         sel_ent   = None
 
         # Entity filtrata dal selettore globale (_g_entity), non più da widget locale
         sel_ent = _g_entity
         if col_entity and col_entity in df_global.columns:
-            df_global = df_global[df_global[col_entity].astype(str) == sel_ent]
+            df_global = df_global[_str_eq(df_global[col_entity], sel_ent)]
 
         if col_data and pd.api.types.is_datetime64_any_dtype(df_global[col_data]):
             # Usa il selettore data GLOBALE dalla sidebar (G_START / G_END)
             d_start, d_end = G_START, G_END
-            df_global = df_global[
-                (df_global[col_data].dt.date >= d_start) &
-                (df_global[col_data].dt.date <= d_end)
-            ]
+            df_global = _filter_period(
+                df_global, col_data, d_start, d_end, base=df_processed,
+                src=(selected_file_obj['id'], selected_file_obj['modifiedTime'], "Sales")
+            )
 
         # FIX: filtri avanzati ora EFFETTIVAMENTE gated dal pulsante Submit.
         # Problema originale: active_filters veniva popolato in ogni render
@@ -2157,7 +4882,27 @@ if page == "📊 Vendite & Fatturazione":
         active_filters = st.session_state.get('sales_adv_filters', {})
         for f_col, vals in active_filters.items():
             if f_col in df_global.columns:
-                df_global = df_global[df_global[f_col].astype(str).isin(vals)]
+                df_global = df_global[_str_isin(df_global[f_col], vals)]
+        # Fingerprint = file + mappatura colonne + filtri applicati (chiave delle cache a valle)
+        df_global_fp = _fingerprint(
+            selected_file_obj['id'], selected_file_obj['modifiedTime'], "Sales",
+            {"entity": [col_entity, sel_ent], "date": [col_data, G_START, G_END],
+             "adv": active_filters}
+        )
+
+        # ── CUBO: KPI, grafici e tabelle aggregate leggono da df_agg ───────────
+        # df_agg = cubo filtrato (O(gruppi)); se la mappatura o i filtri avanzati
+        # non sono coperti dal cubo → df_global (righe grezze, stesse colonne).
+        df_agg = None
+        if col_data and pd.api.types.is_datetime64_any_dtype(df_processed[col_data]):
+            df_agg = _sales_cube_view(
+                df_processed, (selected_file_obj['id'], selected_file_obj['modifiedTime'], "Sales"),
+                col_entity if col_entity in df_processed.columns else None, col_data,
+                col_customer, col_prod, (col_euro, col_kg, col_cartons, col_cartons_del),
+                sel_ent, G_START, G_END, active_filters,
+            )
+        if df_agg is None:
+            df_agg = df_global
 
         # --- Salva / Carica Settings Vendite ---
         with st.sidebar.expander("💾 Impostazioni Sessione", expanded=False):
@@ -2203,22 +4948,27 @@ if page == "📊 Vendite & Fatturazione":
         except Exception:
             _periodo_sales = _periodo_g
         if not df_global.empty:
-            st.session_state["ai_context_df"]    = df_global
+            st.session_state["ai_context_view"]  = _view_spec(
+                (selected_file_obj['id'], selected_file_obj['modifiedTime'], "Sales"), df_global)
+            st.session_state["ai_context_fp"]    = df_global_fp
         st.session_state["ai_context_label"] = f"Vendite {_g_entity}{_periodo_sales}"
 
         if not df_global.empty:
-            tot_euro    = df_global[col_euro].sum()
-            tot_kg      = df_global[col_kg].sum()
+            tot_euro    = df_agg[col_euro].sum()
+            tot_kg      = df_agg[col_kg].sum()
             ord_num_col = next((c for c in df_global.columns if "Numero_Ordine" in c), None)
-            tot_orders  = df_global[ord_num_col].nunique() if ord_num_col else len(df_global)
-            top_c_data  = df_global.groupby(col_customer)[col_euro].sum().sort_values(ascending=False).head(1)
+            # nunique non è additivo → unico KPI calcolato sulle righe
+            tot_orders  = (df_global[ord_num_col].nunique() if ord_num_col
+                           else int(df_agg[_CUBE_ROWS].sum()) if _CUBE_ROWS in df_agg.columns
+                           else len(df_agg))
+            top_c_data  = df_agg.groupby(col_customer, observed=True)[col_euro].sum().sort_values(ascending=False).head(1)
             top_name    = top_c_data.index[0]  if not top_c_data.empty else "-"
             top_val     = top_c_data.values[0] if not top_c_data.empty else 0
             short_top   = (str(top_name)[:20] + "..") if len(str(top_name)) > 20 else str(top_name)
 
             # Livello di servizio: Cartoni Consegnati / Cartoni Ordinati
-            _s_ord = df_global[col_cartons].sum()     if col_cartons     and col_cartons     in df_global.columns else 0
-            _s_del = df_global[col_cartons_del].sum() if col_cartons_del and col_cartons_del in df_global.columns else 0
+            _s_ord = df_agg[col_cartons].sum()     if col_cartons     and col_cartons     in df_agg.columns else 0
+            _s_del = df_agg[col_cartons_del].sum() if col_cartons_del and col_cartons_del in df_agg.columns else 0
             svc_lv_s = min((_s_del / _s_ord * 100), 100) if _s_ord > 0 else None
             svc_lv_s_str = f"{svc_lv_s:.1f}%" if svc_lv_s is not None else "N/D"
 
@@ -2234,8 +4984,8 @@ if page == "📊 Vendite & Fatturazione":
             st.caption(f"📅 Colonna data: **{col_data}**")
             col_l, col_r = st.columns([1.2, 1.8], gap="large")
 
-            cust_totals      = df_global.groupby(col_customer)[col_euro].sum().sort_values(ascending=False)
-            total_val_period = df_global[col_euro].sum()
+            cust_totals      = df_agg.groupby(col_customer, observed=True)[col_euro].sum().sort_values(ascending=False)
+            total_val_period = df_agg[col_euro].sum()
             options          = ["🌍 TUTTI I CLIENTI"] + cust_totals.index.tolist()
 
             with col_l:
@@ -2246,8 +4996,10 @@ if page == "📊 Vendite & Fatturazione":
                         else f"{x} (€ {cust_totals[x]:,.0f})"
                     )
                 )
-                df_target = (df_global if "TUTTI" in sel_target
-                             else df_global[df_global[col_customer] == sel_target])
+                # df_target: cubo (o righe) del focus selezionato
+                df_target = (df_agg if "TUTTI" in sel_target
+                             else df_agg[df_agg[col_customer] == sel_target])
+                df_target_fp = _fingerprint(df_global_fp, col_customer, sel_target)
 
                 if not df_target.empty:
                     chart_type = st.radio(
@@ -2255,7 +5007,7 @@ if page == "📊 Vendite & Fatturazione":
                         horizontal=True
                     )
                     prod_agg = (
-                        df_target.groupby(col_prod)
+                        df_target.groupby(col_prod, observed=True)
                                  .agg({col_euro: 'sum', col_kg: 'sum', col_cartons: 'sum'})
                                  .reset_index()
                                  .sort_values(col_euro, ascending=False)
@@ -2380,7 +5132,7 @@ if page == "📊 Vendite & Fatturazione":
                             "Gerarchia:", ["Prodotto → Cliente", "Cliente → Prodotto"],
                             horizontal=True
                         )
-                        all_p_sorted    = df_target.groupby(col_prod)[col_euro].sum().sort_values(ascending=False)
+                        all_p_sorted    = df_target.groupby(col_prod, observed=True)[col_euro].sum().sort_values(ascending=False)
                         tot_euro_target = df_target[col_euro].sum()
                         prod_options    = ["TUTTI I PRODOTTI"] + all_p_sorted.index.tolist()
                         sel_p = st.multiselect(
@@ -2411,46 +5163,48 @@ if page == "📊 Vendite & Fatturazione":
                             'Valore Medio €/CT': st.column_config.NumberColumn("€/CT Med",format="€ %.2f"),
                         },
                         hide_index=True, height=500, width='stretch')
-                    st.download_button(
-                        "📥 Scarica Dettaglio Excel (.xlsx)",
-                        data=convert_df_to_excel(ps),
+                    _excel_download_button(
+                        "📥 Scarica Dettaglio Excel (.xlsx)", ps,
                         file_name=f"Dettaglio_{sel_target}_{datetime.date.today()}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="btn_download_single"
+                        key="btn_download_single",
+                        fingerprint=_fingerprint(
+                            df_target_fp, "dettaglio", col_prod, col_cartons, col_kg, col_euro),
                     )
 
             # ── SEZIONE DETTAGLIO — full width sotto le colonne ─────────────
-            if "TUTTI" in sel_target and (submit_btn or 'sales_raw_df' in st.session_state):
+            if "TUTTI" in sel_target and (submit_btn or 'sales_tree_filter' in st.session_state):
                 if submit_btn:
-                    df_ps = df_target.copy()
-                    if "TUTTI I PRODOTTI" not in sel_p:
-                        df_ps = df_ps[df_ps[col_prod].isin(sel_p)]
-                    if sel_c:
-                        df_ps = df_ps[df_ps[col_customer].astype(str).isin(sel_c)]
-                    st.session_state['sales_raw_df']     = df_ps
-                    st.session_state['sales_group_mode'] = group_mode
+                    # Solo i filtri: albero e righe si ricavano da cubo / df_global a ogni render
+                    st.session_state['sales_tree_filter'] = {"prod": sel_p, "cust": sel_c}
+                    st.session_state['sales_group_mode']  = group_mode
                     st.session_state.pop('drill_down_selector', None)
 
-                df_tree_raw   = st.session_state.get('sales_raw_df',    df_target)
+                _tree_flt     = st.session_state['sales_tree_filter']
+                df_tree_agg   = _tree_filter(df_target, col_prod, col_customer,
+                                             _tree_flt["prod"], _tree_flt["cust"])
+                df_tree_fp    = _fingerprint(df_target_fp, col_prod,
+                                             _tree_flt["prod"], _tree_flt["cust"])
                 mode          = st.session_state.get('sales_group_mode', "Prodotto → Cliente")
                 primary_col   = col_prod     if mode == "Prodotto → Cliente" else col_customer
                 secondary_col = col_customer if mode == "Prodotto → Cliente" else col_prod
+                _tree_fp      = _fingerprint(df_tree_fp, primary_col, secondary_col,
+                                             col_cartons, col_cartons_del, col_kg, col_euro)
 
                 st.divider()
                 master_df = build_agg_with_ratios(
-                    df_tree_raw, primary_col, col_cartons, col_kg, col_euro
+                    df_tree_agg, primary_col, col_cartons, col_kg, col_euro
                 )
                 master_df = _add_service_level(
-                    master_df, df_tree_raw, primary_col, col_cartons, col_cartons_del
+                    master_df, df_tree_agg, primary_col, col_cartons, col_cartons_del
                 )
 
                 # ── Mostra / Nascondi Colonne — Tabella Master ───────────────
                 _SVC_COL = '% Livello Servizio'
-                _has_svc = (col_cartons_del and col_cartons_del in df_tree_raw.columns
-                             and col_cartons in df_tree_raw.columns)
+                _has_svc = (col_cartons_del and col_cartons_del in df_global.columns
+                             and col_cartons in df_global.columns)
                 _master_agg_default   = list(master_df.columns)
                 # Solo nomi colonne sorgente (zero overhead — non copia il df)
-                _master_src_col_names = list(df_tree_raw.columns)
+                _master_src_col_names = list(df_global.columns)
                 if _has_svc and _SVC_COL not in _master_src_col_names:
                     _master_src_col_names = _master_src_col_names + [_SVC_COL]
                 _master_src_preset = [c for c in [primary_col, secondary_col,
@@ -2503,14 +5257,16 @@ if page == "📊 Vendite & Fatturazione":
                     _master_df_shown = master_df[[c for c in _master_vis if c in master_df.columns]]
                     st.dataframe(_master_df_shown, column_config=_master_col_cfg,
                                  hide_index=True, width='stretch')
-                    st.download_button(
-                        "📥 Scarica Tabella Master (.xlsx)",
-                        data=convert_df_to_excel(_master_df_shown),
+                    _excel_download_button(
+                        "📥 Scarica Tabella Master (.xlsx)", _master_df_shown,
                         file_name=f"Master_{primary_col}_{datetime.date.today()}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="btn_dl_master"
+                        key="btn_dl_master",
+                        fingerprint=_fingerprint(_tree_fp, "master", _master_vis),
                     )
                 else:
+                    # Righe grezze solo qui: stessi filtri dell'albero applicati a df_global
+                    df_tree_raw = _tree_filter(df_global, col_prod, col_customer,
+                                               _tree_flt["prod"], _tree_flt["cust"])
                     # FIX CRASH: .assign() lazy — solo quando in Righe sorgente
                     # FIX SVC VALORI VUOTI: np.where su int64 (pandas 2.x .replace(0,nan) inaffidabile)
                     _tree_src = (
@@ -2532,12 +5288,11 @@ if page == "📊 Vendite & Fatturazione":
                                      "🎯 Livello Servizio", min_value=0, max_value=100, format="%.1f%%"
                                  )},
                                  hide_index=True, width='stretch')
-                    st.download_button(
-                        "📥 Scarica Righe Sorgente Master (.xlsx)",
-                        data=convert_df_to_excel(_master_src_df_shown),
+                    _excel_download_button(
+                        "📥 Scarica Righe Sorgente Master (.xlsx)", _master_src_df_shown,
                         file_name=f"MasterSrc_{primary_col}_{datetime.date.today()}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="btn_dl_master_src"
+                        key="btn_dl_master_src",
+                        fingerprint=_fingerprint(_tree_fp, "master_src", _master_src_vis),
                     )
 
                 st.markdown("⬇️ **Seleziona un elemento per vedere il dettaglio:**")
@@ -2547,12 +5302,12 @@ if page == "📊 Vendite & Fatturazione":
                 )
                 if selected_val is not None:
                     # Include righe con CT_consegnato=0 (tagli completi) — nessun filtro su qty
-                    detail_df  = df_tree_raw[df_tree_raw[primary_col] == selected_val]
-                    detail_agg = build_agg_with_ratios(
-                        detail_df, secondary_col, col_cartons, col_kg, col_euro
+                    detail_cube = df_tree_agg[df_tree_agg[primary_col] == selected_val]
+                    detail_agg  = build_agg_with_ratios(
+                        detail_cube, secondary_col, col_cartons, col_kg, col_euro
                     )
-                    detail_agg = _add_service_level(
-                        detail_agg, detail_df, secondary_col, col_cartons, col_cartons_del
+                    detail_agg  = _add_service_level(
+                        detail_agg, detail_cube, secondary_col, col_cartons, col_cartons_del
                     )
                     st.markdown(
                         f'<div class="detail-section">Dettaglio per: <b>{selected_val}</b></div>',
@@ -2560,7 +5315,7 @@ if page == "📊 Vendite & Fatturazione":
                     )
                     # ── Mostra / Nascondi Colonne (Child) ────────────────────
                     _agg_default    = list(detail_agg.columns)
-                    _src_col_names  = [c for c in detail_df.columns if c != primary_col]
+                    _src_col_names  = [c for c in df_global.columns if c != primary_col]
                     if _has_svc and _SVC_COL not in _src_col_names:
                         _src_col_names = _src_col_names + [_SVC_COL]
                     _src_preset = [c for c in [secondary_col, col_cartons, col_cartons_del,
@@ -2617,14 +5372,16 @@ if page == "📊 Vendite & Fatturazione":
                                     "🎯 Livello Servizio", min_value=0, max_value=100, format="%.1f%%"
                                 ),
                             }, hide_index=True, width='stretch')
-                        st.download_button(
-                            "📥 Scarica Dettaglio (Child) (.xlsx)",
-                            data=convert_df_to_excel(_child_df_shown),
+                        _excel_download_button(
+                            "📥 Scarica Dettaglio (Child) (.xlsx)", _child_df_shown,
                             file_name=f"Child_{str(selected_val)[:30]}_{datetime.date.today()}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key="btn_dl_child_agg"
+                            key="btn_dl_child_agg",
+                            fingerprint=_fingerprint(_tree_fp, "child", selected_val, _child_vis),
                         )
                     else:
+                        _tree_rows = _tree_filter(df_global, col_prod, col_customer,
+                                                  _tree_flt["prod"], _tree_flt["cust"])
+                        detail_df  = _tree_rows[_tree_rows[primary_col] == selected_val]
                         # FIX CRASH: lazy — .assign() solo quando in Righe sorgente
                         # FIX SVC VALORI VUOTI: np.where su int64 (pandas 2.x .replace(0,nan) inaffidabile)
                         _detail_src = (
@@ -2647,18 +5404,18 @@ if page == "📊 Vendite & Fatturazione":
                                 "🎯 Livello Servizio", min_value=0, max_value=100, format="%.1f%%"
                             )},
                             hide_index=True, width='stretch')
-                        st.download_button(
-                            "📥 Scarica Righe Sorgente (.xlsx)",
-                            data=convert_df_to_excel(_child_src_df_shown),
+                        _excel_download_button(
+                            "📥 Scarica Righe Sorgente (.xlsx)", _child_src_df_shown,
                             file_name=f"Sorgente_{str(selected_val)[:30]}_{datetime.date.today()}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key="btn_dl_child_src"
+                            key="btn_dl_child_src",
+                            fingerprint=_fingerprint(
+                                _tree_fp, "child_src", selected_val, _child_src_vis),
                         )
 
 
                 full_flat = (
-                    df_tree_raw
-                    .groupby([primary_col, secondary_col])
+                    df_tree_agg
+                    .groupby([primary_col, secondary_col], observed=True)
                     .agg({col_cartons: 'sum', col_kg: 'sum', col_euro: 'sum'})
                     .reset_index()
                     .sort_values(col_euro, ascending=False)
@@ -2667,11 +5424,10 @@ if page == "📊 Vendite & Fatturazione":
                         'Valore Medio €/CT': lambda d: np.where(d[col_cartons] > 0, d[col_euro] / d[col_cartons], 0),
                     })
                 )
-                st.download_button(
-                    "📥 Scarica Report Excel Completo",
-                    data=convert_df_to_excel(full_flat),
+                _excel_download_button(
+                    "📥 Scarica Report Excel Completo", full_flat,
                     file_name=f"Explosion_Full_Report_{datetime.date.today()}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    fingerprint=_fingerprint(_tree_fp, "full"),
                 )
 
 
@@ -2693,20 +5449,16 @@ elif page == "🏷️ Analisi Customer Promo":
     df_promo_processed = None
 
     if files:
-        file_map = {f['name']: f for f in files}
-        file_list = list(file_map.keys())
+        file_map  = files.by_name
+        file_list = files.names
 
         # --- Carica Promo ---
-        default_idx_p  = next(
-            (i for i, n in enumerate(file_list) if "customer_promo" in n.lower()), 0
-        )
+        default_idx_p  = files.default_pos("Promo")
         sel_promo_file = st.sidebar.selectbox("1. File Sorgente Promo", file_list, index=default_idx_p)
         with st.spinner('Elaborazione dati promozionali...'):
-            df_promo_raw = load_dataset(
-                file_map[sel_promo_file]['id'], file_map[sel_promo_file]['modifiedTime']
+            df_promo_processed = load_clean_dataset(
+                file_map[sel_promo_file]['id'], file_map[sel_promo_file]['modifiedTime'], "Promo"
             )
-            if df_promo_raw is not None:
-                df_promo_processed = smart_analyze_and_clean(df_promo_raw, "Promo")
 
     if df_promo_processed is not None:
         guesses_p  = guess_column_role(df_promo_processed, "Promo")
@@ -2724,7 +5476,7 @@ elif page == "🏷️ Analisi Customer Promo":
             p_week   = st.selectbox("Week start",         all_cols_p, index=set_idx(guesses_p['week_start'],   all_cols_p))
 
         st.sidebar.markdown("### 🔍 Filtri Promo Rapidi")
-        df_pglobal = df_promo_processed.copy()
+        df_pglobal = df_promo_processed   # condiviso: i filtri sotto creano nuovi oggetti
 
         # Filtro Division
         if p_div in df_pglobal.columns:
@@ -2736,10 +5488,10 @@ elif page == "🏷️ Analisi Customer Promo":
         # Filtro data Sell-In — usa il selettore data GLOBALE (G_START / G_END)
         if p_start in df_pglobal.columns and pd.api.types.is_datetime64_any_dtype(df_pglobal[p_start]):
             d_start, d_end = G_START, G_END
-            df_pglobal = df_pglobal[
-                (df_pglobal[p_start].dt.date >= d_start) &
-                (df_pglobal[p_start].dt.date <= d_end)
-            ]
+            df_pglobal = _filter_period(
+                df_pglobal, p_start, d_start, d_end, base=df_promo_processed,
+                src=(file_map[sel_promo_file]['id'], file_map[sel_promo_file]['modifiedTime'], "Promo")
+            )
 
         # FIX: filtri avanzati gated da Submit (stessa logica di Sales page).
         # Problema originale: active_filters_p e sel_stati venivano applicati
@@ -2757,7 +5509,7 @@ elif page == "🏷️ Analisi Customer Promo":
             filters_selected_p = st.multiselect("Aggiungi altri filtri:", possible_filters_p)
             staged_adv_p: dict = {}
             for f_col in filters_selected_p:
-                unique_vals = sorted(df_promo_processed[f_col].dropna().astype(str).unique())
+                unique_vals = _str_unique(df_promo_processed[f_col])
                 sel_vals    = st.multiselect(f"Seleziona {f_col}", unique_vals)
                 if sel_vals:
                     staged_adv_p[f_col] = sel_vals
@@ -2807,14 +5559,14 @@ elif page == "🏷️ Analisi Customer Promo":
             df_pglobal = df_pglobal[df_pglobal[p_status].isin(active_stati)]
         for f_col, vals in active_adv_p.items():
             if f_col in df_pglobal.columns:
-                df_pglobal = df_pglobal[df_pglobal[f_col].astype(str).isin(vals)]
+                df_pglobal = df_pglobal[_str_isin(df_pglobal[f_col], vals)]
 
         # ── _df_vendite = _df_sales_global (calcolato globalmente prima dell'AI) ──
         # Stesso df usato dal contesto AI → zero divergenze possibili.
         # Non serve ricalcolare: G_START/G_END e entity="EITA" sono già applicati.
         _df_vendite  = _df_sales_global  # alias esplicito per chiarezza nel codice sotto
         _periodo_promo = _periodo_g
-        # Nota: ai_context_df è già stato impostato nel blocco globale con _df_sales_global.
+        # Nota: ai_context_view è già stato impostato nel blocco globale con _df_sales_global.
         # Non serve aggiornarlo qui (sarebbe già il valore corretto).
 
         if not df_pglobal.empty:
@@ -2849,8 +5601,8 @@ elif page == "🏷️ Analisi Customer Promo":
                     )
                     # ── Filtri opzionali per visualizzazione (non cambiano la fonte dati) ──
                     with st.form("promo_sales_chart_filter"):
-                        _all_arts  = sorted(_df_vendite[_COL_AT].dropna().astype(str).unique()) if _COL_AT in _df_vendite.columns else []
-                        _all_clis  = sorted(_df_vendite[_COL_CL].dropna().astype(str).unique()) if _COL_CL in _df_vendite.columns else []
+                        _all_arts  = _str_unique(_df_vendite[_COL_AT]) if _COL_AT in _df_vendite.columns else []
+                        _all_clis  = _str_unique(_df_vendite[_COL_CL]) if _COL_CL in _df_vendite.columns else []
                         _sel_art   = st.multiselect("Filtra Articolo", _all_arts, placeholder="Tutti...")
                         _sel_cli   = st.multiselect("Filtra Cliente",  _all_clis, placeholder="Tutti...")
                         _apply_ch  = st.form_submit_button("Aggiorna Grafico")
@@ -2858,19 +5610,19 @@ elif page == "🏷️ Analisi Customer Promo":
                         st.session_state['pchart_art'] = _sel_art
                         st.session_state['pchart_cli'] = _sel_cli
 
-                    df_s = _df_vendite.copy()
+                    df_s = _df_vendite
                     _f_art = st.session_state.get('pchart_art', [])
                     _f_cli = st.session_state.get('pchart_cli', [])
                     if _f_art and _COL_AT in df_s.columns:
-                        df_s = df_s[df_s[_COL_AT].astype(str).isin(_f_art)]
+                        df_s = df_s[_str_isin(df_s[_COL_AT], _f_art)]
                     if _f_cli and _COL_CL in df_s.columns:
-                        df_s = df_s[df_s[_COL_CL].astype(str).isin(_f_cli)]
+                        df_s = df_s[_str_isin(df_s[_COL_CL], _f_cli)]
 
                     # ── Aggregazione Kg per tipo (__tipo__ già calcolato con regole ufficiali) ──
                     if _COL_KG not in df_s.columns:
                         st.warning(f"Colonna {_COL_KG} non trovata.")
                     else:
-                        promo_stats = df_s.groupby('__tipo__')[_COL_KG].sum().reset_index()
+                        promo_stats = df_s.groupby('__tipo__', observed=True)[_COL_KG].sum().reset_index()
                         promo_stats.columns = ['Tipo', 'Kg']
                         total_kg = promo_stats['Kg'].sum()
 
@@ -2931,7 +5683,7 @@ elif page == "🏷️ Analisi Customer Promo":
                 promo_desc_col = guesses_p.get('promo_desc') or 'Descrizione Promozione'
                 if promo_desc_col in df_pglobal.columns:
                     top_promos = (
-                        df_pglobal.groupby(promo_desc_col)
+                        df_pglobal.groupby(promo_desc_col, observed=True)
                                   .agg({p_qty_a: 'sum'})
                                   .reset_index()
                                   .sort_values(p_qty_a, ascending=False)
@@ -3050,11 +5802,11 @@ elif page == "🏷️ Analisi Customer Promo":
                 )
 
                 # Usa df_s (già filtrato per art/cli dal form sopra)
-                _df_tbl = df_s.copy() if '_f_art' in dir() or '_f_cli' in dir() else _df_vendite.copy()
+                _df_tbl = df_s if '_f_art' in dir() or '_f_cli' in dir() else _df_vendite
                 if _f_art and _COL_AT in _df_tbl.columns:
-                    _df_tbl = _df_tbl[_df_tbl[_COL_AT].astype(str).isin(_f_art)]
+                    _df_tbl = _df_tbl[_str_isin(_df_tbl[_COL_AT], _f_art)]
                 if _f_cli and _COL_CL in _df_tbl.columns:
-                    _df_tbl = _df_tbl[_df_tbl[_COL_CL].astype(str).isin(_f_cli)]
+                    _df_tbl = _df_tbl[_str_isin(_df_tbl[_COL_CL], _f_cli)]
 
                 _has_tbl_cols = all(c in _df_tbl.columns for c in [_COL_AT, _COL_CL, _COL_KG])
                 if _has_tbl_cols:
@@ -3067,7 +5819,8 @@ elif page == "🏷️ Analisi Customer Promo":
                     )
                     # Pivot: una riga per Articolo×Cliente con colonne per tipo
                     _pivot_kg = _agg_base.pivot_table(
-                        index=_grp_cols, columns='__tipo__', values=_COL_KG, aggfunc='sum', fill_value=0
+                        index=_grp_cols, columns='__tipo__', values=_COL_KG, aggfunc='sum', fill_value=0,
+                        observed=True
                     ).reset_index()
                     _pivot_kg.columns = [c if isinstance(c, str) else f"Kg_{c}" for c in _pivot_kg.columns]
 
@@ -3129,45 +5882,47 @@ elif page == "🏷️ Analisi Customer Promo":
                         }, hide_index=True, width='stretch')
                     # Download Excel
                     if not _tbl_final.empty:
-                        st.download_button(
-                            "📥 Scarica tabella Excel",
-                            data=convert_df_to_excel(_tbl_final),
+                        _excel_download_button(
+                            "📥 Scarica tabella Excel", _tbl_final,
                             file_name=f"Promo_Detail_{G_START}_{G_END}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key="promo_detail_download"
+                            key="promo_detail_download",
+                            fingerprint=_view_fingerprint(_df_proc_pre_src, _df_tbl,
+                                                          "promo_kg_table", _tbl_cols),
                         )
                 else:
                     st.caption("⚠️ Colonne insufficienti per la tabella dettaglio.")
 
 
             st.subheader("📋 Dettaglio Iniziative Promozionali")
+            _promo_src = (file_map[sel_promo_file]['id'], file_map[sel_promo_file]['modifiedTime'],
+                          "Promo")
 
             with st.form("promo_detail_form"):
                 st.caption("Seleziona i filtri e premi 'Aggiorna Tabella'.")
                 f1, f2, f3, f4 = st.columns(4)
                 with f1:
-                    c_list = sorted(df_pglobal[p_cust].dropna().astype(str).unique()) if p_cust in df_pglobal.columns else []
+                    c_list = _str_unique(df_pglobal[p_cust]) if p_cust in df_pglobal.columns else []
                     sel_tc = st.multiselect("👤 Cliente",     c_list, placeholder="Tutti...")
                 with f2:
-                    p_list = sorted(df_pglobal[p_prod].dropna().astype(str).unique()) if p_prod in df_pglobal.columns else []
+                    p_list = _str_unique(df_pglobal[p_prod]) if p_prod in df_pglobal.columns else []
                     sel_tp = st.multiselect("🏷️ Prodotto",   p_list, placeholder="Tutti...")
                 with f3:
                     s_list = (sorted(df_pglobal['Sconto promo'].dropna().astype(str).unique())
                               if 'Sconto promo' in df_pglobal.columns else [])
                     sel_ts = st.multiselect("📉 Sconto promo", s_list, placeholder="Tutti...")
                 with f4:
-                    w_list = sorted(df_pglobal[p_week].dropna().astype(str).unique()) if p_week in df_pglobal.columns else []
+                    w_list = _str_unique(df_pglobal[p_week]) if p_week in df_pglobal.columns else []
                     sel_tw = st.multiselect("📅 Week start",  w_list, placeholder="Tutte...")
                 submit_promo = st.form_submit_button("🔄 Aggiorna Tabella")
 
             if submit_promo:
-                df_display = df_pglobal.copy()
-                if sel_tc: df_display = df_display[df_display[p_cust].astype(str).isin(sel_tc)]
-                if sel_tp: df_display = df_display[df_display[p_prod].astype(str).isin(sel_tp)]
+                df_display = df_pglobal
+                if sel_tc: df_display = df_display[_str_isin(df_display[p_cust], sel_tc)]
+                if sel_tp: df_display = df_display[_str_isin(df_display[p_prod], sel_tp)]
                 if sel_ts and 'Sconto promo' in df_display.columns:
                     df_display = df_display[df_display['Sconto promo'].astype(str).isin(sel_ts)]
                 if sel_tw and p_week in df_display.columns:
-                    df_display = df_display[df_display[p_week].astype(str).isin(sel_tw)]
+                    df_display = df_display[_str_isin(df_display[p_week], sel_tw)]
 
                 promo_id_col   = guesses_p.get('promo_id')
                 promo_desc_col = guesses_p.get('promo_desc') or 'Descrizione Promozione'
@@ -3180,12 +5935,18 @@ elif page == "🏷️ Analisi Customer Promo":
                     df_display.sort_values(by=p_qty_a, ascending=False)
                     if p_qty_a in df_display.columns else df_display
                 )
-                # Salva sia il df COMPLETO (tutte le colonne) sia il preset
-                st.session_state['promo_detail_df']      = df_display_sorted
+                # Salva la vista (sorgente + posizioni già ordinate) del df COMPLETO e il preset colonne
+                st.session_state['promo_detail_view']    = _view_spec(_promo_src, df_display_sorted)
                 st.session_state['promo_detail_preset']  = _preset_cols
 
-            if 'promo_detail_df' in st.session_state:
-                df_p_full  = st.session_state['promo_detail_df']       # tutte le colonne
+            # Vista di un altro file (selettore) o di una versione superata → scartata
+            _p_view = st.session_state.get('promo_detail_view')
+            if _p_view is not None and tuple(_p_view["src"]) != _promo_src:
+                st.session_state.pop('promo_detail_view', None)
+                st.session_state.pop('promo_detail_preset', None)
+                _p_view = None
+            df_p_full = _resolve_view(_p_view)                         # tutte le colonne
+            if df_p_full is not None:
                 _p_preset  = st.session_state.get('promo_detail_preset',
                                                    list(df_p_full.columns))
                 _all_p_cols = [c for c in df_p_full.columns]
@@ -3215,12 +5976,11 @@ elif page == "🏷️ Analisi Customer Promo":
                     },
                     hide_index=True, height=500
                 , width='stretch')
-                st.download_button(
-                    "📥 Scarica Report Promo Excel (.xlsx)",
-                    data=convert_df_to_excel(df_p_show),
+                _excel_download_button(
+                    "📥 Scarica Report Promo Excel (.xlsx)", df_p_show,
                     file_name=f"Promo_Report_{datetime.date.today()}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    key="btn_download_promo"
+                    key="btn_download_promo",
+                    fingerprint=_view_fingerprint(_promo_src, df_p_show, "promo_detail"),
                 )
         else:
             st.warning("Nessuna promozione trovata per i filtri selezionati.")
@@ -3245,39 +6005,16 @@ elif page == "🏭 Analisi Acquisti":
     df_purch_processed = None
 
     if files:
-        file_map       = {f['name']: f for f in files}
-        file_list      = list(file_map.keys())
-        default_idx_pu = next(
-            (i for i, n in enumerate(file_list) if "purchase_orders_history" in n.lower()), 0
-        )
+        file_map       = files.by_name
+        file_list      = files.names
+        default_idx_pu = files.default_pos("Purchase")
         sel_purch_file = st.sidebar.selectbox("1. File Sorgente Acquisti", file_list, index=default_idx_pu)
 
         with st.spinner('Lettura file acquisti...'):
-            df_purch_raw = load_dataset(
-                file_map[sel_purch_file]['id'], file_map[sel_purch_file]['modifiedTime']
+            df_purch_processed = load_clean_dataset(
+                file_map[sel_purch_file]['id'], file_map[sel_purch_file]['modifiedTime'], "Purchase"
             )
-            if df_purch_raw is not None:
-                df_purch_processed = smart_analyze_and_clean(df_purch_raw, "Purchase")
-
-                # LEGENDA: "Kg acquistati = costo della linea / prezzo €/kg"
-                # = Line amount / Purchase price
-                # FIX: SEMPRE ricalcola — la colonna esiste già nel file
-                # Excel ma può avere valori zero o sbagliati.
-                # Non usare il guard "if not in columns".
-                if all(c in df_purch_processed.columns for c in ['Line amount', 'Purchase price']):
-                    df_purch_processed['Kg acquistati'] = np.where(
-                        df_purch_processed['Purchase price'] > 0,
-                        df_purch_processed['Line amount'] / df_purch_processed['Purchase price'],
-                        0
-                    )
-                elif all(c in df_purch_processed.columns for c in ['Row amount', 'Purchase price']):
-                    df_purch_processed['Kg acquistati'] = np.where(
-                        df_purch_processed['Purchase price'] > 0,
-                        df_purch_processed['Row amount'] / df_purch_processed['Purchase price'],
-                        0
-                    )
-                else:
-                    df_purch_processed['Kg acquistati'] = 0
+            # 'Kg acquistati' è già calcolato in load_clean_dataset (_derive_columns)
     else:
         st.error("Nessun file trovato.")
 
@@ -3334,17 +6071,14 @@ elif page == "🏭 Analisi Acquisti":
             else:
                 default_div_idx = 0
             sel_div_pu   = st.sidebar.selectbox("Divisione", divs, index=default_div_idx)
-            df_pu_global = df_pu_global[df_pu_global[pu_div].astype(str) == sel_div_pu]
+            df_pu_global = df_pu_global[_str_eq(df_pu_global[pu_div], sel_div_pu)]
 
         # --- Periodo di Analisi ---
         # Filtra per G_START/G_END esattamente come Page 1 e Page 2.
         # Se il risultato è vuoto → KPI=0 + warning con range disponibile nel file.
         d_start_pu = d_end_pu = None
         if pu_date in df_pu_global.columns:
-            if not pd.api.types.is_datetime64_any_dtype(df_pu_global[pu_date]):
-                df_pu_global[pu_date] = pd.to_datetime(
-                    df_pu_global[pu_date], format='mixed', dayfirst=True, errors='coerce'
-                )
+            df_pu_global = _coerce_dates(df_pu_global, [pu_date])
             df_pu_global = df_pu_global.dropna(subset=[pu_date])
 
             if pd.api.types.is_datetime64_any_dtype(df_pu_global[pu_date]) and not df_pu_global.empty:
@@ -3353,10 +6087,11 @@ elif page == "🏭 Analisi Acquisti":
 
                 # Applica direttamente il filtro globale (stesso pattern Page 1/2)
                 d_start_pu, d_end_pu = G_START, G_END
-                df_pu_global = df_pu_global[
-                    (df_pu_global[pu_date].dt.date >= d_start_pu) &
-                    (df_pu_global[pu_date].dt.date <= d_end_pu)
-                ]
+                df_pu_global = _filter_period(
+                    df_pu_global, pu_date, d_start_pu, d_end_pu, base=df_purch_processed,
+                    src=(file_map[sel_purch_file]['id'], file_map[sel_purch_file]['modifiedTime'],
+                         "Purchase")
+                )
 
                 # Se vuoto: avvisa con range disponibile (non sovrascrive la selezione)
                 if df_pu_global.empty and pd.notnull(_min_d) and pd.notnull(_max_d):
@@ -3370,7 +6105,7 @@ elif page == "🏭 Analisi Acquisti":
 
         # --- Filtro Fornitore ---
         if pu_supp in df_pu_global.columns:
-            all_suppliers = ["Tutti"] + sorted(df_pu_global[pu_supp].dropna().astype(str).unique())
+            all_suppliers = ["Tutti"] + _str_unique(df_pu_global[pu_supp])
             saved_supps   = pu_saved.get("sel_suppliers", ["Tutti"])
             # Ripristina solo i fornitori ancora presenti nel dataset corrente
             valid_saved = [s for s in saved_supps if s in all_suppliers]
@@ -3378,7 +6113,7 @@ elif page == "🏭 Analisi Acquisti":
                 valid_saved = ["Tutti"]
             sel_suppliers = st.sidebar.multiselect("Fornitori", all_suppliers, default=valid_saved)
             if sel_suppliers and "Tutti" not in sel_suppliers:
-                df_pu_global = df_pu_global[df_pu_global[pu_supp].astype(str).isin(sel_suppliers)]
+                df_pu_global = df_pu_global[_str_isin(df_pu_global[pu_supp], sel_suppliers)]
         else:
             sel_suppliers = ["Tutti"]
 
@@ -3411,8 +6146,9 @@ elif page == "🏭 Analisi Acquisti":
         # Ricarica dati dal Drive (pulisce cache per il file Acquisti)
         if st.sidebar.button("🔄 Ricarica dati Drive", key="btn_reload_pu",
                               help="Forza il ricaricamento del file da Google Drive"):
-            load_dataset.clear()
-            smart_analyze_and_clean.clear()
+            load_clean_dataset.clear(file_map[sel_purch_file]['id'],
+                                     file_map[sel_purch_file]['modifiedTime'], "Purchase")
+            _snapshot_purge(file_map[sel_purch_file]['id'])
             st.rerun()
 
         # Importa/Esporta settings come JSON (persistenza cross-sessione)
@@ -3444,7 +6180,14 @@ elif page == "🏭 Analisi Acquisti":
                 _periodo_pu = f" | Periodo: {d_start_pu.strftime('%d/%m/%Y')} – {d_end_pu.strftime('%d/%m/%Y')}"
             except Exception:
                 pass
-            st.session_state["ai_context_df"]    = df_pu_global
+            st.session_state["ai_context_view"]  = _view_spec(
+                (file_map[sel_purch_file]['id'], file_map[sel_purch_file]['modifiedTime'],
+                 "Purchase"), df_pu_global, dates=[pu_date])
+            st.session_state["ai_context_fp"]    = _fingerprint(
+                file_map[sel_purch_file]['id'], file_map[sel_purch_file]['modifiedTime'],
+                "Purchase", {"div": [pu_div, sel_div_pu], "date": [pu_date, G_START, G_END],
+                             "supp": [pu_supp, sel_suppliers]}
+            )
             st.session_state["ai_context_label"] = f"Acquisti{_periodo_pu}"
 
         # KPI — sempre visibili; quando df_pu_global è vuoto i valori sono 0
@@ -3616,12 +6359,12 @@ elif page == "🏭 Analisi Acquisti":
                 st.caption(f"📅 Colonna data: **{pu_date}**")
                 if pu_supp in df_pu_global.columns and pu_amount in df_pu_global.columns:
                     top_supp = (df_pu_global
-                                .groupby(pu_supp)[pu_amount]
+                                .groupby(pu_supp, observed=True)[pu_amount]
                                 .sum().sort_values(ascending=False)
                                 .head(10).reset_index())
                     # Calcola anche Kg per i top fornitori (asse secondario)
                     top_supp_full = (
-                        df_pu_global.groupby(pu_supp)
+                        df_pu_global.groupby(pu_supp, observed=True)
                         .agg(
                             **{pu_amount: (pu_amount, 'sum'),
                                pu_kg:    (pu_kg,    'sum')}
@@ -3792,7 +6535,7 @@ elif page == "🏭 Analisi Acquisti":
                     staged_pu_filters = {}
                     for j, col_name in enumerate(_FILTERABLE_COLS):
                         with filter_cols_ui[j % len(filter_cols_ui)]:
-                            uniq = sorted(df_pu_global[col_name].dropna().astype(str).unique().tolist())
+                            uniq = _str_unique(df_pu_global[col_name])
                             if len(uniq) <= 300:
                                 sel = st.multiselect(
                                     col_name,
@@ -3812,7 +6555,7 @@ elif page == "🏭 Analisi Acquisti":
                 for col_name, sel_vals in active_pu_filters.items():
                     if col_name in df_detail_filtered.columns:
                         df_detail_filtered = df_detail_filtered[
-                            df_detail_filtered[col_name].astype(str).isin(sel_vals)
+                            _str_isin(df_detail_filtered[col_name], sel_vals)
                         ]
 
             # ---- Applica ordinamento ----
@@ -3830,12 +6573,11 @@ elif page == "🏭 Analisi Acquisti":
             _rec_col = 'Received quantity'
             _has_svc_cols = _ord_col in df_final.columns and _rec_col in df_final.columns
             if _has_svc_cols:
-                df_final = df_final.copy()
-                df_final['% Livello Servizio'] = np.where(
+                df_final = df_final.assign(**{'% Livello Servizio': np.where(
                     df_final[_ord_col] > 0,
                     (df_final[_rec_col] / df_final[_ord_col] * 100).clip(0, 100).round(1),
                     np.nan
-                )
+                )})
 
             # CAP DISPLAY: Streamlit renderizza tutto in DOM → troppo RAM con 100k+ righe
             _MAX_ROWS_DISPLAY = 5000
@@ -3896,11 +6638,12 @@ elif page == "🏭 Analisi Acquisti":
                 df_final,
                 column_config=col_cfg, height=520, hide_index=True
             , width='stretch')
-            st.download_button(
-                "📥 Scarica Report Acquisti (.xlsx)",
-                data=convert_df_to_excel(df_final),
+            _excel_download_button(
+                "📥 Scarica Report Acquisti (.xlsx)", df_final,
                 file_name=f"Report_Acquisti_{datetime.date.today()}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                fingerprint=_view_fingerprint(
+                    (file_map[sel_purch_file]['id'], file_map[sel_purch_file]['modifiedTime'],
+                     "Purchase"), df_final, "report", pu_date),
             )
 
             # ── Footer GDPR ────────────────────────────────────────────────
@@ -0,0 +1,83 @@
+"""
+Benchmark del parsing xlsx: processo unico vs IngestPool (processi worker).
+
+Genera N file xlsx sintetici (righe tipo Sales) in una cartella temporanea e misura
+lo stesso carico del warm-up di app.py — N file letti da N thread in parallelo:
+    • thread    → ingest_worker.read_spreadsheet nel processo corrente (GIL)
+    • pool      → IngestPool.parse, un file per worker
+Il pool è misurato due volte: "freddo" (prima richiesta, import nei worker) e
+"caldo" (worker già avviati, il caso di un server Streamlit in esecuzione).
+Controlla anche che i DataFrame coincidano tra le due strade.
+
+    python benchmarks/ingest_pool.py --rows 200000 --files 3 --procs 3
+    EITA_EXCEL_ENGINE=openpyxl python benchmarks/ingest_pool.py   # motore forzato
+
+Il guadagno dipende dai core disponibili (stampati in testa): con un solo core il
+pool non può battere i thread.
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ingest_worker  # noqa: E402
+
+
+def _make_file(path: str, rows: int, seed: int) -> None:
+    r = np.random.default_rng(seed)
+    pd.DataFrame({
+        "Data_Ordine":           pd.Timestamp("2025-01-01") + pd.to_timedelta(r.integers(0, 365, rows), unit="D"),
+        "Cliente":               r.choice([f"Cliente {i}" for i in range(500)], rows),
+        "Articolo":              r.choice([f"ART{i:05d}" for i in range(3000)], rows),
+        "Importo_Netto_TotRiga": r.random(rows).round(2) * 1000,
+        "Peso_Netto_TotRiga":    r.random(rows).round(3) * 50,
+        "Qta_Cartoni_Ordinato":  r.integers(1, 200, rows),
+    }).to_excel(path, index=False, engine="openpyxl")
+
+
+def _timed(fn, paths: list) -> tuple:
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(len(paths)) as ex:
+        frames = list(ex.map(fn, paths))
+    return time.perf_counter() - t0, frames
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--rows",  type=int, default=100_000, help="righe per file")
+    ap.add_argument("--files", type=int, default=3,       help="file letti in parallelo")
+    ap.add_argument("--procs", type=int, default=None,    help="worker del pool (default: --files)")
+    args  = ap.parse_args()
+    procs = args.procs or args.files
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    print(f"CPU disponibili: {cpus} · motori: {ingest_worker.excel_engines()} · "
+          f"{args.files} file × {args.rows:,} righe · pool {procs} worker")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f"bench_{i}.xlsx") for i in range(args.files)]
+        t0 = time.perf_counter()
+        for i, p in enumerate(paths):
+            _make_file(p, args.rows, seed=i)
+        print(f"generazione file: {time.perf_counter() - t0:.1f}s "
+              f"({os.path.getsize(paths[0]) / 1e6:.1f} MB ciascuno)")
+
+        t_thr, ref = _timed(lambda p: ingest_worker.read_spreadsheet(p)[0], paths)
+        print(f"thread (processo unico): {t_thr:6.2f}s")
+
+        pool = ingest_worker.IngestPool(procs)
+        for label in ("pool freddo", "pool caldo"):
+            t_pool, out = _timed(lambda p: pool.parse(p)[1], paths)
+            for a, b in zip(ref, out):
+                pd.testing.assert_frame_equal(a, b)
+            print(f"{label + ':':24s} {t_pool:6.2f}s  (×{t_thr / t_pool:.2f} vs thread, DataFrame identici)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Parsing dei file dati in processi separati (IngestPool, usato da app.py).
+
+pd.read_excel (openpyxl) è puro Python e CPU-bound: nei thread resta su un solo
+core per via del GIL. Qui ogni file gira in un processo worker persistente e il
+DataFrame torna al processo Streamlit come stream Arrow IPC (buffer colonnari),
+non come pickle riga per riga degli oggetti pandas.
+
+Niente multiprocessing/ProcessPoolExecutor: Streamlit installa lo script come
+sys.modules["__main__"], quindi un figlio "spawn"/"forkserver" rieseguirebbe
+app.py intero, e "fork" di un server con thread attivi può bloccarsi. Il worker
+è un normale processo Python (python ingest_worker.py) che dialoga su stdin/stdout:
+    richiesta: {"path": ..., "usecols": [...] | null, "dtype": {...} | null}\\n  (JSON)
+    risposta:  <formato> <byte> <motore> <secondi parsing>\\n<payload>
+               (formato: arrow | pickle | error)
+"""
+import importlib.util
+import json
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import pandas as pd
+
+# Motori read_excel in ordine di velocità. calamine (Rust, pandas ≥ 2.2 +
+# python-calamine) legge gli xlsx molte volte più veloce di openpyxl, con lo stesso
+# DataFrame in uscita; se manca o fallisce su un file si passa al successivo.
+# EITA_EXCEL_ENGINE forza un motore (es. "openpyxl" per confronti).
+_EXCEL_ENGINES = (("calamine", "python_calamine", (2, 2)), ("openpyxl", "openpyxl", (0, 0)))
+
+
+def excel_engines() -> list:
+    """Motori read_excel disponibili in questo processo, dal più veloce."""
+    forced  = os.environ.get("EITA_EXCEL_ENGINE")
+    pd_ver  = tuple(int(x) for x in pd.__version__.split(".")[:2])
+    engines = [name for name, module, min_pd in _EXCEL_ENGINES
+               if pd_ver >= min_pd and importlib.util.find_spec(module) is not None]
+    return [forced] if forced else engines
+
+
+def read_spreadsheet(path: str, usecols=None, dtype=None) -> tuple:
+    """
+    (DataFrame, motore, secondi) del primo foglio dell'xlsx/xls su disco; se nessun
+    motore lo legge, CSV. usecols (nomi colonna) e dtype passano a pandas invariati.
+    """
+    t0 = time.perf_counter()
+    for engine in excel_engines():
+        try:
+            df = pd.read_excel(path, engine=engine, usecols=usecols, dtype=dtype)
+            return df, engine, time.perf_counter() - t0
+        except Exception:
+            continue
+    df = pd.read_csv(path, usecols=usecols, dtype=dtype)
+    return df, "csv", time.perf_counter() - t0
+
+
+def encode_frame(df: pd.DataFrame) -> tuple:
+    """
+    (formato, payload) per il ritorno al processo principale: Arrow IPC se la
+    conversione riesce, altrimenti pickle (colonne object miste, es. numeri + testo,
+    che Arrow rifiuta — stesso ripiego degli snapshot su disco).
+    """
+    try:
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        sink  = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return "arrow", sink.getvalue().to_pybytes()
+    except Exception:
+        return "pickle", pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_frame(fmt: str, payload: bytes) -> pd.DataFrame:
+    """Inverso di encode_frame (lato processo principale)."""
+    if fmt == "arrow":
+        import pyarrow as pa
+        return pa.ipc.open_stream(payload).read_all().to_pandas()
+    return pickle.loads(payload)
+
+
+class IngestPool:
+    """
+    Processi worker persistenti (python ingest_worker.py) per il parsing dei fogli.
+    Ogni richiesta ha una scadenza (timeout, secondi): un worker bloccato su un file
+    patologico viene terminato da un watchdog e rimpiazzato, e la chiamata solleva
+    TimeoutError; anche l'attesa di un worker libero ha la stessa scadenza.
+    """
+
+    def __init__(self, n: int, timeout: float = 300):
+        self.timeout = timeout
+        self._idle   = queue.Queue()
+        for _ in range(n):
+            self._idle.put(self._start())
+
+    @staticmethod
+    def _start() -> subprocess.Popen:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def parse(self, path: str, usecols=None, dtype=None) -> tuple:
+        """
+        (formato, DataFrame, motore, secondi parsing) del file su disco, da un worker libero.
+        OSError (TimeoutError compreso)/EOFError/ValueError = worker perso o scaduto
+        (rimpiazzato): il chiamante ripiega sul parsing locale.
+        RuntimeError = file illeggibile (errore del parser).
+        """
+        try:
+            proc = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"nessun worker libero entro {self.timeout:.0f}s") from None
+        if proc.poll() is not None:   # morto mentre era libero
+            proc = self._start()
+        watchdog = threading.Timer(self.timeout, proc.kill)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            req = {"path": path, "usecols": usecols, "dtype": dtype}
+            proc.stdin.write(json.dumps(req).encode() + b"\n")
+            proc.stdin.flush()
+            fmt, size, engine, parse_s = proc.stdout.readline().decode().split()
+            payload = proc.stdout.read(int(size))
+            if len(payload) < int(size):
+                raise EOFError("risposta worker incompleta")
+        except (OSError, EOFError, ValueError) as e:
+            proc.kill()
+            proc.wait()   # reaped: poll() lo vede morto e finally lo rimpiazza
+            if watchdog.finished.is_set():   # scattato il watchdog, non un crash
+                raise TimeoutError(f"parsing oltre {self.timeout:.0f}s: worker terminato") from e
+            raise
+        finally:
+            watchdog.cancel()
+            self._idle.put(proc if proc.poll() is None else self._start())
+        if fmt == "error":
+            raise RuntimeError(payload.decode(errors="replace"))
+        return fmt, decode_frame(fmt, payload), engine, float(parse_s)
+
+
+def main() -> None:
+    """Ciclo del worker: una richiesta JSON per riga su stdin, una risposta su stdout."""
+    # stdout riservato al protocollo: eventuali print/warning di librerie vanno su stderr
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    for line in sys.stdin.buffer:
+        engine, parse_s = "-", 0.0
+        try:
+            req = json.loads(line)
+            df, engine, parse_s = read_spreadsheet(req["path"], req.get("usecols"), req.get("dtype"))
+            fmt, payload = encode_frame(df)
+        except Exception as e:
+            fmt, payload = "error", f"{type(e).__name__}: {e}".encode()
+        out.write(f"{fmt} {len(payload)} {engine} {parse_s:.4f}\n".encode())
+        out.write(payload)
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()